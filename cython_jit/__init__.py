@@ -1,5 +1,6 @@
 import atexit
 import enum
+import sys
 from functools import wraps
 
 
@@ -7,6 +8,18 @@ class ModuleNotCachedError(Exception):
     pass
 
 
+class CompileCollectedError(Exception):
+    '''
+    Raised when some of the modules could not be compiled (the modules which
+    compiled successfully are still loaded).
+    '''
+
+    def __init__(self, pyd_name_to_error):
+        self.pyd_name_to_error = pyd_name_to_error
+        Exception.__init__(self, 'Error compiling: %s' % (
+            ', '.join('%s (%s)' % (pyd_name, error) for pyd_name, error in sorted(pyd_name_to_error.items())),))
+
+
 class JitStage(enum.Enum):
 
     # This mode will not really jit, it'll collect all information needed
@@ -21,6 +34,20 @@ class JitStage(enum.Enum):
     # This mode will only collect information (mostly useful for testing).
     collect_info = 2
 
+    # This mode will collect information until a threshold is reached (see:
+    # `set_background_compile_thresholds`) and will then compile the module
+    # in the background, switching to the compiled version when it's ready
+    # (useful for long-running processes which never exit).
+    collect_info_and_compile_in_background = 3
+
+
+# The stages where information is collected.
+_COLLECT_STAGES = (
+    JitStage.collect_info_and_compile_at_exit,
+    JitStage.collect_info,
+    JitStage.collect_info_and_compile_in_background,
+)
+
 
 class _RestoreState(object):
 
@@ -85,49 +112,489 @@ def get_temp_dir():
     return _get_jit_state_info().get_dir('temp')
 
 
-def jit(nogil=False):
+def remove_unused_artifacts():
+    '''
+    Removes the compiled modules in the cache dir which were replaced by newer
+    versions (modules still loaded by some live process sharing the cache dir
+    or being built are kept).
+
+    :return list(pathlib.Path):
+        The files removed.
+    '''
+    from cython_jit._manifest import remove_unused_artifacts
+    return remove_unused_artifacts(get_cache_dir())
+
+
+def set_cache_limits(max_size=None, max_age=None):
+    '''
+    Configures the limits of the cache dir: after modules are compiled, the
+    modules not used for more than `max_age` seconds and the least recently
+    used modules (until the cache has at most `max_size` bytes) are removed.
+
+    Modules loaded by some live process sharing the cache dir are kept.
+
+    :param int max_size:
+    :param float max_age:
+    '''
+    from cython_jit._jit_state_info import _get_jit_state_info
+    jit_state_info = _get_jit_state_info()
+    jit_state_info.cache_max_size = max_size
+    jit_state_info.cache_max_age = max_age
+
+
+def prune_cache(max_size=None, max_age=None):
+    '''
+    Removes the least recently used modules exceeding the given limits (or
+    the ones from `set_cache_limits` if no limit is given) and leftover build
+    files from the cache and temp dirs.
+
+    Modules replaced by newer versions are only removed when needed to fit
+    the limits (see: `remove_unused_artifacts` to remove all of them).
+
+    :return list(pathlib.Path):
+        The files and dirs removed.
+    '''
+    from cython_jit._jit_state_info import _get_jit_state_info
+    return _get_jit_state_info().prune_cache(max_size=max_size, max_age=max_age)
+
+
+def get_cache_stats():
+    '''
+    :return CacheStats:
+        The number and size of the modules in the cache dir and the size of
+        the temp dir.
+    '''
+    from cython_jit._cache import get_cache_stats
+    return get_cache_stats(get_cache_dir(), get_temp_dir())
+
+
+def set_compile_options(**compile_options):
+    '''
+    The options passed to `compile_collected` when it's called automatically
+    (i.e.: when the process exits in the `JitStage.collect_info_and_compile_at_exit`
+    stage).
+
+    i.e.:
+        set_compile_options(jobs=4, backend='inprocess')
+
+    :note: when compiling at exit in the process itself (i.e.: without a time
+        budget and not detached -- see: `set_compile_at_exit_options`) the
+        modules are always compiled one at a time (`jobs` is ignored).
+    '''
+    from cython_jit._jit_state_info import _get_jit_state_info
+    _get_jit_state_info().compile_options = compile_options
+
+
+def set_compile_at_exit_options(time_budget=None, detach=False):
+    '''
+    Configures the compilation done when the process exits in the
+    `JitStage.collect_info_and_compile_at_exit` stage.
+
+    :param float time_budget:
+        If given, the compilation is done in a separate process and the
+        process exit waits at most this number of seconds for it to finish
+        (if it doesn't finish in time it's kept running in the background).
+
+    :param bool detach:
+        If True the compilation is done in a separate process and the process
+        exit doesn't wait for it at all.
+    '''
+    from cython_jit._jit_state_info import _get_jit_state_info
+    jit_state_info = _get_jit_state_info()
+    jit_state_info.compile_at_exit_time_budget = time_budget
+    jit_state_info.compile_at_exit_detach = detach
+
+
+def set_background_compile_thresholds(calls=1000, seconds=None):
+    '''
+    Configures when a module is compiled in the
+    `JitStage.collect_info_and_compile_in_background` stage (whatever is
+    reached first).
+
+    :param int calls:
+        The module is compiled after a function is called this number of times.
+
+    :param float seconds:
+        The module is compiled after this number of seconds since the first
+        call of a function.
+    '''
+    from cython_jit._jit_state_info import _get_jit_state_info
+    jit_state_info = _get_jit_state_info()
+    jit_state_info.background_compile_calls = calls
+    jit_state_info.background_compile_seconds = seconds
+
+
+def set_build_mode(build_mode):
+    '''
+    Configures how the jitted functions are compiled.
+
+    :param str build_mode:
+        'module': the jitted functions of a python module are compiled in one
+            extension module along with the rest of the python module (the
+            default).
+        'sliced': the jitted functions of a python module are compiled in one
+            extension module along with only the imports, constants, helpers
+            and classes they reference (other classes and top-level code, such
+            as `if __name__ == '__main__':` blocks, are left out, so, compiling
+            and importing it is faster).
+        'function': each jitted function is compiled in its own extension
+            module along with only the imports, constants and helpers it
+            references. When a function changes, only its module (and the
+            modules of the functions which call it) are compiled again.
+    '''
+    from cython_jit._jit_state_info import BUILD_MODES
+    from cython_jit._jit_state_info import _get_jit_state_info
+    if build_mode not in BUILD_MODES:
+        raise AssertionError('Unexpected build mode: %s (expected one of: %s).' % (build_mode, ', '.join(BUILD_MODES)))
+    _get_jit_state_info().build_mode = build_mode
+
+
+def set_lazy_load(lazy_load=True):
+    '''
+    Configures whether the compiled modules are loaded lazily in the
+    `JitStage.use_compiled` stage.
+
+    If True, decorating a function just returns a lightweight proxy (the
+    compiled module is only looked up in the manifest of the cache dir and
+    loaded when the function is first called). This makes importing modules
+    with many jitted functions faster when only a few of them are called.
+    After the first call, the function in its module is replaced by the
+    compiled one (so, only the calls through references to the proxy kept
+    elsewhere -- i.e.: `from module import func` done before the first
+    call -- still go through it).
+
+    Note: if the compiled version is not available, `ModuleNotCachedError`
+    is raised on the first call (instead of when the function is decorated).
+    '''
+    from cython_jit._jit_state_info import _get_jit_state_info
+    _get_jit_state_info().lazy_load = lazy_load
+
+
+def set_stats_enabled(enabled=True):
+    '''
+    Configures whether runtime statistics are recorded: the calls (and the
+    time spent) in each jitted function according to whether the python or
+    the compiled version ran, the time spent collecting types, the fallbacks
+    (i.e.: `ModuleNotCachedError`) and the time to compile each module.
+
+    Note: only the functions jitted after this call are instrumented (so, it
+    should be called before the modules with jitted functions are imported).
+    When disabled (the default) there's no overhead.
+    '''
+    from cython_jit._jit_state_info import _get_jit_state_info
+    from cython_jit._stats import RuntimeStats
+    jit_state_info = _get_jit_state_info()
+    if not enabled:
+        jit_state_info.stats = None
+    elif jit_state_info.stats is None:
+        jit_state_info.stats = RuntimeStats()
+
+
+def get_stats():
+    '''
+    :return cython_jit._stats.Stats|NoneType:
+        The runtime statistics recorded so far (None if not enabled -- see:
+        `set_stats_enabled`).
+    '''
+    from cython_jit._jit_state_info import _get_jit_state_info
+    stats = _get_jit_state_info().stats
+    if stats is None:
+        return None
+    return stats.get_stats()
+
+
+def export_stats(path, output_format='json'):
+    '''
+    Saves the runtime statistics (see: `set_stats_enabled`) to the given path.
+
+    :param str output_format:
+        'json' or 'prometheus' (the Prometheus text format).
+    '''
+    from cython_jit._stats import export_stats
+    stats = get_stats()
+    if stats is None:
+        raise AssertionError('The stats are not enabled (see: cython_jit.set_stats_enabled).')
+    export_stats(stats, path, output_format)
+
+
+def save_type_profile(path):
+    '''
+    Saves the information collected so far (the types seen in the calls of
+    the jitted functions) to a json file, so that the functions may be compiled
+    later on without importing the application, possibly in another machine:
+
+        python -m cython_jit compile --profile <path> --cache-dir <cache_dir>
+
+    Profiles saved by different processes (i.e.: one file per process) may be
+    given together (their information is merged).
+
+    :param str|pathlib.Path path:
+    '''
+    from pathlib import Path
+    from cython_jit import _type_profiles
+    from cython_jit._jit_state_info import _get_jit_state_info
+    _type_profiles.save_type_profile(
+        Path(path), _type_profiles.create_type_profile(list(_get_jit_state_info().all_collectors.values())))
+
+
+def _register_compile_at_exit(jit_state_info):
+    if not jit_state_info.compile_at_exit_registered:
+        jit_state_info.compile_at_exit_registered = True
+        atexit.register(jit_state_info.compile_at_exit)
+
+
+def _get_stats_recorder(jit_state_info, func):
+    '''
+    :return FunctionRecorder|NoneType:
+        The recorder for the calls of the given function (None if the stats
+        are not enabled).
+    '''
+    stats = jit_state_info.stats
+    if stats is None:
+        return None
+    return stats.get_recorder(func)
+
+
+def jit(nogil=False, stable_after=None, max_signatures=None, directives=None, aggressive=False, profile=None,
+        infer_locals=False, parallel=False, num_threads=None, vectorize=False, inline=None):
+    '''
+    :param bool nogil:
+        If True the function is compiled as a `noexcept nogil` function.
+
+    :param int stable_after:
+        Information is no longer collected after the same types are seen in
+        this number of consecutive calls (0 means that it's always collected).
+        If None, `CythonJitInfoCollector.DEFAULT_STABLE_AFTER` is used.
+
+    :param int max_signatures:
+        The maximum number of distinct signatures compiled for the function
+        (each signature is compiled as a separate cdef function and a def
+        wrapper dispatches to the one matching the types of the arguments).
+        If None, `CythonJitInfoCollector.DEFAULT_MAX_SIGNATURES` is used.
+
+    :param dict(str, bool) directives:
+        Cython directives applied to the function (boundscheck, wraparound,
+        cdivision, initializedcheck or nonecheck).
+        i.e.: jit(directives=dict(cdivision=True))
+
+    :param bool aggressive:
+        If True, boundscheck, wraparound and initializedcheck are turned off
+        when the function receives memoryviews (unless explicitly given in
+        `directives`).
+
+    :param str|CompileProfile profile:
+        The C compiler optimization profile for the module of this function
+        (a name from `cython_jit.compile_with_cython.PROFILES`, such as
+        'fast' or 'native', or a `CompileProfile`). If None, the profile
+        given to `compile_collected` is used.
+
+    :param bool infer_locals:
+        If True, the types of local variables (loop counters, accumulators,
+        memoryview items, ...) are inferred from the types of the arguments
+        and declared with `cdef` so that loops are compiled to C code.
+        Note: inferred integers are C integers (so, they may overflow where
+        a python int would not).
+
+    :param bool parallel:
+        If True, the outermost `for i in range(...)` loops over memoryviews
+        are converted to `cython.parallel.prange` loops and the module is
+        compiled with OpenMP (requires `nogil=True`). The iterations must be
+        independent (variables assigned in the loop body are private to each
+        thread and in-place operators such as `+=` are reductions).
+
+    :param int num_threads:
+        The number of threads used in the `prange` loops (if None, OpenMP
+        decides it -- i.e.: based on the `OMP_NUM_THREADS` environment
+        variable).
+
+    :param bool vectorize:
+        If True, the function (which must receive and return scalars) may
+        also be called with arrays (which are broadcast as in numpy) and it's
+        applied to each element in a C loop. The result is a new array or
+        the array passed in the `out` keyword argument.
+        i.e.:
+            @jit(vectorize=True)
+            def add_one(x):
+                return x + 1
+
+            add_one(numpy.arange(10))
+
+    :param bool inline:
+        If True the function is compiled as a `cdef inline` function (a hint
+        for the C compiler to inline it in the calls from other jitted
+        functions of the same module). If None, it's inlined if it's called
+        from other jitted functions and its body is small (see:
+        `CythonJitInfoCollector.MAX_AUTO_INLINE_LINES`).
+
+    :note: calls from a jitted function to another jitted function of the same
+        module are compiled as direct C calls (to the specialization of the
+        callee matching the types seen when the caller was called with each
+        signature).
+    '''
     from cython_jit._jit_state_info import _get_jit_state_info
     stage = get_jit_stage()
     jit_state_info = _get_jit_state_info()
-    if stage in (JitStage.collect_info_and_compile_at_exit, JitStage.collect_info):
+    if stage in _COLLECT_STAGES:
+        if stage == JitStage.collect_info_and_compile_at_exit:
+            _register_compile_at_exit(jit_state_info)
 
         def method(func):
+            from time import perf_counter
             from cython_jit import _info_collector
-            collector = _info_collector.CythonJitInfoCollector(func, nogil=nogil, jit_stage=stage)
+            from cython_jit import _stats
+            collector = _info_collector.CythonJitInfoCollector(
+                func, nogil=nogil, jit_stage=stage, stable_after=stable_after, max_signatures=max_signatures,
+                directives=directives, aggressive=aggressive, profile=profile, infer_locals=infer_locals,
+                parallel=parallel, num_threads=num_threads, vectorize=vectorize, inline=inline)
+            recorder = _get_stats_recorder(jit_state_info, func)
+
+            # The frame calling `actual_method` (`instrumented_method` is in
+            # between if the stats are enabled).
+            caller_depth = 2 if recorder is None else 3
+
+            def collect_and_call(args, kwargs):
+                if vectorize:
+                    from cython_jit import _vectorize
+                    return _vectorize.call_element_wise(collector, func, args, kwargs)
+                if recorder is not None:
+                    initial_time = perf_counter()
+                collector.collect_args(args, kwargs)
+                if recorder is not None:
+                    collect_time = perf_counter() - initial_time
+
+                ret = func(*args, **kwargs)
+
+                if recorder is not None:
+                    initial_time = perf_counter()
+                if not collector.collection_done:
+                    collector.collect_caller(sys._getframe(caller_depth).f_code)
+                collector.collect_return(ret)
+                if recorder is not None:
+                    recorder.record_collect(collect_time + perf_counter() - initial_time)
+                return ret
 
             @wraps(func)
             def actual_method(*args, **kwargs):
                 # Get the new stage as it could've changed.
                 stage = get_jit_stage()
-                if stage in (JitStage.collect_info_and_compile_at_exit, JitStage.collect_info):
-                    collector.collect_args(args, kwargs)
-                    ret = func(*args, **kwargs)
-                    collector.collect_return(ret)
+                if stage == JitStage.collect_info_and_compile_in_background:
+                    compiled_func = collector.compiled_func
+                    if compiled_func is not None:
+                        return compiled_func(*args, **kwargs)
+
+                    if collector.compile_scheduled:
+                        # Being compiled: just run the python version.
+                        if recorder is not None:
+                            recorder.record_fallback(_stats.FALLBACK_COMPILE_PENDING)
+                        if vectorize:
+                            from cython_jit import _vectorize
+                            return _vectorize.call_element_wise(collector, func, args, kwargs, collect=False)
+                        return func(*args, **kwargs)
+
+                    ret = collect_and_call(args, kwargs)
+                    jit_state_info.on_collected_in_background(collector)
                     return ret
 
+                elif stage in _COLLECT_STAGES:
+                    if stage == JitStage.collect_info_and_compile_at_exit:
+                        _register_compile_at_exit(jit_state_info)
+                    return collect_and_call(args, kwargs)
+
                 elif stage == JitStage.use_compiled:
                     # Stage changed to use compiled!
                     cached = jit_state_info.get_cached(collector)
                     if cached is None:
+                        if recorder is not None:
+                            recorder.record_fallback(_stats.FALLBACK_NOT_CACHED)
                         raise ModuleNotCachedError('Unable to find cython-compiled module for: %s' % (func,))
                     return cached(*args, **kwargs)
 
                 else:
                     raise AssertionError('TODO')
 
+            if recorder is not None:
+
+                def get_stage_and_mode():
+                    stage = get_jit_stage()
+                    if stage == JitStage.collect_info_and_compile_in_background:
+                        if collector.compiled_func is not None:
+                            return stage, 'compiled'
+                        if collector.compile_scheduled:
+                            return stage, 'python'
+                    elif stage == JitStage.use_compiled:
+                        return stage, 'compiled'
+                    return stage, 'collect'
+
+                return _stats.instrument(recorder, actual_method, get_stage_and_mode)
+
             return actual_method
 
         return method
 
     elif stage == JitStage.use_compiled:
+        jit_options = dict(
+            nogil=nogil, directives=directives, aggressive=aggressive, infer_locals=infer_locals,
+            parallel=parallel, num_threads=num_threads, vectorize=vectorize, inline=inline)
+
+        if jit_state_info.lazy_load:
+
+            def method(func):
+                # The collector (which hashes the function code) is only created
+                # and the module loaded on the first call.
+                compiled = []
+                recorder = _get_stats_recorder(jit_state_info, func)
+
+                def resolve():
+                    from cython_jit import _info_collector
+                    collector = _info_collector.CythonJitInfoCollector(
+                        func, jit_stage=stage, register=False, **jit_options)
+                    cached = jit_state_info.get_cached(collector)
+                    if cached is None:
+                        if recorder is not None:
+                            from cython_jit import _stats
+                            recorder.record_fallback(_stats.FALLBACK_NOT_CACHED)
+                        raise ModuleNotCachedError('Unable to find cython-compiled module for: %s' % (func,))
+                    compiled.append(cached)
+
+                    # Rebind the module attribute so that the next calls through
+                    # the module go directly to the compiled function (references
+                    # to this wrapper kept elsewhere still forward to it).
+                    resolved = cached
+                    if recorder is not None:
+                        from cython_jit import _stats
+                        resolved = _stats.instrument(recorder, cached, lambda: (stage, 'compiled'))
+                    module_globals = func.__globals__
+                    if func.__qualname__ == func.__name__ and module_globals.get(func.__name__) is wrapper:
+                        module_globals[func.__name__] = resolved
+
+                @wraps(func)
+                def lazy_method(*args, **kwargs):
+                    if not compiled:
+                        resolve()
+                    return compiled[0](*args, **kwargs)
+
+                wrapper = lazy_method
+                if recorder is not None:
+                    from cython_jit import _stats
+                    wrapper = _stats.instrument(recorder, lazy_method, lambda: (stage, 'compiled'))
+                return wrapper
+
+            return method
 
         def method(func):
             from cython_jit import _info_collector
-            collector = _info_collector.CythonJitInfoCollector(func, nogil=nogil, jit_stage=stage)
+            collector = _info_collector.CythonJitInfoCollector(func, jit_stage=stage, **jit_options)
+            recorder = _get_stats_recorder(jit_state_info, func)
 
             cached = jit_state_info.get_cached(collector)
             if cached is None:
+                if recorder is not None:
+                    from cython_jit import _stats
+                    recorder.record_fallback(_stats.FALLBACK_NOT_CACHED)
                 raise ModuleNotCachedError('Unable to find cython-compiled module for: %s' % (func,))
+            if recorder is not None:
+                from cython_jit import _stats
+                return _stats.instrument(recorder, cached, lambda: (stage, 'compiled'))
             return cached
 
         return method
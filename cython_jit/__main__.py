@@ -0,0 +1,249 @@
+'''
+Command line interface for cython_jit.
+
+i.e.:
+    python -m cython_jit compile --profile profiles_dir --cache-dir cache_dir
+    python -m cython_jit build mypackage --profile profiles_dir --format wheel --output dist
+    python -m cython_jit cache prune --max-size 500M --max-age 30d
+    python -m cython_jit bench --json bench.json
+'''
+import sys
+
+
+def _compile(args):
+    from pathlib import Path
+    import cython_jit
+    from cython_jit import _type_profiles
+
+    if args.cache_dir:
+        cython_jit.set_cache_dir(Path(args.cache_dir))
+    if args.temp_dir:
+        cython_jit.set_temp_dir(Path(args.temp_dir))
+    cython_jit.set_build_mode(args.build_mode)
+
+    type_profile = _type_profiles.load_type_profiles([Path(p) for p in args.profile])
+    pyd_name_to_error, stale = _type_profiles.compile_type_profile(
+        type_profile,
+        source_paths=[Path(p) for p in args.source_path],
+        silent=not args.verbose,
+        debug=args.debug,
+        jobs=args.jobs,
+        backend=args.backend,
+        profile=args.compile_profile,
+    )
+
+    for func_profile in stale:
+        sys.stderr.write('Skipped (changed since the profile was collected): %s.%s\n' % (
+            func_profile['module'], func_profile['name']))
+    for pyd_name, error in sorted(pyd_name_to_error.items()):
+        sys.stderr.write('Error compiling: %s (%s)\n' % (pyd_name, error))
+    return 1 if pyd_name_to_error else 0
+
+
+def _build(args):
+    from pathlib import Path
+    import cython_jit
+    from cython_jit import _build
+    from cython_jit import _type_profiles
+
+    if args.temp_dir:
+        cython_jit.set_temp_dir(Path(args.temp_dir))
+    cython_jit.set_build_mode(args.build_mode)
+
+    type_profile = None
+    if args.profile:
+        type_profile = _type_profiles.load_type_profiles([Path(p) for p in args.profile])
+
+    output_path, pyd_name_to_error, stale = _build.build(
+        Path(args.package).absolute(),
+        Path(args.output),
+        type_profile=type_profile,
+        output_format=args.format,
+        version=args.version,
+        build_dir=Path(args.build_dir) if args.build_dir else None,
+        silent=not args.verbose,
+        debug=args.debug,
+        jobs=args.jobs,
+        backend=args.backend,
+        profile=args.compile_profile,
+    )
+
+    for func_profile in stale:
+        sys.stderr.write('Skipped (changed since the profile was collected): %s.%s\n' % (
+            func_profile['module'], func_profile['name']))
+    for pyd_name, error in sorted(pyd_name_to_error.items()):
+        sys.stderr.write('Error compiling: %s (%s)\n' % (pyd_name, error))
+    if output_path is None:
+        sys.stderr.write('No jitted functions with collected types or annotations found.\n')
+    else:
+        sys.stdout.write('Created: %s\n' % (output_path,))
+    return 1 if pyd_name_to_error else 0
+
+
+def _cache(args):
+    from pathlib import Path
+    import cython_jit
+    from cython_jit import _cache
+
+    if args.cache_dir:
+        cython_jit.set_cache_dir(Path(args.cache_dir))
+    if args.temp_dir:
+        cython_jit.set_temp_dir(Path(args.temp_dir))
+    cache_dir = cython_jit.get_cache_dir()
+    temp_dir = cython_jit.get_temp_dir()
+
+    if args.cache_command == 'stats':
+        stats = _cache.get_cache_stats(cache_dir, temp_dir)
+        sys.stdout.write('Cache dir: %s\n' % (cache_dir,))
+        sys.stdout.write('Modules: %s (%s latest)\n' % (stats.modules, stats.latest_modules))
+        sys.stdout.write('Size: %s bytes\n' % (stats.size,))
+        sys.stdout.write('Temp dir: %s\n' % (temp_dir,))
+        sys.stdout.write('Temp size: %s bytes\n' % (stats.temp_size,))
+        return 0
+
+    if args.cache_command == 'prune':
+        removed = _cache.prune_cache(
+            cache_dir,
+            temp_dir,
+            max_size=_cache.parse_size(args.max_size) if args.max_size else None,
+            max_age=_cache.parse_age(args.max_age) if args.max_age else None,
+        )
+    elif args.cache_command == 'clear':
+        removed = _cache.clear_cache(cache_dir, temp_dir)
+    else:
+        raise AssertionError('Unexpected cache command: %s' % (args.cache_command,))
+
+    for path in removed:
+        sys.stdout.write('Removed: %s\n' % (path,))
+    return 0
+
+
+def _bench(args):
+    from pathlib import Path
+    import json
+    from cython_jit import _bench
+
+    python_latencies = {}
+
+    def on_result(result):
+        if result.stage == 'python' and result.threads == 1:
+            python_latencies[result.kernel] = result.latency
+        sys.stdout.write(_bench.format_result(result, python_latencies.get(result.kernel)) + '\n')
+        sys.stdout.flush()
+
+    report = _bench.run_benchmarks(
+        kernel_names=args.kernel or None,
+        thread_counts=tuple(int(x) for x in args.threads.split(',')),
+        min_time=args.min_time,
+        repeat=args.repeat,
+        cache_dir=Path(args.cache_dir) if args.cache_dir else None,
+        temp_dir=Path(args.temp_dir) if args.temp_dir else None,
+        profile=args.compile_profile,
+        on_result=on_result,
+    )
+    sys.stdout.write('Compile time: %.3f s\n' % (report.compile_time,))
+    sys.stdout.write('Import time: %.3f ms\n' % (report.import_time * 1e3,))
+
+    if args.json:
+        with open(args.json, 'w') as stream:
+            json.dump(_bench.report_to_json(report), stream, indent=2, sort_keys=True)
+        sys.stdout.write('Created: %s\n' % (args.json,))
+    return 0
+
+
+def _add_compile_arguments(parser):
+    parser.add_argument('--temp-dir', help='The directory where temporary files are stored.')
+    parser.add_argument('--jobs', type=int, help='The number of modules compiled concurrently.')
+    parser.add_argument('--backend', choices=('inprocess', 'subprocess'))
+    parser.add_argument(
+        '--compile-profile', help='The C compiler optimization profile (i.e.: default, fast, native, aggressive).')
+    parser.add_argument(
+        '--build-mode', choices=('module', 'sliced', 'function'), default='module',
+        help='module: compile each python module as an extension module; sliced: only with the jitted functions '
+        'and what they reference; function: each jitted function in its own extension module.')
+    parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--verbose', action='store_true')
+
+
+def create_parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m cython_jit', description='Use Cython as a Jit for Python.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    compile_parser = subparsers.add_parser(
+        'compile', help='Compiles the jitted functions with the types from saved type profiles.')
+    compile_parser.add_argument(
+        '--profile', action='append', required=True,
+        help='A type profile saved with cython_jit.save_type_profile (or a directory with type profiles). '
+        'May be given multiple times (the profiles are merged).')
+    compile_parser.add_argument(
+        '--source-path', action='append', default=[],
+        help='A directory where the modules are searched if they are not in the location where '
+        'the profile was collected. May be given multiple times.')
+    compile_parser.add_argument('--cache-dir', help='The directory where the compiled modules are stored.')
+    _add_compile_arguments(compile_parser)
+    compile_parser.set_defaults(func=_compile)
+
+    build_parser = subparsers.add_parser(
+        'build', help='Compiles the jitted functions of a package (with the types from type profiles or '
+        'string annotations) and creates a wheel or a tarball with the compiled modules.')
+    build_parser.add_argument('package', help='The directory of the package.')
+    build_parser.add_argument(
+        '--profile', action='append', default=[],
+        help='A type profile (or a directory with type profiles). May be given multiple times.')
+    build_parser.add_argument('--format', choices=('wheel', 'tar'), default='wheel')
+    build_parser.add_argument('--output', default='dist', help='The directory where the wheel/tarball is created.')
+    build_parser.add_argument('--version', default='0.0.0', help='The version of the wheel.')
+    build_parser.add_argument(
+        '--build-dir', help='The directory where the modules are compiled (a temporary dir by default).')
+    _add_compile_arguments(build_parser)
+    build_parser.set_defaults(func=_build)
+
+    cache_parser = subparsers.add_parser('cache', help='Shows or cleans up the compiled modules in the cache dir.')
+    cache_parser.add_argument('--cache-dir', help='The directory where the compiled modules are stored.')
+    cache_parser.add_argument('--temp-dir', help='The directory where temporary files are stored.')
+    cache_subparsers = cache_parser.add_subparsers(dest='cache_command')
+    cache_subparsers.required = True
+    cache_subparsers.add_parser('stats', help='Shows the number and size of the compiled modules.')
+    prune_parser = cache_subparsers.add_parser(
+        'prune', help='Removes old versions of modules, leftover build files and the modules exceeding the limits '
+        '(least recently used first). Modules loaded by running processes are kept.')
+    prune_parser.add_argument('--max-size', help='The maximum size of the cache (i.e.: 500M, 2G).')
+    prune_parser.add_argument(
+        '--max-age', help='Modules not used for longer than this are removed (i.e.: 3600, 12h, 30d).')
+    cache_subparsers.add_parser('clear', help='Removes all the compiled modules (but the ones in use).')
+    cache_parser.set_defaults(func=_cache)
+
+    from cython_jit._bench import KERNELS
+    bench_parser = subparsers.add_parser(
+        'bench', help='Measures the latency and throughput of benchmark kernels as plain python, while '
+        'collecting types and compiled (and the time to compile and import them).')
+    bench_parser.add_argument(
+        '--kernel', action='append', choices=[kernel.name for kernel in KERNELS],
+        help='The kernel to benchmark (may be given multiple times -- all by default).')
+    bench_parser.add_argument(
+        '--threads', default='1,2,4', help='The number of threads used with kernels which release the GIL.')
+    bench_parser.add_argument(
+        '--min-time', type=float, default=.2, help='The minimum number of seconds of each measure.')
+    bench_parser.add_argument('--repeat', type=int, default=3, help='The number of measures (the best is used).')
+    bench_parser.add_argument('--json', help='A file where the results are saved as json.')
+    bench_parser.add_argument(
+        '--cache-dir', help='The directory where the compiled modules are stored (a temporary dir by default).')
+    bench_parser.add_argument(
+        '--temp-dir', help='The directory where temporary files are stored (a temporary dir by default).')
+    bench_parser.add_argument(
+        '--compile-profile', help='The C compiler optimization profile (i.e.: default, fast, native, aggressive).')
+    bench_parser.set_defaults(func=_bench)
+    return parser
+
+
+def main(argv=None):
+    parser = create_parser()
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
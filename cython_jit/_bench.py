@@ -0,0 +1,295 @@
+'''
+Benchmarks for the code generated by cython_jit.
+
+i.e.:
+    python -m cython_jit bench
+    python -m cython_jit bench --kernel bench_dot --threads 1,2,4 --json bench.json
+
+For each kernel (see: `cython_jit._bench_kernels`) the latency (seconds per
+call) and throughput (calls per second) are measured when calling:
+
+- python: the plain python function;
+- collect_info: the function in `JitStage.collect_info` (the overhead of
+  collecting the types -- note that the collection stops once the types are
+  stable, so, this is mostly the overhead of the wrapper);
+- use_compiled: the compiled function.
+
+The time to compile the kernels and to import the compiled module are also
+measured. Kernels which release the GIL (`nogil=True`) are also called from
+many python threads (the throughput should scale with the number of threads up
+to the number of cores).
+'''
+from collections import namedtuple
+
+# name: the name of the function in `cython_jit._bench_kernels`.
+# description: what's measured.
+# create_args: callable(numpy.random.RandomState) -> tuple with the args for a call.
+# threaded: whether it's also called from many threads.
+BenchKernel = namedtuple('BenchKernel', 'name, description, create_args, threaded')
+
+KERNELS = (
+    BenchKernel('bench_scalar', 'scalar arithmetic', lambda random: (1000,), False),
+    BenchKernel('bench_sum_2d', '2-D memoryview loop', lambda random: (random.random_sample((300, 300)),), False),
+    BenchKernel('bench_dot', 'reduction', lambda random: (
+        random.random_sample(100000), random.random_sample(100000)), False),
+    BenchKernel('bench_sum_squares', 'nogil with threads', lambda random: (random.random_sample(100000),), True),
+)
+
+STAGES = ('python', 'collect_info', 'use_compiled')
+
+# latency: the seconds per call (in each thread).
+# throughput: the calls per second (in all the threads).
+BenchResult = namedtuple('BenchResult', 'kernel, stage, threads, latency, throughput')
+
+# environment: dict with the versions of python, cython, numpy and the platform.
+# compile_time: the seconds to compile the kernels (small if they were already in the cache).
+# import_time: the seconds to import the kernels in `JitStage.use_compiled`.
+# results: list(BenchResult)
+BenchReport = namedtuple('BenchReport', 'environment, compile_time, import_time, results')
+
+
+def _load_kernels_module():
+    from importlib import import_module
+    from importlib import reload
+    import sys
+
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    all_collectors = _get_jit_state_info().all_collectors
+    for kernel in KERNELS:
+        all_collectors.pop(kernel.name, None)
+    module = sys.modules.get('cython_jit._bench_kernels')
+    if module is None:
+        return import_module('cython_jit._bench_kernels')
+    return reload(module)
+
+
+def _call_kernels(module):
+    '''
+    Calls all the kernels once (so that the types are collected for all of
+    them -- the compiled module can only be loaded if all were collected).
+    '''
+    import numpy
+    random = numpy.random.RandomState(0)
+    for kernel in KERNELS:
+        getattr(module, kernel.name)(*kernel.create_args(random))
+
+
+def _time_calls(func, args, calls):
+    import time
+    initial_time = time.perf_counter()
+    for _i in range(calls):
+        func(*args)
+    return time.perf_counter() - initial_time
+
+
+def measure_latency(func, args, min_time=.2, repeat=3):
+    '''
+    :param float min_time:
+        Each measure calls `func(*args)` as many times as needed to take at
+        least this number of seconds.
+
+    :param int repeat:
+        The number of measures (the best one is used).
+
+    :return float:
+        The seconds per call.
+    '''
+    calls = 1
+    while True:
+        elapsed = _time_calls(func, args, calls)
+        if elapsed >= min_time:
+            break
+        if elapsed <= 0:
+            calls *= 10
+        else:
+            calls = max(calls * 2, int(calls * min_time / elapsed * 1.1))
+
+    timings = [elapsed / calls]
+    for _i in range(repeat - 1):
+        timings.append(_time_calls(func, args, calls) / calls)
+    return min(timings)
+
+
+def bench_threads(func, args, num_threads, calls_per_thread):
+    '''
+    :return float:
+        The number of calls per second when calling `func(*args)`
+        `calls_per_thread` times in each one of the `num_threads` threads.
+    '''
+    import threading
+    import time
+
+    barrier = threading.Barrier(num_threads + 1)
+
+    def run():
+        barrier.wait()
+        for _i in range(calls_per_thread):
+            func(*args)
+
+    threads = [threading.Thread(target=run) for _i in range(num_threads)]
+    for t in threads:
+        t.start()
+
+    barrier.wait()
+    initial_time = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - initial_time
+    return (num_threads * calls_per_thread) / elapsed
+
+
+def _get_environment():
+    import platform
+
+    import Cython
+    import numpy
+    return dict(
+        python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        cython=Cython.__version__,
+        numpy=numpy.__version__,
+        platform=platform.platform(),
+        machine=platform.machine(),
+    )
+
+
+def run_benchmarks(kernel_names=None, thread_counts=(1, 2, 4), min_time=.2, repeat=3, cache_dir=None,
+                   temp_dir=None, profile=None, on_result=None):
+    '''
+    :param list(str) kernel_names:
+        The kernels to benchmark (if None, all in `KERNELS`).
+
+    :param tuple(int) thread_counts:
+        The number of threads used with the kernels which release the GIL.
+
+    :param pathlib.Path cache_dir:
+    :param pathlib.Path temp_dir:
+        If not given, temporary dirs are used (so that the compile time is
+        always measured).
+
+    :param str|CompileProfile profile:
+        The C compiler optimization profile (see: `compile_collected`).
+
+    :param callable(BenchResult) on_result:
+        Called as each result is available.
+
+    :return BenchReport:
+    '''
+    from pathlib import Path
+    import shutil
+    import tempfile
+    import time
+
+    import numpy
+
+    from cython_jit import JitStage, set_jit_stage, set_cache_dir, set_temp_dir
+    from cython_jit import get_cache_dir, get_temp_dir
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    name_to_kernel = dict((kernel.name, kernel) for kernel in KERNELS)
+    if kernel_names is None:
+        kernel_names = [kernel.name for kernel in KERNELS]
+    for kernel_name in kernel_names:
+        if kernel_name not in name_to_kernel:
+            raise AssertionError('Unknown kernel: %s (expected one of: %s).' % (
+                kernel_name, ', '.join(name_to_kernel)))
+    kernels = [name_to_kernel[kernel_name] for kernel_name in kernel_names]
+
+    random = numpy.random.RandomState(0)
+    name_to_args = dict((kernel.name, kernel.create_args(random)) for kernel in kernels)
+
+    results = []
+
+    def measure(kernel, stage, func):
+        args = name_to_args[kernel.name]
+        latency = measure_latency(func, args, min_time=min_time, repeat=repeat)
+        add_result(BenchResult(kernel.name, stage, 1, latency, 1.0 / latency))
+
+        if kernel.threaded and stage != 'collect_info':
+            calls_per_thread = max(1, int(min_time / latency))
+            for num_threads in thread_counts:
+                if num_threads == 1:
+                    continue
+                throughput = max(bench_threads(func, args, num_threads, calls_per_thread) for _i in range(repeat))
+                add_result(BenchResult(kernel.name, stage, num_threads, num_threads / throughput, throughput))
+
+    def add_result(result):
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+
+    created_dir = None
+    if cache_dir is None or temp_dir is None:
+        created_dir = Path(tempfile.mkdtemp(prefix='cython_jit_bench_'))
+        if cache_dir is None:
+            cache_dir = created_dir / 'cache'
+        if temp_dir is None:
+            temp_dir = created_dir / 'temp'
+    prev_cache_dir = get_cache_dir()
+    prev_temp_dir = get_temp_dir()
+    set_cache_dir(cache_dir)
+    set_temp_dir(temp_dir)
+    try:
+        with set_jit_stage(JitStage.collect_info):
+            module = _load_kernels_module()
+            _call_kernels(module)
+            for kernel in kernels:
+                measure(kernel, 'python', getattr(module, kernel.name).__wrapped__)
+                measure(kernel, 'collect_info', getattr(module, kernel.name))
+
+            initial_time = time.perf_counter()
+            _get_jit_state_info().compile_collected(silent=True, profile=profile)
+            compile_time = time.perf_counter() - initial_time
+
+        with set_jit_stage(JitStage.use_compiled):
+            initial_time = time.perf_counter()
+            module = _load_kernels_module()
+            import_time = time.perf_counter() - initial_time
+            for kernel in kernels:
+                measure(kernel, 'use_compiled', getattr(module, kernel.name))
+    finally:
+        set_cache_dir(prev_cache_dir)
+        set_temp_dir(prev_temp_dir)
+        if created_dir is not None:
+            shutil.rmtree(str(created_dir), ignore_errors=True)
+
+    return BenchReport(_get_environment(), compile_time, import_time, results)
+
+
+def report_to_json(report):
+    '''
+    :return dict:
+        The report as a dict which may be saved as json.
+    '''
+    return dict(
+        environment=report.environment,
+        compile_time=report.compile_time,
+        import_time=report.import_time,
+        results=[result._asdict() for result in report.results],
+    )
+
+
+def format_result(result, python_latency=None):
+    '''
+    :param float python_latency:
+        If given, the speedup over the plain python function is shown.
+
+    :return str:
+    '''
+    speedup = ''
+    if python_latency is not None:
+        # Compared to the throughput of the python function in a single thread.
+        speedup = '  speedup: %8.2fx' % (result.throughput * python_latency,)
+    return '%-18s %-13s threads: %2d  latency: %12.3f us  calls/s: %14.1f%s' % (
+        result.kernel, result.stage, result.threads, result.latency * 1e6, result.throughput, speedup)
+
+
+def main(argv=None):
+    from cython_jit.__main__ import main
+    return main(['bench'] + list(argv or []))
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv[1:]))
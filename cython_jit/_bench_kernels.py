@@ -0,0 +1,37 @@
+'''
+Kernels used in the benchmarks (see: `cython_jit._bench`).
+'''
+from cython_jit import jit
+
+
+@jit(infer_locals=True)
+def bench_scalar(n):
+    total = 0.0
+    for i in range(n):
+        total += i * 0.5 + 1.0
+    return total
+
+
+@jit(infer_locals=True, aggressive=True)
+def bench_sum_2d(mat):
+    total = 0.0
+    for i in range(mat.shape[0]):
+        for j in range(mat.shape[1]):
+            total += mat[i, j]
+    return total
+
+
+@jit(infer_locals=True, aggressive=True)
+def bench_dot(a, b):
+    total = 0.0
+    for i in range(a.shape[0]):
+        total += a[i] * b[i]
+    return total
+
+
+@jit(nogil=True, infer_locals=True)
+def bench_sum_squares(arr):
+    total = 0.0
+    for i in range(arr.shape[0]):
+        total += arr[i] * arr[i]
+    return total
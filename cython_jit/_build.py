@@ -0,0 +1,210 @@
+'''
+Ahead-of-time build of the jitted functions of a package (so that hosts
+without a C compiler may use `JitStage.use_compiled` from the start).
+
+i.e.:
+    python -m cython_jit build mypackage --profile profiles_dir --format wheel --output dist
+
+The wheel has a `<package>_cyjit` package with the compiled modules, which is
+used as the cache dir:
+
+    import mypackage_cyjit
+    cython_jit.set_cache_dir(mypackage_cyjit.CACHE_DIR)
+    cython_jit.set_jit_stage(cython_jit.JitStage.use_compiled)
+
+The tarball has the compiled modules to be extracted to the cache dir.
+'''
+import sys
+
+_CACHE_PACKAGE_INIT = """'''
+Modules compiled by cython_jit (to be used with: cython_jit.set_cache_dir(CACHE_DIR)).
+'''
+from pathlib import Path
+
+CACHE_DIR = Path(__file__).absolute().parent
+"""
+
+
+def find_package_modules(package_dir):
+    '''
+    :param pathlib.Path package_dir:
+        The directory of a package.
+
+    :return list(tuple(str, pathlib.Path)):
+        The name and path of each python module in the package (including
+        subpackages).
+    '''
+    ret = []
+    for path in sorted(package_dir.rglob('*.py')):
+        relative = path.relative_to(package_dir.parent)
+        if not all((package_dir.parent / parent / '__init__.py').exists() for parent in relative.parents
+                   if len(parent.parts) > 1):
+            continue  # Not inside a subpackage.
+        parts = list(relative.with_suffix('').parts)
+        if parts[-1] == '__init__':
+            parts = parts[:-1]
+        ret.append(('.'.join(parts), path))
+    return ret
+
+
+def create_package_collectors(package_dir, type_profile=None):
+    '''
+    Creates the collectors for the jitted functions in the package (the types
+    come from the type profile or from the string annotations of the functions).
+
+    :return tuple(list(CythonJitInfoCollector), list(dict)):
+        The collectors and the functions in the profile which are stale.
+    '''
+    from collections import defaultdict
+    from cython_jit import _type_profiles
+
+    module_to_func_profiles = defaultdict(list)
+    if type_profile is not None:
+        _type_profiles.check_python_version(type_profile)
+        for func_profile in type_profile['functions']:
+            module_to_func_profiles[func_profile['module']].append(func_profile)
+
+    collectors = []
+    stale = []
+    for module_name, path in find_package_modules(package_dir):
+        if 'jit' not in path.read_text():
+            continue
+        module_collectors, module_stale = _type_profiles.create_module_collectors(
+            module_name, path, module_to_func_profiles.get(module_name, ()), use_annotations=True)
+        collectors.extend(module_collectors)
+        stale.extend(module_stale)
+    return collectors, stale
+
+
+def _get_wheel_tag():
+    import sysconfig
+    python_tag = 'cp%s%s' % sys.version_info[:2]
+    abi_tag = python_tag + getattr(sys, 'abiflags', '')
+    platform_tag = sysconfig.get_platform().replace('-', '_').replace('.', '_')
+    return '%s-%s-%s' % (python_tag, abi_tag, platform_tag)
+
+
+def write_wheel(output_dir, dist_name, version, files):
+    '''
+    Writes a wheel with a `dist_name` package with the given files and a
+    `CACHE_DIR` attribute pointing to the directory with the files.
+
+    :return pathlib.Path:
+        The path to the wheel.
+    '''
+    import base64
+    import hashlib
+    import zipfile
+
+    tag = _get_wheel_tag()
+    dist_info = '%s-%s.dist-info' % (dist_name, version)
+    contents = [('%s/__init__.py' % (dist_name,), _CACHE_PACKAGE_INIT.encode('utf-8'))]
+    for path in files:
+        contents.append(('%s/%s' % (dist_name, path.name), path.read_bytes()))
+    contents.append(('%s/METADATA' % (dist_info,), (
+        'Metadata-Version: 2.1\nName: %s\nVersion: %s\nSummary: Modules compiled by cython_jit.\n' % (
+            dist_name, version)).encode('utf-8')))
+    contents.append(('%s/WHEEL' % (dist_info,), (
+        'Wheel-Version: 1.0\nGenerator: cython_jit\nRoot-Is-Purelib: false\nTag: %s\n' % (tag,)).encode('utf-8')))
+
+    record_lines = []
+    for name, data in contents:
+        digest = base64.urlsafe_b64encode(hashlib.sha256(data).digest()).rstrip(b'=').decode('ascii')
+        record_lines.append('%s,sha256=%s,%s' % (name, digest, len(data)))
+    record_lines.append('%s/RECORD,,' % (dist_info,))
+    contents.append(('%s/RECORD' % (dist_info,), ('\n'.join(record_lines) + '\n').encode('utf-8')))
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    wheel_path = output_dir / ('%s-%s-%s.whl' % (dist_name, version, tag))
+    with zipfile.ZipFile(str(wheel_path), 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for name, data in contents:
+            zip_file.writestr(name, data)
+    return wheel_path
+
+
+def write_tarball(output_dir, dist_name, version, files):
+    '''
+    :return pathlib.Path:
+        The path to a .tar.gz with the given files (to be extracted to the
+        cache dir).
+    '''
+    import tarfile
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    tar_path = output_dir / ('%s-%s-%s.tar.gz' % (dist_name, version, _get_wheel_tag()))
+    with tarfile.open(str(tar_path), 'w:gz') as tar:
+        for path in files:
+            tar.add(str(path), arcname=path.name)
+    return tar_path
+
+
+def build(package_dir, output_dir, type_profile=None, output_format='wheel', version='0.0.0', build_dir=None,
+          silent=False, debug=False, jobs=None, backend=None, profile=None):
+    '''
+    Compiles the jitted functions of a package and creates a wheel or a
+    tarball with the compiled modules.
+
+    :param pathlib.Path package_dir:
+    :param pathlib.Path output_dir:
+    :param dict type_profile:
+        The merged type profiles (see: `_type_profiles.load_type_profiles`).
+    :param str output_format:
+        'wheel' or 'tar'.
+    :param pathlib.Path build_dir:
+        The directory where the modules are compiled (if None, a temporary
+        directory is used).
+
+    :return tuple(pathlib.Path|NoneType, dict(str, str), list(dict)):
+        The created file (None if there was nothing to compile), the errors
+        for the modules which failed to compile and the stale functions in
+        the type profile.
+    '''
+    import shutil
+    import tempfile
+    from pathlib import Path
+    import cython_jit
+    from cython_jit._jit_state_info import _get_jit_state_info
+    from cython_jit._jit_state_info import build_compile_jobs
+    from cython_jit._jit_state_info import get_artifact_files
+    from cython_jit._jit_state_info import _get_manifest_entry
+    from cython_jit._manifest import get_manifest_path
+    from cython_jit._manifest import write_manifest
+
+    if output_format not in ('wheel', 'tar'):
+        raise AssertionError('Unexpected output format: %s (expected wheel or tar).' % (output_format,))
+
+    collectors, stale = create_package_collectors(package_dir, type_profile)
+    compile_jobs = _get_jit_state_info()._create_compile_jobs(
+        debug=debug, backend=backend, profile=profile, collectors=collectors)
+    if not compile_jobs:
+        return None, {}, stale
+
+    remove_build_dir = build_dir is None
+    if build_dir is None:
+        build_dir = Path(tempfile.mkdtemp(prefix='cython_jit_build_'))
+    try:
+        pyd_name_to_error = build_compile_jobs(
+            compile_jobs, cython_jit.get_temp_dir(), build_dir, silent=silent, debug=debug, jobs=jobs,
+            backend=backend)
+
+        files = []
+        pyd_name_to_entry = {}
+        for compile_job in compile_jobs:
+            if compile_job.pyd_name not in pyd_name_to_error:
+                files.extend(get_artifact_files(compile_job, build_dir))
+                pyd_name_to_entry[compile_job.pyd_name] = _get_manifest_entry(compile_job)
+
+        dist_name = '%s_cyjit' % (package_dir.name.replace('-', '_'),)
+        write = write_wheel if output_format == 'wheel' else write_tarball
+        # The build dir may have other modules, so, only the packaged ones go to the manifest.
+        manifest_dir = Path(tempfile.mkdtemp(prefix='cython_jit_manifest_'))
+        try:
+            if pyd_name_to_entry:
+                write_manifest(manifest_dir, pyd_name_to_entry)
+                files.append(get_manifest_path(manifest_dir))
+            return write(output_dir, dist_name, version, files), pyd_name_to_error, stale
+        finally:
+            shutil.rmtree(str(manifest_dir), ignore_errors=True)
+    finally:
+        if remove_build_dir:
+            shutil.rmtree(str(build_dir), ignore_errors=True)
@@ -0,0 +1,288 @@
+'''
+Management of the cache dir (the compiled modules) and the temp dir (the
+intermediate files used to build them).
+
+The last use of a module is the modification time of its file (it's updated
+when the module is loaded), so, the least recently used modules are evicted
+first when the cache is pruned.
+
+i.e.:
+    python -m cython_jit cache stats
+    python -m cython_jit cache prune --max-size 500M --max-age 30d
+    python -m cython_jit cache clear
+'''
+from collections import namedtuple
+
+# modules: the number of compiled modules in the cache dir.
+# size: the size (in bytes) of the compiled modules.
+# latest_modules: the number of modules referenced by the manifest.
+# temp_size: the size (in bytes) of the files in the temp dir.
+CacheStats = namedtuple('CacheStats', 'modules, size, latest_modules, temp_size')
+
+# Staging dirs older than this are from builds which were interrupted.
+_STALE_STAGING_SECONDS = 60 * 60
+
+# Kept in the temp dir of a module (profile data is needed to build it again).
+_PGO_DIR_NAME = 'pgo'
+
+
+def touch_module(path):
+    '''
+    Marks the given compiled module as used now (errors are ignored, i.e.:
+    the cache dir may be read-only).
+    '''
+    import os
+    try:
+        os.utime(str(path))
+    except OSError:
+        pass
+
+
+def _get_size(path):
+    '''
+    :return int:
+        The size of the given file or of all the files in the given dir.
+    '''
+    import os
+    try:
+        if not path.is_dir():
+            return path.stat().st_size
+    except OSError:
+        return 0
+
+    size = 0
+    for dirpath, _dirnames, filenames in os.walk(str(path)):
+        for filename in filenames:
+            try:
+                size += os.stat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def _iter_modules(cache_dir):
+    '''
+    :return iterator(tuple(str, pathlib.Path)):
+        The module name and the path of the compiled modules in the cache dir.
+    '''
+    from cython_jit._manifest import _get_artifact_module_name
+    if not cache_dir.is_dir():
+        return
+    for path in cache_dir.iterdir():
+        if path.suffix != '.pgo':
+            module_name = _get_artifact_module_name(path)
+            if module_name is not None:
+                yield module_name, path
+
+
+def get_cache_stats(cache_dir, temp_dir):
+    '''
+    :return CacheStats:
+    '''
+    from cython_jit._manifest import read_manifest
+
+    modules = 0
+    size = 0
+    for _module_name, path in _iter_modules(cache_dir):
+        modules += 1
+        size += _get_size(path)
+
+    temp_size = _get_size(temp_dir) if temp_dir.is_dir() else 0
+    return CacheStats(modules, size, len(read_manifest(cache_dir)), temp_size)
+
+
+def remove_build_intermediates(module_temp_dir):
+    '''
+    Removes the files used to build a module (.pyx, .c, .o, setup_cython.py,
+    ...) after it was built (the pgo profile data is kept).
+    '''
+    import shutil
+    if not module_temp_dir.is_dir():
+        return
+
+    for path in module_temp_dir.iterdir():
+        if path.name == _PGO_DIR_NAME:
+            continue
+        if path.is_dir():
+            shutil.rmtree(str(path), ignore_errors=True)
+        else:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    try:
+        module_temp_dir.rmdir()  # Only removed if empty.
+    except OSError:
+        pass
+
+
+def prune_cache(cache_dir, temp_dir=None, max_size=None, max_age=None):
+    '''
+    Removes from the cache dir:
+
+    - the modules not used for more than `max_age` seconds;
+    - the least recently used modules until the size of the cache is at most
+      `max_size` bytes;
+    - the files in the temp dir of modules no longer in the cache and
+      interrupted builds.
+
+    Modules replaced by newer versions are evicted just like the others (they
+    are kept while within the limits so that they're reused if the same
+    contents are compiled again -- see: `remove_unused_artifacts` to remove
+    all of them).
+
+    Modules loaded by live processes or being built are always kept.
+
+    :return list(pathlib.Path):
+        The files and dirs removed.
+    '''
+    import shutil
+    import time
+    from cython_jit._file_lock import LOCKS_DIR_NAME
+    from cython_jit._file_lock import get_leased_module_names
+    from cython_jit._file_lock import get_module_lock
+    from cython_jit._file_lock import remove_lock_file
+    from cython_jit._manifest import get_manifest_lock
+    from cython_jit._manifest import read_manifest
+    from cython_jit._manifest import write_manifest
+
+    removed = []
+    if not cache_dir.is_dir():
+        return removed
+
+    now = time.time()
+    with get_manifest_lock(cache_dir):
+        entries = read_manifest(cache_dir)
+        module_name_to_pyd_name = dict((entry.module_name, pyd_name) for pyd_name, entry in entries.items())
+        leased = get_leased_module_names(cache_dir)
+
+        modules = []
+        for module_name, path in _iter_modules(cache_dir):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            modules.append((stat.st_mtime, stat.st_size, module_name, path))
+        modules.sort(key=lambda module: module[0])  # Least recently used first.
+
+        size = sum(module[1] for module in modules)
+        removed_pyd_names = set()
+        for last_use, module_size, module_name, path in modules:
+            expired = max_age is not None and now - last_use > max_age
+            over_budget = max_size is not None and size > max_size
+            if not expired and not over_budget:
+                continue
+            if module_name in leased:
+                continue
+
+            module_lock = get_module_lock(cache_dir, module_name)
+            if not module_lock.acquire(blocking=False):
+                continue  # Being built (or loaded) right now.
+            try:
+                if module_name in get_leased_module_names(cache_dir):
+                    continue  # Loaded after the leases were read.
+                for module_path in (path, path.with_name(module_name + '.pgo')):
+                    try:
+                        module_path.unlink()
+                    except OSError:
+                        if module_path == path and module_path.exists():
+                            break  # i.e.: still loaded by some process on windows.
+                    else:
+                        removed.append(module_path)
+                else:
+                    if module_name in module_name_to_pyd_name:
+                        removed_pyd_names.add(module_name_to_pyd_name[module_name])
+                    size -= module_size
+            finally:
+                module_lock.release()
+
+        if removed_pyd_names:
+            write_manifest(cache_dir, dict(
+                (pyd_name, entry) for pyd_name, entry in entries.items() if pyd_name not in removed_pyd_names))
+
+        module_names = set(module_name for module_name, _path in _iter_modules(cache_dir))
+        if temp_dir is not None and temp_dir.is_dir():
+            for module_temp_dir in temp_dir.iterdir():
+                module_name = module_temp_dir.name
+                if '_cyjit' not in module_name or module_name in module_names or not module_temp_dir.is_dir():
+                    continue
+                module_lock = get_module_lock(cache_dir, module_name)
+                if not module_lock.acquire(blocking=False):
+                    continue  # Being built right now.
+                try:
+                    shutil.rmtree(str(module_temp_dir), ignore_errors=True)
+                    removed.append(module_temp_dir)
+                finally:
+                    module_lock.release()
+
+        # The pgo markers of modules no longer in the cache.
+        for pgo_marker_path in cache_dir.glob('*_cyjit*.pgo'):
+            module_name = pgo_marker_path.stem
+            if module_name in module_names:
+                continue
+            module_lock = get_module_lock(cache_dir, module_name)
+            if not module_lock.acquire(blocking=False):
+                continue  # Being built right now.
+            try:
+                pgo_marker_path.unlink()
+            except OSError:
+                pass
+            else:
+                removed.append(pgo_marker_path)
+            finally:
+                module_lock.release()
+
+        locks_dir = cache_dir / LOCKS_DIR_NAME
+        if locks_dir.is_dir():
+            for lock_path in locks_dir.glob('*.lock'):
+                if lock_path.stem not in module_names:
+                    remove_lock_file(lock_path)
+
+    for staging_dir in cache_dir.glob('.staging_*'):
+        try:
+            if now - staging_dir.stat().st_mtime > _STALE_STAGING_SECONDS:
+                shutil.rmtree(str(staging_dir), ignore_errors=True)
+                removed.append(staging_dir)
+        except OSError:
+            pass
+    return removed
+
+
+def clear_cache(cache_dir, temp_dir=None):
+    '''
+    Removes all the modules from the cache dir (but the ones loaded by live
+    processes or being built) and their files in the temp dir.
+
+    :return list(pathlib.Path):
+        The files and dirs removed.
+    '''
+    return prune_cache(cache_dir, temp_dir, max_size=0)
+
+
+def parse_size(size):
+    '''
+    :param str size:
+        A size in bytes, optionally with a K, M, G or T suffix (i.e.: 500M).
+
+    :return int:
+    '''
+    multipliers = dict(K=1024, M=1024 ** 2, G=1024 ** 3, T=1024 ** 4)
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in multipliers:
+        return int(float(size[:-1]) * multipliers[size[-1]])
+    return int(size)
+
+
+def parse_age(age):
+    '''
+    :param str age:
+        An age in seconds, optionally with a s, m, h or d suffix (i.e.: 30d).
+
+    :return float:
+    '''
+    multipliers = dict(s=1, m=60, h=60 * 60, d=24 * 60 * 60)
+    age = age.strip().lower()
+    if age and age[-1] in multipliers:
+        return float(age[:-1]) * multipliers[age[-1]]
+    return float(age)
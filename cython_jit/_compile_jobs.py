@@ -0,0 +1,81 @@
+'''
+Compiles (in a separate process) the jobs created by `_JitStateInfo`.
+
+i.e.: python -m cython_jit._compile_jobs <jobs_file.json>
+'''
+import sys
+
+
+def start_compile_process(compile_jobs, temp_dir, target_dir, compile_options):
+    '''
+    Starts a process (in a new session, so, it's not killed when the current
+    process exits) which compiles the given jobs.
+
+    :return subprocess.Popen
+    '''
+    import json
+    import os
+    import subprocess
+    import tempfile
+    from pathlib import Path
+
+    fd, jobs_file = tempfile.mkstemp(suffix='.json', prefix='compile_jobs_', dir=str(temp_dir))
+    with os.fdopen(fd, 'w') as stream:
+        json.dump(dict(
+            compile_jobs=[list(compile_job) for compile_job in compile_jobs],
+            temp_dir=str(temp_dir),
+            target_dir=str(target_dir),
+            compile_options=compile_options,
+        ), stream)
+
+    # Make sure that cython_jit can be imported in the new process.
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(
+        [str(Path(__file__).absolute().parent.parent)] + [x for x in [env.get('PYTHONPATH')] if x])
+
+    kwargs = {}
+    if sys.platform == 'win32':
+        kwargs['creationflags'] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs['start_new_session'] = True
+
+    return subprocess.Popen(
+        [sys.executable, '-m', 'cython_jit._compile_jobs', jobs_file],
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        **kwargs
+    )
+
+
+def main(jobs_file):
+    import json
+    import os
+    from pathlib import Path
+    from cython_jit._jit_state_info import _CompileJob
+    from cython_jit._jit_state_info import build_compile_jobs
+    from cython_jit.compile_with_cython import CompileProfile
+
+    with open(jobs_file) as stream:
+        contents = json.load(stream)
+    os.remove(jobs_file)
+
+    compile_jobs = []
+    for compile_job in contents['compile_jobs']:
+        compile_job = _CompileJob(*compile_job)
+        compile_jobs.append(compile_job._replace(profile=CompileProfile(*compile_job.profile)))
+
+    pyd_name_to_error = build_compile_jobs(
+        compile_jobs,
+        Path(contents['temp_dir']),
+        Path(contents['target_dir']),
+        **contents['compile_options']
+    )
+    for pyd_name, error in sorted(pyd_name_to_error.items()):
+        sys.stderr.write('Error compiling: %s (%s)\n' % (pyd_name, error))
+    return 1 if pyd_name_to_error else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1]))
@@ -0,0 +1,205 @@
+'''
+Inter-process locks on files (so that many processes may share the same cache
+dir) and the leases which record which modules each process loaded from a
+cache dir (so that they are not removed while in use).
+'''
+import sys
+
+LOCKS_DIR_NAME = 'locks'
+LEASES_DIR_NAME = 'leases'
+
+
+class FileLock(object):
+    '''
+    An exclusive lock on a file (fcntl.flock on posix and msvcrt.locking on
+    windows). The lock is released when the process exits (even if it's
+    killed).
+
+    i.e.:
+        with FileLock(path):
+            ...
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._stream = None
+
+    def acquire(self, blocking=True):
+        '''
+        :return bool:
+            Whether the lock was acquired (always True if blocking).
+        '''
+        import time
+        assert self._stream is None, 'Lock already acquired: %s' % (self.path,)
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        while True:
+            stream = open(str(self.path), 'a+b')
+            try:
+                if _try_lock(stream):
+                    if _is_same_file(stream, self.path):
+                        self._stream = stream
+                        return True
+                    # The file was removed (see: `remove_lock_file`) after we opened it.
+                    _unlock(stream)
+                elif not blocking:
+                    stream.close()
+                    return False
+                else:
+                    time.sleep(.05)
+            except BaseException:
+                stream.close()
+                raise
+            stream.close()
+
+    def release(self):
+        stream = self._stream
+        self._stream = None
+        if stream is not None:
+            _unlock(stream)
+            stream.close()
+
+    @property
+    def locked(self):
+        return self._stream is not None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.release()
+
+
+def remove_lock_file(path):
+    '''
+    Removes the given lock file (if it's not locked).
+
+    :return bool:
+        Whether it was removed.
+    '''
+    lock = FileLock(path)
+    if not lock.acquire(blocking=False):
+        return False
+    try:
+        path.unlink()
+    except OSError:
+        return False  # i.e.: files which are open can't be removed on windows.
+    finally:
+        lock.release()
+    return True
+
+
+def _is_same_file(stream, path):
+    import os
+    if sys.platform == 'win32':
+        return True  # Files which are open can't be removed on windows.
+    try:
+        stat = os.stat(str(path))
+    except OSError:
+        return False
+    fstat = os.fstat(stream.fileno())
+    return (stat.st_dev, stat.st_ino) == (fstat.st_dev, fstat.st_ino)
+
+
+def _try_lock(stream):
+    if sys.platform == 'win32':
+        import msvcrt
+        stream.seek(0)
+        try:
+            msvcrt.locking(stream.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+
+    import fcntl
+    try:
+        fcntl.flock(stream.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def _unlock(stream):
+    if sys.platform == 'win32':
+        import msvcrt
+        stream.seek(0)
+        msvcrt.locking(stream.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(stream.fileno(), fcntl.LOCK_UN)
+
+
+def get_module_lock(cache_dir, module_name):
+    '''
+    :return FileLock:
+        The lock held while the given module is built (or removed).
+    '''
+    return FileLock(cache_dir / LOCKS_DIR_NAME / (module_name + '.lock'))
+
+
+class ProcessLease(object):
+    '''
+    Records the modules loaded by this process from a cache dir.
+
+    The lease is a `<id>.modules` file with the loaded module names and a
+    `<id>.lock` file which is locked while the process is alive (so, a lease
+    whose lock can be acquired was left by a process which already exited).
+    '''
+
+    def __init__(self, cache_dir):
+        import os
+        import uuid
+        lease_id = '%s_%s' % (os.getpid(), uuid.uuid4().hex[:8])
+        leases_dir = cache_dir / LEASES_DIR_NAME
+        self._lock = FileLock(leases_dir / (lease_id + '.lock'))
+        self._modules_path = leases_dir / (lease_id + '.modules')
+        self._module_names = set()
+
+    def add(self, module_name):
+        '''
+        Records that the given module is in use (errors are ignored, i.e.: the
+        cache dir may be read-only, in which case its modules can't be
+        removed by other processes either).
+        '''
+        if module_name in self._module_names:
+            return
+        try:
+            if not self._lock.locked:
+                self._lock.acquire()
+            with self._modules_path.open('a') as stream:
+                stream.write(module_name + '\n')
+        except OSError:
+            return
+        self._module_names.add(module_name)
+
+
+def get_leased_module_names(cache_dir):
+    '''
+    :return set(str):
+        The names of the modules loaded by live processes from the given cache
+        dir (leases from processes which already exited are removed).
+    '''
+    leased = set()
+    leases_dir = cache_dir / LEASES_DIR_NAME
+    if not leases_dir.is_dir():
+        return leased
+
+    for modules_path in leases_dir.glob('*.modules'):
+        lock = FileLock(modules_path.with_suffix('.lock'))
+        if lock.acquire(blocking=False):
+            # The process which created the lease exited.
+            lock.release()
+            for path in (modules_path, lock.path):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+            continue
+
+        try:
+            with modules_path.open() as stream:
+                leased.update(line.strip() for line in stream if line.strip())
+        except OSError:
+            pass
+    return leased
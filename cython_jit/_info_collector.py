@@ -1,8 +1,10 @@
 import sys
+from collections import OrderedDict
 from collections import namedtuple
 from contextlib import contextmanager
+import re
 
-from cython_jit import JitStage
+from cython_jit import _COLLECT_STAGES
 
 
 def get_line_indent(line):
@@ -12,10 +14,175 @@ def get_line_indent(line):
 _GeneratedInfo = namedtuple('_GeneratedInfo', 'func_lines, c_import_lines')
 
 
+# The cython directives which may be set for a function in `jit(directives=...)`.
+SUPPORTED_DIRECTIVES = ('boundscheck', 'wraparound', 'cdivision', 'initializedcheck', 'nonecheck')
+
+# numpy dtype name -> cython type used for the items of typed memoryviews.
+_NUMPY_DTYPE_TO_CYTHON_TYPE = {
+    'bool': 'uint8_t',  # Cython accepts bool buffers as uint8_t.
+    'int8': 'int8_t',
+    'int16': 'int16_t',
+    'int32': 'int32_t',
+    'int64': 'int64_t',
+    'uint8': 'uint8_t',
+    'uint16': 'uint16_t',
+    'uint32': 'uint32_t',
+    'uint64': 'uint64_t',
+    'float32': 'float',
+    'float64': 'double',
+    'complex64': 'float complex',
+    'complex128': 'double complex',
+}
+
+# cython scalar type -> numpy dtype name (used for the arrays of the
+# functions compiled with `jit(vectorize=True)`).
+_CYTHON_TYPE_TO_NUMPY_DTYPE = dict(
+    (cython_type, dtype_name) for dtype_name, cython_type in _NUMPY_DTYPE_TO_CYTHON_TYPE.items()
+    if dtype_name != 'bool')
+_CYTHON_TYPE_TO_NUMPY_DTYPE.update({'bint': 'bool', 'int': 'intc', 'long': 'int_'})
+
+
+# Matches the types which must be cimported from libc.stdint (i.e.: 'int64_t' or 'uint8_t[::1]').
+_STDINT_TYPE_RE = re.compile(r'^u?int(8|16|32|64)_t\b')
+
+
+def _get_memoryview_dims(array):
+    '''
+    :return list(str):
+        The dimensions for a typed memoryview of the given array (declaring
+        the contiguous dimension so that Cython can generate faster indexing).
+        i.e.: ['::1'] for a contiguous 1-D array, [':', '::1'] for a C
+        contiguous 2-D array, ['::1', ':'] for a Fortran contiguous 2-D array
+        and [':', ':'] for a strided 2-D array.
+    '''
+    dims = [':'] * array.ndim
+    if array.flags.c_contiguous:
+        dims[-1] = '::1'
+    elif array.flags.f_contiguous:
+        dims[0] = '::1'
+    return dims
+
+
+class _Repr(object):
+    '''
+    Used to represent values (i.e.: default values in signatures) which are
+    only available as source code.
+    '''
+
+    def __init__(self, s):
+        self._s = s
+
+    def __repr__(self):
+        return self._s
+
+
+_DefArgSources = namedtuple('_DefArgSources', 'arg_name_to_annotation, arg_name_to_default, return_annotation')
+
+
+def get_def_arg_sources(source):
+    '''
+    :param str source:
+        Source starting at (or before) the `def` line of a function (the
+        lines after the signature aren't read).
+
+    :return _DefArgSources:
+        The source of the annotations and defaults of the arguments (only for
+        the arguments which have one) and the source of the return annotation
+        (None if there's none).
+    '''
+    import io
+    import tokenize
+
+    line_offsets = [0]
+    for line in source.splitlines(True):
+        line_offsets.append(line_offsets[-1] + len(line))
+
+    def get_text(start, end):
+        return source[line_offsets[start[0] - 1] + start[1]:line_offsets[end[0] - 1] + end[1]].strip()
+
+    arg_name_to_annotation = {}
+    arg_name_to_default = {}
+    return_annotation = None
+
+    state = 'before_def'
+    depth = 0
+    arg_name = part = part_start = None
+    prev_end = None
+    for token in tokenize.generate_tokens(io.StringIO(source).readline):
+        tok_type, tok_string, tok_start, tok_end, _line = token
+        if state == 'before_def':
+            if tok_type == tokenize.NAME and tok_string == 'def':
+                state = 'before_args'
+
+        elif state == 'before_args':
+            if tok_type == tokenize.OP and tok_string == '(':
+                state = 'args'
+                depth = 1
+
+        elif state == 'args':
+            if tok_type in (tokenize.NL, tokenize.COMMENT):
+                continue
+            if tok_type == tokenize.OP and tok_string in '([{':
+                depth += 1
+            elif tok_type == tokenize.OP and tok_string in ')]}':
+                depth -= 1
+
+            if depth == 0 or (depth == 1 and tok_type == tokenize.OP and tok_string == ','):
+                # The end of an argument.
+                if part is not None:
+                    part[arg_name] = get_text(part_start, prev_end)
+                arg_name = part = None
+                if depth == 0:
+                    state = 'after_args'
+            elif depth == 1 and tok_type == tokenize.OP and arg_name is not None and (
+                    (tok_string == ':' and part is None) or (tok_string == '=' and part is not arg_name_to_default)):
+                # i.e.: the ':' of a lambda in a default isn't an annotation.
+                if part is not None:
+                    part[arg_name] = get_text(part_start, prev_end)
+                part = arg_name_to_annotation if tok_string == ':' else arg_name_to_default
+                part_start = tok_end
+            elif depth == 1 and tok_type == tokenize.NAME and arg_name is None:
+                arg_name = tok_string
+
+        elif state == 'after_args':
+            if tok_type == tokenize.OP and tok_string == '->':
+                part_start = tok_end
+                state = 'return_annotation'
+            else:
+                break
+
+        elif state == 'return_annotation':
+            if tok_type == tokenize.OP and tok_string in '([{':
+                depth += 1
+            elif tok_type == tokenize.OP and tok_string in ')]}':
+                depth -= 1
+            elif depth == 0 and tok_type == tokenize.OP and tok_string == ':':
+                return_annotation = get_text(part_start, prev_end)
+                break
+
+        prev_end = tok_end
+
+    return _DefArgSources(arg_name_to_annotation, arg_name_to_default, return_annotation)
+
+
 class InfoNotCollectedError(RuntimeError):
     pass
 
 
+class _CollectedSignature(object):
+
+    def __init__(self, arg_name_to_arg_type, return_type):
+        self.arg_name_to_arg_type = arg_name_to_arg_type
+        self.return_type = return_type
+
+        # arg name -> set(str) with the expressions which check whether the
+        # value of the argument matches this signature.
+        self.arg_name_to_checks = {}
+
+        # The number of calls (collected) with this signature.
+        self.count = 0
+
+
 def fix_cython_ifdefs(func_lines):
     state = 'regular'
     new_contents = []
@@ -61,34 +228,121 @@ class CythonJitInfoCollector(object):
 
     RETURN_NOT_COLLECTED = 'RETURN_NOT_COLLECTED'
 
-    def __init__(self, func, nogil, jit_stage):
+    # After the same types are seen in this number of consecutive calls the
+    # information is no longer collected.
+    DEFAULT_STABLE_AFTER = 100
+
+    # The maximum number of signatures compiled for a function (calls with
+    # other signatures use the first signature seen).
+    DEFAULT_MAX_SIGNATURES = 4
+
+    # Functions called by other jitted functions are declared as `cdef inline`
+    # if their body has at most this number of lines (and `inline` isn't
+    # given).
+    MAX_AUTO_INLINE_LINES = 3
+
+    def __init__(self, func, nogil, jit_stage, stable_after=None, max_signatures=None, directives=None,
+                 aggressive=False, profile=None, infer_locals=False, parallel=False, num_threads=None,
+                 vectorize=False, inline=None, register=True):
         import hashlib
         import inspect
         from cython_jit._jit_state_info import _get_jit_state_info
         self._c_imports = set()
 
-        all_collectors = _get_jit_state_info().all_collectors
-        assert func.__name__ not in all_collectors, 'There is already a function named: %s from file: %s' % (
-            func.__name__, func.__code__.co_filename)
+        if register:
+            all_collectors = _get_jit_state_info().all_collectors
+            assert func.__name__ not in all_collectors, 'There is already a function named: %s from file: %s' % (
+                func.__name__, func.__code__.co_filename)
 
         self._func = func
         self._nogil = nogil
-        self._arg_name_to_arg_type = {}
+        self._directives = dict(directives or {})
+        self._aggressive = aggressive
+        self._profile = profile
+        self._infer_locals = infer_locals
+        self._parallel = parallel
+        self._num_threads = num_threads
+        if parallel and not nogil:
+            raise AssertionError('parallel=True may only be used with nogil=True (in: %s).' % (func.__name__,))
+        self._vectorize = vectorize
+        self._inline = inline
+        for directive in self._directives:
+            if directive not in SUPPORTED_DIRECTIVES:
+                raise AssertionError('Unsupported directive: %s (expected one of: %s).' % (
+                    directive, ', '.join(SUPPORTED_DIRECTIVES)))
+
+        if register:
+            all_collectors[func.__name__] = self
+
+        # The options passed to `jit()` (saved in type profiles).
+        self._jit_options = dict(
+            nogil=nogil, stable_after=stable_after, max_signatures=max_signatures, directives=directives,
+            aggressive=aggressive, profile=profile, infer_locals=infer_locals, parallel=parallel,
+            num_threads=num_threads, vectorize=vectorize, inline=inline)
 
-        all_collectors[func.__name__] = self
         m = hashlib.sha256()
         m.update(func.__code__.co_code)
         self._sig = inspect.signature(func)
         m.update(str(self._sig).encode('utf-8'))
         if nogil:
             m.update(b'noexcept nogil')
+        if self._directives or aggressive:
+            m.update(repr((sorted(self._directives.items()), aggressive)).encode('utf-8'))
+        if infer_locals:
+            m.update(b'infer_locals')
+        if parallel:
+            m.update(('parallel %s' % (num_threads,)).encode('utf-8'))
+        if vectorize:
+            m.update(b'vectorize')
+        if inline is not None:
+            m.update(('inline %s' % (inline,)).encode('utf-8'))
         key = m.hexdigest()
 
         # If the key is not the same the function must be recompiled.
         self._key = key
         self._jit_stage = jit_stage
 
-        if jit_stage in (JitStage.collect_info_and_compile_at_exit, JitStage.collect_info):
+        # Computed upfront as Signature.bind() is slow (used when only
+        # positional arguments are passed).
+        self._positional_arg_names = None
+        if all(param.kind in (param.POSITIONAL_ONLY, param.POSITIONAL_OR_KEYWORD)
+               for param in self._sig.parameters.values()):
+            self._positional_arg_names = tuple(self._sig.parameters)
+        if vectorize and self._positional_arg_names is None:
+            raise AssertionError('vectorize=True may only be used in functions with positional arguments (in: %s).' % (
+                func.__name__,))
+        self._annotated_arg_names = frozenset(
+            arg_name for arg_name, param in self._sig.parameters.items() if isinstance(param.annotation, str))
+
+        self._type_key_to_translated_type = {}
+        self._stable_after = self.DEFAULT_STABLE_AFTER if stable_after is None else stable_after
+        self._last_arg_types = ()
+        self._last_arg_checks = ()
+        self._last_signature = None
+        self._stable_count = 0
+        self._collection_done = False
+
+        # The distinct signatures seen (the first one is the primary signature
+        # which is compiled with the function name).
+        self._max_signatures = self.DEFAULT_MAX_SIGNATURES if max_signatures is None else max_signatures
+        if vectorize:
+            # The arrays are converted to the types of the primary signature.
+            self._max_signatures = 1
+        self._arg_types_to_signature = OrderedDict()
+
+        # The arg types of the calls to other jitted functions (of the same
+        # module) seen for each signature of this function:
+        # {(arg_types, callee_name): set(callee_arg_types)}
+        self._callee_arg_types = {}
+        self._called_from_jitted = False
+
+        # Used in the JitStage.collect_info_and_compile_in_background stage.
+        self.compiled_func = None
+        self.compile_scheduled = False
+        self.background_calls = 0
+        self.background_first_call_time = None
+
+        if jit_stage in _COLLECT_STAGES:
             func_lines = []
             func_first_line = self.func_first_line
             with self.file_stream() as stream:
@@ -111,6 +365,7 @@ class CythonJitInfoCollector(object):
 
             self._last_line = i_line + func_first_line + 1
 
+            self._raw_func_lines = tuple(func_lines)
             func_lines = fix_cython_ifdefs(func_lines)
             assert func_lines
 
@@ -137,8 +392,16 @@ class CythonJitInfoCollector(object):
     def get_pyd_name(self):
         return self.func.__module__.replace('.', '_') + '_cyjit' + ''.join(str(x) for x in sys.version_info[:2])
 
+    def get_function_pyd_name(self):
+        '''
+        :return str:
+            The name used when the function is compiled in its own module
+            (see: `cython_jit.set_build_mode`).
+        '''
+        return '%s__%s' % (self.get_pyd_name(), self.func.__name__)
+
     def _check_jit_stage_collect(self):
-        if self._jit_stage not in (JitStage.collect_info_and_compile_at_exit, JitStage.collect_info):
+        if self._jit_stage not in _COLLECT_STAGES:
             raise AssertionError('Should only be called at collect time.')
 
     def generate(self):
@@ -155,11 +418,19 @@ class CythonJitInfoCollector(object):
         assert def_line.startswith('def '), \
             'Expected line: %s to start with def.' % (def_line,)
 
-        generated_func_lines.extend(self.get_wrapper_func_lines())
-        generated_func_lines.append(self.get_def_line())
-        generated_func_lines.extend((x.rstrip() for x in self.func_lines[1:]))
+        if self._vectorize:
+            generated_func_lines.extend(self.get_vectorized_func_lines())
+        else:
+            generated_func_lines.extend(self.get_wrapper_func_lines())
+        for signature in self.signatures:
+            generated_func_lines.extend(self.get_directive_lines(signature))
+            generated_func_lines.append(self.get_def_line(signature))
+            generated_func_lines.extend(self.get_local_declaration_lines(signature))
+            generated_func_lines.extend(self.get_body_lines(signature))
 
         generated_c_import_lines.update(self.get_c_import_lines())
+        if any('_cyjit_numpy' in line for line in generated_func_lines):
+            generated_c_import_lines.add('import numpy as _cyjit_numpy')
         return _GeneratedInfo(generated_func_lines, generated_c_import_lines)
 
     @property
@@ -180,60 +451,384 @@ class CythonJitInfoCollector(object):
     def nogil(self):
         return self._nogil
 
+    @property
+    def parallel(self):
+        return self._parallel
+
+    @property
+    def vectorize(self):
+        return self._vectorize
+
     @property
     def key(self):
         return self._key
 
+    @property
+    def profile(self):
+        '''
+        The optimization profile (name or CompileProfile) for the module of
+        this function (None to use the default profile).
+        '''
+        return self._profile
+
+    @property
+    def collection_done(self):
+        '''
+        True if the same types were seen in enough consecutive calls and no
+        more information needs to be collected.
+        '''
+        return self._collection_done
+
+    def bind_arguments(self, args, kwargs):
+        '''
+        :return OrderedDict(str, object):
+            The argument names and the values passed for each one.
+        '''
+        if not kwargs and self._positional_arg_names is not None and len(args) == len(self._positional_arg_names):
+            return OrderedDict(zip(self._positional_arg_names, args))
+        return OrderedDict(self._sig.bind(*args, **kwargs).arguments)
+
     def collect_args(self, args, kwargs):
+        if self._collection_done:
+            return
         self._check_jit_stage_collect()
-        bound_arguments = self._sig.bind(*args, **kwargs)
-        for arg_name, arg_value in bound_arguments.arguments.items():
-            ann = self._sig.parameters[arg_name].annotation
-            if isinstance(ann, str):
+        if not kwargs and self._positional_arg_names is not None and len(args) == len(self._positional_arg_names):
+            arguments = zip(self._positional_arg_names, args)
+        else:
+            arguments = self._sig.bind(*args, **kwargs).arguments.items()
+
+        arg_types = []
+        arg_checks = []
+        for arg_name, arg_value in arguments:
+            if arg_name in self._annotated_arg_names:
                 # Don't collect if it's already annotated.
                 continue
 
-            self._collect_arg(arg_name, arg_value)
-
-    def _collect_arg(self, arg_name, arg_value):
-        self._arg_name_to_arg_type[arg_name] = self._translate_type(arg_name, arg_value)
+            arg_type, arg_check = self._translate_arg(arg_name, arg_value)
+            arg_types.append((arg_name, arg_type))
+            arg_checks.append((arg_name, arg_check))
+        self._last_arg_types = tuple(arg_types)
+        self._last_arg_checks = tuple(arg_checks)
 
     def collect_return(self, ret):
+        if self._collection_done:
+            return
         self._check_jit_stage_collect()
         if self._sig.return_annotation and self._sig.return_annotation != self._sig.empty:
             self._return_type = self._sig.return_annotation
         else:
             self._return_type = self._translate_type('return value', ret)
 
-    def _get_arg_type(self, arg_name):
+        self._collect_signature()
+
+        signature = (self._last_arg_types, self._return_type)
+        if signature == self._last_signature:
+            self._stable_count += 1
+        else:
+            self._last_signature = signature
+            self._stable_count = 1
+
+        if self._stable_after and self._stable_count >= self._stable_after:
+            self._collection_done = True
+
+    def collect_caller(self, caller_code):
+        '''
+        Records that the last call (whose args were collected) was done from
+        the function with the given code. If it's another jitted function of
+        the same module, the call is compiled as a direct C call to the
+        specialization matching the types seen.
+        '''
+        from cython_jit._jit_state_info import _get_jit_state_info
+        caller = _get_jit_state_info().all_collectors.get(caller_code.co_name)
+        if caller is None or caller.func.__code__ is not caller_code:
+            return
+        if caller.func.__module__ != self.func.__module__ or self._vectorize:
+            return
+
+        self._called_from_jitted = True
+        caller._callee_arg_types.setdefault(
+            (caller._last_arg_types, self.func.__name__), set()).add(self._last_arg_types)
+
+    def _collect_signature(self):
+        arg_types = self._last_arg_types
+        signature = self._arg_types_to_signature.get(arg_types)
+        if signature is None:
+            if len(self._arg_types_to_signature) >= max(1, self._max_signatures):
+                return  # Calls with this signature will use the primary signature.
+            signature = self._arg_types_to_signature[arg_types] = _CollectedSignature(
+                dict(arg_types), self._return_type)
+
+        signature.return_type = self._return_type
+        signature.count += 1
+        for arg_name, arg_check in self._last_arg_checks:
+            signature.arg_name_to_checks.setdefault(arg_name, set()).add(arg_check)
+
+    @property
+    def signatures(self):
+        '''
+        :return list(_CollectedSignature):
+            The signatures seen (the first one is the primary signature).
+        '''
+        return list(self._arg_types_to_signature.values())
+
+    def to_type_profile(self):
+        '''
+        :return dict:
+            The information needed to compile this function later on (possibly
+            in another process or machine -- see: `from_type_profile`), with
+            the types seen in each signature (and the number of calls for each
+            one). It may be saved as json.
+        '''
+        import inspect
+
+        def annotation_to_profile(annotation):
+            if annotation is inspect.Parameter.empty:
+                return None
+            if isinstance(annotation, str):
+                return dict(str=annotation)
+            return dict(repr=inspect.formatannotation(annotation))
+
+        parameters = []
+        for param in self._sig.parameters.values():
+            parameters.append(dict(
+                name=param.name,
+                kind=param.kind.name,
+                annotation=annotation_to_profile(param.annotation),
+                default=None if param.default is param.empty else repr(param.default),
+            ))
+
+        jit_options = dict(self._jit_options)
+        if jit_options['profile'] is not None and not isinstance(jit_options['profile'], str):
+            jit_options['profile'] = list(jit_options['profile'])
+
+        return dict(
+            key=self.key,
+            module=self.func.__module__,
+            name=self.func.__name__,
+            filename=self.func.__code__.co_filename,
+            first_line=self.func_first_line,
+            parameters=parameters,
+            return_annotation=annotation_to_profile(self._sig.return_annotation),
+            jit_options=jit_options,
+            c_imports=sorted(self._c_imports),
+            signatures=[dict(
+                arg_types=[[arg_name, arg_type] for arg_name, arg_type in arg_types],
+                return_type=signature.return_type,
+                checks=dict((arg_name, sorted(checks)) for arg_name, checks in signature.arg_name_to_checks.items()),
+                count=signature.count,
+            ) for arg_types, signature in self._arg_types_to_signature.items()],
+        )
+
+    @classmethod
+    def from_type_profile(cls, func_profile, code):
+        '''
+        Creates a collector (which isn't registered in the jit state) with the
+        information saved in `to_type_profile` (so that the function may be
+        compiled without importing its module).
+
+        :param dict func_profile:
+            The information from `to_type_profile`.
+
+        :param code code:
+            The code of the function (compiled from its current source).
+
+        :note: the `key` of the returned collector is computed from the given
+            code, so, if it doesn't match the key in `func_profile` the
+            function changed and the types in the profile may not be valid.
+        '''
+        import inspect
+        import types
+        from cython_jit import JitStage
+        from cython_jit.compile_with_cython import CompileProfile
+
+        def annotation_from_profile(annotation):
+            if annotation is None:
+                return inspect.Parameter.empty
+            if 'str' in annotation:
+                return annotation['str']
+            return _Repr(annotation['repr'])
+
+        parameters = []
+        for param in func_profile['parameters']:
+            parameters.append(inspect.Parameter(
+                param['name'],
+                getattr(inspect.Parameter, param['kind']),
+                default=inspect.Parameter.empty if param['default'] is None else _Repr(param['default']),
+                annotation=annotation_from_profile(param['annotation']),
+            ))
+
+        func = types.FunctionType(code, {'__name__': func_profile['module']}, func_profile['name'])
+        func.__signature__ = inspect.Signature(
+            parameters, return_annotation=annotation_from_profile(func_profile['return_annotation']))
+
+        jit_options = dict(func_profile['jit_options'])
+        if isinstance(jit_options['profile'], list):
+            jit_options['profile'] = CompileProfile(*jit_options['profile'])
+        jit_options = dict(jit_options)
+        jit_options.setdefault('nogil', False)  # i.e.: not given in `@jit()`.
+        collector = cls(func, jit_stage=JitStage.collect_info, register=False, **jit_options)
+
+        collector._c_imports.update(func_profile['c_imports'])
+        for signature_profile in func_profile['signatures']:
+            arg_types = tuple(tuple(x) for x in signature_profile['arg_types'])
+            signature = _CollectedSignature(dict(arg_types), signature_profile['return_type'])
+            signature.count = signature_profile['count']
+            for arg_name, checks in signature_profile['checks'].items():
+                signature.arg_name_to_checks[arg_name] = set(checks)
+            collector._arg_types_to_signature[arg_types] = signature
+
+        signatures = collector.signatures
+        if signatures:
+            collector._return_type = signatures[0].return_type
+        collector._collection_done = True
+        return collector
+
+    @classmethod
+    def from_annotations(cls, func, jit_options):
+        '''
+        :param dict jit_options:
+            The options passed to `jit()`.
+
+        :return CythonJitInfoCollector|NoneType:
+            A collector (which isn't registered in the jit state) for a
+            function with string annotations (cython types) for all the
+            arguments and the return or None if some annotation is missing.
+        '''
+        import inspect
+        from cython_jit import JitStage
+
+        sig = inspect.signature(func)
+        if not isinstance(sig.return_annotation, str) or \
+                not all(isinstance(param.annotation, str) for param in sig.parameters.values()):
+            return None
+
+        jit_options = dict(jit_options)
+        jit_options.setdefault('nogil', False)  # i.e.: not given in `@jit()`.
+        collector = cls(func, jit_stage=JitStage.collect_info, register=False, **jit_options)
+        # Annotated arguments are not collected (so, the signature has no arg types).
+        collector._arg_types_to_signature[()] = _CollectedSignature({}, sig.return_annotation)
+        collector._return_type = sig.return_annotation
+        collector._collection_done = True
+        return collector
+
+    def _get_arg_type(self, arg_name, signature=None):
         ann = self._sig.parameters[arg_name].annotation
         if isinstance(ann, str):
             return ann
-        return self._arg_name_to_arg_type[arg_name]
+        if signature is None:
+            signature = self.signatures[0]
+        return signature.arg_name_to_arg_type[arg_name]
+
+    def _get_specialization_name(self, signature):
+        i = self.signatures.index(signature)
+        if i == 0:
+            return self.func.__name__
+        return '%s__cyjit_%d' % (self.func.__name__, i)
+
+    def _get_callee_specialization_names(self, signature):
+        '''
+        :return dict(str, str):
+            The name of the jitted functions (of the same module) called in the
+            given signature mapped to the name of the specialization which
+            should be called (only when it's not the primary one).
+        '''
+        from cython_jit._jit_state_info import _get_jit_state_info
+        all_collectors = _get_jit_state_info().all_collectors
+
+        arg_types = None
+        for signature_arg_types, collected_signature in self._arg_types_to_signature.items():
+            if collected_signature is signature:
+                arg_types = signature_arg_types
+                break
+
+        ret = {}
+        for (caller_arg_types, callee_name), callee_arg_types in self._callee_arg_types.items():
+            callee = all_collectors.get(callee_name)
+            if caller_arg_types != arg_types or callee is None or not callee.collected_info():
+                continue
+            callee_signatures = callee.signatures
+            names = set()
+            for types in callee_arg_types:
+                callee_signature = callee._arg_types_to_signature.get(types)
+                if callee_signature is None:
+                    callee_signature = callee_signatures[0]  # Calls with other types use the primary one.
+                names.add(callee._get_specialization_name(callee_signature))
+            if len(names) == 1:
+                name = names.pop()
+                if name != callee_name:
+                    ret[callee_name] = name
+        return ret
 
-    def get_def_line(self):
+    def is_inline(self):
+        '''
+        :return bool:
+            Whether the function should be declared as `cdef inline` (if
+            `inline` wasn't given, small functions called from other jitted
+            functions are inlined).
+        '''
+        if self._inline is not None:
+            return bool(self._inline)
+        if not self._called_from_jitted:
+            return False
+        body_lines = [line for line in self.func_lines[1:] if line.strip() and not line.strip().startswith('#')]
+        return len(body_lines) <= self.MAX_AUTO_INLINE_LINES
+
+    def get_def_line(self, signature=None):
         self._check_jit_stage_collect()
+        if signature is None:
+            signature = self.signatures[0]
         args = []
         for arg in self._sig.parameters:
-            args.append('%s %s' % (self._get_arg_type(arg), arg))
+            args.append('%s %s' % (self._get_arg_type(arg, signature), arg))
 
-        # Add:
-        # @cython.boundscheck(False) # turn off bounds-checking for entire function
-        # @cython.wraparound(False)  # turn off negative index wrapping for entire function
-
-        return 'cdef %(ret_type)s %(func_name)s(%(args)s)%(nogil)s:' % (dict(
-            ret_type=self.get_cython_ret_type(),
-            func_name=self.func.__name__,
+        return 'cdef %(inline)s%(ret_type)s %(func_name)s(%(args)s)%(nogil)s:' % (dict(
+            inline='inline ' if self.is_inline() else '',
+            ret_type=self.get_cython_ret_type(signature),
+            func_name=self._get_specialization_name(signature),
             args=', '.join(args),
             nogil=' noexcept nogil' if self.nogil else ''
             ))
 
+    def get_directives(self, signature=None):
+        '''
+        :return dict(str, bool):
+            The cython directives to be applied to the function (with the given
+            signature).
+        '''
+        if signature is None:
+            signature = self.signatures[0]
+
+        directives = {}
+        if self._aggressive:
+            if any('[' in self._get_arg_type(arg, signature) for arg in self._sig.parameters):
+                # Memoryview arguments: don't check bounds/negative indexes/initialization.
+                directives.update(boundscheck=False, wraparound=False, initializedcheck=False)
+        directives.update(self._directives)
+        return directives
+
+    def get_directive_lines(self, signature=None):
+        self._check_jit_stage_collect()
+        return ['@cython.%s(%s)' % (directive, value)
+                for directive, value in sorted(self.get_directives(signature).items())]
+
+    def _get_arg_name_to_default(self):
+        '''
+        :return dict(str, str):
+            The source of the default value of the arguments which have one
+            (from the def line, so that it's also used in the def wrapper).
+        '''
+        return get_def_arg_sources(''.join(self.func_lines)).arg_name_to_default
+
     def get_wrapper_func_lines(self):
         self._check_jit_stage_collect()
         call_args = []
         args = []
+        untyped_args = []
+        arg_name_to_default = self._get_arg_name_to_default()
         for arg in self._sig.parameters:
-            args.append('%s %s' % (self._get_arg_type(arg), arg))
+            default = '=%s' % (arg_name_to_default[arg],) if arg in arg_name_to_default else ''
+            args.append('%s %s%s' % (self._get_arg_type(arg), arg, default))
+            untyped_args.append('%s%s' % (arg, default))
             call_args.append(arg)
 
         d = dict(
@@ -241,30 +836,326 @@ class CythonJitInfoCollector(object):
             func_name=self.func.__name__,
             func_wrapper_name=self.get_func_wrappr_name(),
             args=', '.join(args),
+            untyped_args=', '.join(untyped_args),
             call_args=', '.join(call_args),
         )
-        def_line = 'def %(func_wrapper_name)s(%(args)s) -> %(ret_type)s:' % (d)
-
-        return [def_line, '    return %(func_name)s(%(call_args)s)' % d]
+        signatures = self.signatures
+        if len(signatures) == 1:
+            def_line = 'def %(func_wrapper_name)s(%(args)s) -> %(ret_type)s:' % (d)
+            if self.nogil:
+                # The arguments are already converted: release the GIL during the call.
+                return [def_line] + self._get_nogil_call_lines(
+                    signatures[0], call_args, '_cyjit_ret', '    ', declare_ret=True)
+            return [def_line, '    return %(func_name)s(%(call_args)s)' % d]
+
+        # Multiple signatures: dispatch to the specialization matching the
+        # types of the arguments (falling back to the primary signature).
+        lines = ['def %(func_wrapper_name)s(%(untyped_args)s):' % (d)]
+        if self.nogil:
+            # The arguments are converted to typed variables (with the GIL)
+            # so that the call may be done without the GIL.
+            for i, signature in enumerate(signatures):
+                for arg in self._sig.parameters:
+                    lines.append('    cdef %s _cyjit_%s_%s' % (self._get_arg_type(arg, signature), i, arg))
+                if self.get_cython_ret_type(signature) != 'void':
+                    lines.append('    cdef %s _cyjit_ret_%s' % (self.get_cython_ret_type(signature), i))
+
+        for i, signature in enumerate(signatures):
+            conditions = []
+            for arg_name, checks in sorted(signature.arg_name_to_checks.items()):
+                conditions.append('(%s)' % ' or '.join(
+                    '(%s)' % (check % dict(arg=arg_name),) for check in sorted(checks)))
+            lines.append('    if %s:' % (' and '.join(conditions) or 'True',))
+            lines.extend(self._get_dispatch_call_lines(signature, i, '        '))
+        lines.extend(self._get_dispatch_call_lines(signatures[0], 0, '    '))
+        return lines
+
+    def get_vectorized_func_lines(self):
+        '''
+        :return list(str):
+            The lines of the def wrapper which broadcasts the arguments to
+            arrays and of the cdef function which applies the function to each
+            element (writing to the `out` array).
+        '''
+        self._check_jit_stage_collect()
+        func_name = self.func.__name__
+        arg_names = list(self._sig.parameters)
+        ret_type = self.get_cython_ret_type()
+
+        def get_array_type(cython_type):
+            dtype_name = _CYTHON_TYPE_TO_NUMPY_DTYPE.get(cython_type)
+            if dtype_name is None:
+                raise AssertionError('Unable to vectorize %s: type %s is not supported.' % (func_name, cython_type))
+            item_type = 'uint8_t' if cython_type == 'bint' else cython_type
+            if item_type.endswith('_t'):
+                self._c_imports.add('from libc.stdint cimport %s' % (item_type,))
+            return dtype_name, '%s[::1]' % (item_type,)
+
+        arg_name_to_array_type = dict((arg, get_array_type(self._get_arg_type(arg))) for arg in arg_names)
+        ret_dtype_name, ret_array_type = get_array_type(ret_type)
+        loop_func_name = '%s__cyjit_loop' % (func_name,)
+
+        arg_name_to_default = self._get_arg_name_to_default()
+        d = dict(
+            func_name=func_name,
+            func_wrapper_name=self.get_func_wrappr_name(),
+            loop_func_name=loop_func_name,
+            args=', '.join(arg_names),
+            untyped_args=', '.join(
+                '%s=%s' % (arg, arg_name_to_default[arg]) if arg in arg_name_to_default else arg
+                for arg in arg_names),
+            ret_dtype=ret_dtype_name,
+            ret_array_type=ret_array_type,
+            nogil=' noexcept nogil' if self.nogil else '',
+        )
+        lines = [
+            'def %(func_wrapper_name)s(%(untyped_args)s, out=None):' % d,
+            '    if out is None and %s:' % (' and '.join('_cyjit_numpy.ndim(%s) == 0' % (arg,) for arg in arg_names),),
+            '        return %(func_name)s(%(args)s)' % d,
+            # i.e.: floats passed to an int function raise a TypeError (instead of being truncated).
+            '    _cyjit_arrays = _cyjit_numpy.broadcast_arrays(%s)' % (', '.join(
+                "_cyjit_numpy.asarray(%s).astype(%r, casting='same_kind', copy=False)" % (
+                    arg, arg_name_to_array_type[arg][0]) for arg in arg_names),),
+            '    if out is None:',
+            '        out = _cyjit_numpy.empty(_cyjit_arrays[0].shape, dtype=%(ret_dtype)r)' % d,
+            '    elif out.shape != _cyjit_arrays[0].shape or out.dtype != _cyjit_numpy.dtype(%(ret_dtype)r) or '
+            'not out.flags.c_contiguous:' % d,
+            "        raise ValueError('out must be a C-contiguous %(ret_dtype)s array with shape: %%s' %% "
+            "(_cyjit_arrays[0].shape,))" % d,
+        ]
+        for i, arg in enumerate(arg_names):
+            lines.append('    cdef %s _cyjit_vec_%s = _cyjit_numpy.ascontiguousarray(_cyjit_arrays[%s]).reshape(-1)' % (
+                arg_name_to_array_type[arg][1], arg, i))
+        lines.append('    cdef %(ret_array_type)s _cyjit_vec_out = out.reshape(-1)' % d)
+        loop_call = '%s(%s)' % (loop_func_name, ', '.join(['_cyjit_vec_%s' % (arg,) for arg in arg_names + ['out']]))
+        if self.nogil:
+            lines.extend(['    with nogil:', '        %s' % (loop_call,)])
+        else:
+            lines.append('    %s' % (loop_call,))
+        lines.append('    return out')
+
+        self._c_imports.add('cimport cython')
+        lines.extend([
+            '@cython.boundscheck(False)',
+            '@cython.wraparound(False)',
+            'cdef void %s(%s)%s:' % (loop_func_name, ', '.join(
+                ['%s %s' % (arg_name_to_array_type[arg][1], arg) for arg in arg_names] +
+                ['%s out' % (ret_array_type,)]), d['nogil']),
+            '    cdef Py_ssize_t _cyjit_i',
+            '    for _cyjit_i in range(out.shape[0]):',
+            '        out[_cyjit_i] = %s(%s)' % (func_name, ', '.join('%s[_cyjit_i]' % (arg,) for arg in arg_names)),
+        ])
+        return lines
+
+    def _get_dispatch_call_lines(self, signature, i, indent):
+        call_args = list(self._sig.parameters)
+        if not self.nogil:
+            return ['%sreturn %s(%s)' % (indent, self._get_specialization_name(signature), ', '.join(call_args))]
+
+        lines = []
+        typed_call_args = []
+        for arg in call_args:
+            typed_arg = '_cyjit_%s_%s' % (i, arg)
+            lines.append('%s%s = %s' % (indent, typed_arg, arg))
+            typed_call_args.append(typed_arg)
+        lines.extend(self._get_nogil_call_lines(signature, typed_call_args, '_cyjit_ret_%s' % (i,), indent))
+        return lines
+
+    def _get_nogil_call_lines(self, signature, call_args, ret_var, indent, declare_ret=False):
+        '''
+        :return list(str):
+            The lines which call the specialization for the given signature
+            without the GIL (the arguments must be already typed and
+            `ret_var` must be declared unless `declare_ret` is True).
+        '''
+        ret_type = self.get_cython_ret_type(signature)
+        call = '%s(%s)' % (self._get_specialization_name(signature), ', '.join(call_args))
+        if ret_type == 'void':
+            return [
+                '%swith nogil:' % (indent,),
+                '%s    %s' % (indent, call),
+                '%sreturn None' % (indent,),
+            ]
+
+        lines = []
+        if declare_ret:
+            lines.append('%scdef %s %s' % (indent, ret_type, ret_var))
+        lines.extend([
+            '%swith nogil:' % (indent,),
+            '%s    %s = %s' % (indent, ret_var, call),
+            '%sreturn %s' % (indent, ret_var),
+        ])
+        return lines
+
+    def get_local_declaration_lines(self, signature=None):
+        '''
+        :return list(str):
+            The `cdef` declarations for the local variables whose types could
+            be inferred (only if `infer_locals` was passed to the collector).
+        '''
+        self._check_jit_stage_collect()
+        if not self._infer_locals and not self._parallel:
+            return []
+        from cython_jit import _type_inference
+        if signature is None:
+            signature = self.signatures[0]
+
+        declared_names = _type_inference.get_declared_names(self.func_lines)
+        local_name_to_type = {}
+        if self._infer_locals:
+            arg_name_to_type = dict((arg, self._get_arg_type(arg, signature)) for arg in self._sig.parameters)
+            local_name_to_type.update(_type_inference.infer_local_types(
+                _type_inference.get_inference_source(self._raw_func_lines),
+                arg_name_to_type,
+                declared_names))
+
+        # prange loop variables must be C integers.
+        for loop_var in self._get_parallel_loops(signature).values():
+            if loop_var not in declared_names:
+                local_name_to_type[loop_var] = 'Py_ssize_t'
+
+        body_indent = 4
+        for line in self.func_lines[1:]:
+            if line.strip():
+                body_indent = get_line_indent(line)
+                break
+
+        lines = []
+        for name, local_type in sorted(local_name_to_type.items()):
+            if local_type.endswith('_t') and local_type != 'Py_ssize_t':
+                self._c_imports.add('from libc.stdint cimport %s' % (local_type,))
+            lines.append('%scdef %s %s' % (' ' * body_indent, local_type, name))
+        return lines
+
+    def _get_parallel_loops(self, signature):
+        '''
+        :return dict(int, str):
+            The index of the lines of the loops converted to `prange` and the
+            loop variable of each one (empty if `parallel` wasn't passed to the
+            collector).
+        '''
+        if not self._parallel:
+            return {}
+        from cython_jit import _parallel_loops
+        from cython_jit import _type_inference
+        memoryview_arg_names = set(
+            arg for arg in self._sig.parameters if '[' in self._get_arg_type(arg, signature))
+        return _parallel_loops.get_parallel_loops(
+            _type_inference.get_inference_source(self._raw_func_lines), memoryview_arg_names)
+
+    def get_body_lines(self, signature=None):
+        '''
+        :return list(str):
+            The lines of the body of the function (with the eligible loops
+            converted to `prange` if `parallel` was passed to the collector and
+            the calls to other jitted functions renamed to the specialization
+            matching the types seen in the given signature).
+        '''
+        self._check_jit_stage_collect()
+        import re
+        from cython_jit import _parallel_loops
+        if signature is None:
+            signature = self.signatures[0]
+
+        callee_renames = [
+            (re.compile(r'(?<![\w.])%s(?=\s*\()' % (re.escape(callee_name),)), name)
+            for callee_name, name in sorted(self._get_callee_specialization_names(signature).items())]
+        parallel_loops = self._get_parallel_loops(signature)
+        lines = []
+        for i, line in enumerate(self.func_lines):
+            if i == 0:
+                continue
+            if i in parallel_loops:
+                prange_line = _parallel_loops.to_prange_line(line, self._num_threads)
+                if prange_line is not None:
+                    line = prange_line
+                    self._c_imports.add('from cython.parallel cimport prange')
+            for pattern, name in callee_renames:
+                line = pattern.sub(name, line)
+            lines.append(line.rstrip())
+        return lines
 
     def get_func_wrappr_name(self):
         return '%s_cy_wrapper' % (self.func.__name__,)
 
     def get_c_import_lines(self):
         self._check_jit_stage_collect()
-        return sorted(self._c_imports)
+        c_imports = set(self._c_imports)
+        annotations = [param.annotation for param in self._sig.parameters.values()] + [self._sig.return_annotation]
+        for annotation in annotations:
+            if isinstance(annotation, str):
+                match = _STDINT_TYPE_RE.match(annotation)
+                if match is not None:
+                    c_imports.add('from libc.stdint cimport %s' % (match.group(0),))
+        if any(self.get_directives(signature) for signature in self.signatures):
+            c_imports.add('cimport cython')
+        return sorted(c_imports)
+
+    def _get_type_key(self, value):
+        value_type = type(value)
+        if value_type.__name__ == 'ndarray':
+            return (value_type, value.dtype, value.ndim, value.flags.c_contiguous, value.flags.f_contiguous)
+        return value_type
+
+    def _translate_arg(self, arg_name, value):
+        '''
+        :return tuple(str, str):
+            The cython type for the given value and an expression (with an
+            `%(arg)s` placeholder for the argument name) which checks whether
+            a value matches the same type (cached by the type of the value as
+            this is called for each argument in each call).
+        '''
+        type_key = self._get_type_key(value)
+        try:
+            return self._type_key_to_translated_type[type_key]
+        except KeyError:
+            ret = self._type_key_to_translated_type[type_key] = (
+                self._compute_translated_type(arg_name, value), self._compute_type_check(value))
+            return ret
 
     def _translate_type(self, arg_name, value):
-        import numpy
-        if type(value) == numpy.int32:
+        '''
+        :return str:
+            The cython type for the given value.
+        '''
+        return self._translate_arg(arg_name, value)[0]
+
+    def _compute_type_check(self, value):
+        if value is None:
+            return '%(arg)s is None'
+
+        value_type = type(value)
+        if value_type in (int, float, bool, complex):
+            return 'type(%%(arg)s) is %s' % (value_type.__name__,)
+
+        if value_type.__name__ == 'ndarray':
+            check = (
+                'type(%%(arg)s) is _cyjit_numpy.ndarray and '
+                '%%(arg)s.dtype == %r and %%(arg)s.ndim == %s' % (value.dtype.name, value.ndim))
+            dims = _get_memoryview_dims(value)
+            if dims[-1] == '::1':
+                check += ' and %(arg)s.flags.c_contiguous'
+            elif dims[0] == '::1':
+                check += ' and %(arg)s.flags.f_contiguous'
+            return check
+
+        if value_type.__module__ == 'numpy':
+            return 'type(%%(arg)s) is _cyjit_numpy.%s' % (value_type.__name__,)
+
+        return 'type(%%(arg)s).__name__ == %r' % (value_type.__name__,)
+
+    def _compute_translated_type(self, arg_name, value):
+        # Note: if numpy wasn't imported the value can't be a numpy type.
+        numpy = sys.modules.get('numpy')
+        if numpy is not None and type(value) == numpy.int32:
             ret = 'int32_t'
             self._c_imports.add('from libc.stdint cimport %s' % (ret,))
 
-        elif type(value) == numpy.uint32:
+        elif numpy is not None and type(value) == numpy.uint32:
             ret = 'uint32_t'
             self._c_imports.add('from libc.stdint cimport %s' % (ret,))
 
-        elif isinstance(value, (int, numpy.int64)):
+        elif isinstance(value, int) or (numpy is not None and isinstance(value, numpy.int64)):
             ret = 'int64_t'
             self._c_imports.add('from libc.stdint cimport %s' % (ret,))
 
@@ -274,16 +1165,20 @@ class CythonJitInfoCollector(object):
         elif value is None:
             return 'void'
 
-        elif isinstance(value, numpy.ndarray):
-            if value.dtype == numpy.uint32:
-                dtype_str = 'uint32_t'
-            elif value.dtype == numpy.uint8:
-                dtype_str = 'uint8_t'
-            else:
-                raise AssertionError('Unhandled %s: %s' % (arg_name, value.dtype,))
+        elif numpy is not None and isinstance(value, numpy.ndarray):
+            dtype_str = _NUMPY_DTYPE_TO_CYTHON_TYPE.get(value.dtype.name)
+            if dtype_str is None or value.ndim == 0:
+                raise AssertionError('Unhandled %s: %s (ndim: %s)' % (arg_name, value.dtype, value.ndim))
+
+            if dtype_str.endswith('_t'):
+                self._c_imports.add('from libc.stdint cimport %s' % (dtype_str,))
+            return '%s[%s]' % (dtype_str, ', '.join(_get_memoryview_dims(value)))
 
-            self._c_imports.add('from libc.stdint cimport %s' % (dtype_str,))
-            return '%s[%s]' % (dtype_str, ','.join([':'] * value.ndim))
+        elif numpy is not None and isinstance(value, numpy.generic) and \
+                value.dtype.name in _NUMPY_DTYPE_TO_CYTHON_TYPE:
+            ret = 'bint' if value.dtype.name == 'bool' else _NUMPY_DTYPE_TO_CYTHON_TYPE[value.dtype.name]
+            if ret.endswith('_t'):
+                self._c_imports.add('from libc.stdint cimport %s' % (ret,))
 
         elif value.__class__.__name__ == self._sig.return_annotation:
             return value.__class__.__name__
@@ -293,6 +1188,8 @@ class CythonJitInfoCollector(object):
 
         return ret
 
-    def get_cython_ret_type(self):
+    def get_cython_ret_type(self, signature=None):
         self._check_jit_stage_collect()
-        return self._return_type
+        if signature is None:
+            signature = self.signatures[0]
+        return signature.return_type
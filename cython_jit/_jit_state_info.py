@@ -1,5 +1,6 @@
 from collections import namedtuple
 from contextlib import contextmanager
+from pathlib import Path
 
 
 @contextmanager
@@ -13,20 +14,6 @@ def add_to_sys_path(directory):
         sys.path.remove(directory)
 
 
-class _EraseHelper(object):
-
-    def __init__(self):
-        self._removed = set()
-
-    def remove(self, filepath):
-        if filepath not in self._removed:
-            self._removed.add(filepath)
-            try:
-                filepath.unlink()
-            except OSError:
-                pass
-
-
 class _JitStateInfo:
 
     def __init__(self):
@@ -34,9 +21,34 @@ class _JitStateInfo:
         self.stage = JitStage.use_compiled
         self._dirs = {}
         self.all_collectors = {}
-        self._erase_helper = _EraseHelper()
         self._pyd_name_to_module = {}
 
+        from cython_jit._manifest import ManifestCache
+        self._manifest_cache = ManifestCache()
+        self._dir_to_lease = {}
+
+        # Options passed to `compile_collected` when it's called automatically.
+        self.compile_options = {}
+        self.compile_at_exit_registered = False
+        self.compile_at_exit_time_budget = None
+        self.compile_at_exit_detach = False
+        self.background_compile_calls = 1000
+        self.background_compile_seconds = None
+        # The modules which failed to compile in the background.
+        self._background_failed_module_names = set()
+        # The pyd names being compiled in the background (guarded by the lock
+        # along with the `compile_scheduled` flag of their collectors).
+        import threading
+        self._background_pyd_names = set()
+        self._background_lock = threading.Lock()
+        self.lazy_load = False
+        self.build_mode = 'module'
+        self.cache_max_size = None
+        self.cache_max_age = None
+
+        # The RuntimeStats (if enabled -- see: `cython_jit.set_stats_enabled`).
+        self.stats = None
+
     def set_dir(self, dir_type, directory):
         assert dir_type in ('cache', 'temp')
         from pathlib import Path
@@ -62,141 +74,744 @@ class _JitStateInfo:
     def get_cached(self, collector):
         '''
         :param CythonJitInfoCollector collector:
+
+        :return callable|NoneType:
+            The compiled function (or None if it's not available in the cache
+            dir with the same key).
         '''
-        import importlib
-        pyd_name = collector.get_pyd_name()
+        from cython_jit._manifest import get_abi
+        from cython_jit.compile_with_cython import get_cpu_key
+        func_name = collector.func.__name__
+
+        # The function may be compiled in the module of its python module or in
+        # its own module (see: `cython_jit.set_build_mode`).
+        for pyd_name in (collector.get_pyd_name(), collector.get_function_pyd_name()):
+            module = self._pyd_name_to_module.get(pyd_name)
+            if module is None or not module.cython_jit_key_matches(func_name, collector.key):
+                # Not loaded (or a different version was loaded): check the manifest.
+                target_dir = self.get_dir('cache')
+                entry = self._manifest_cache.get_entries(target_dir).get(pyd_name)
+                if entry is None or entry.abi != get_abi() or entry.func_keys.get(func_name) != collector.key:
+                    continue
+                if entry.cpu and entry.cpu != get_cpu_key():
+                    continue  # Built for another cpu (i.e.: in a cache dir shared by many hosts).
+                try:
+                    module = self._load_module(entry.module_name, target_dir / entry.filename)
+                except (ImportError, OSError):
+                    continue
+                self._pyd_name_to_module[pyd_name] = module
 
-        module = self._pyd_name_to_module.get(pyd_name)
-        if module is not None:
-            return getattr(module, collector.get_func_wrappr_name())
+            return getattr(module, collector.get_func_wrappr_name(), None)
+        return None
 
-        target_dir = self.get_dir('cache')
+    def _load_module(self, module_name, path):
+        '''
+        Loads a module from the cache dir (first recording it in the lease of
+        this process so that it's not removed while in use).
 
-        pyd_info = self._get_pyd_info_from_dir(pyd_name, target_dir)
-        if pyd_info.latest_pyd_name:
-            with add_to_sys_path(target_dir):
-                try:
-                    module = importlib.import_module(pyd_info.latest_pyd_name)
-                except ImportError:
-                    return None
+        The lock of the module is held while loading it (`prune_cache` only
+        removes a module holding its lock, after checking the leases again).
+        '''
+        from cython_jit._cache import touch_module
+        from cython_jit._file_lock import ProcessLease
+        from cython_jit._file_lock import get_module_lock
+        from cython_jit._manifest import load_module
+
+        cache_dir = path.parent
+        lease = self._dir_to_lease.get(cache_dir)
+        if lease is None:
+            lease = self._dir_to_lease[cache_dir] = ProcessLease(cache_dir)
+
+        module_lock = get_module_lock(cache_dir, module_name)
+        try:
+            module_lock.acquire()
+        except OSError:
+            pass  # i.e.: a read-only cache dir (its modules can't be removed either).
+        try:
+            lease.add(module_name)
+            touch_module(path)  # Used to evict the least recently used modules.
+            return load_module(module_name, path)
+        finally:
+            module_lock.release()
+
+    def prune_cache(self, max_size=None, max_age=None):
+        '''
+        Prunes the cache dir (see: `_cache.prune_cache`). If no limit is given,
+        the limits from `cython_jit.set_cache_limits` are used.
+
+        :return list(pathlib.Path):
+            The files and dirs removed.
+        '''
+        from cython_jit._cache import prune_cache
+        if max_size is None and max_age is None:
+            max_size = self.cache_max_size
+            max_age = self.cache_max_age
+        return prune_cache(self.get_dir('cache'), self.get_dir('temp'), max_size=max_size, max_age=max_age)
+
+    def _prune_cache_after_compile(self):
+        if self.cache_max_size is not None or self.cache_max_age is not None:
+            self.prune_cache()
+
+    def compile_collected(self, silent=False, debug=False, jobs=None, backend=None, profile=None):
+        '''
+        Compiles a module for each python module which had information collected.
+
+        :param int jobs:
+            The number of processes used to compile the modules concurrently
+            (if None, the number of cpus is used).
+
+        :param str backend:
+            The backend used to compile each module (see: `compile_with_cython`).
+
+        :param str|CompileProfile profile:
+            The optimization profile used for modules where no function
+            specified a profile in `jit(profile=...)`.
+
+        :raise CompileCollectedError:
+            If some module failed to compile (the modules which were compiled
+            successfully are still loaded).
+        '''
+        import cython_jit
+
+        target_dir = cython_jit.get_cache_dir()
+        temp_dir = cython_jit.get_temp_dir()
+
+        compile_jobs = self._create_compile_jobs(debug=debug, backend=backend, profile=profile)
+        pyd_name_to_duration = {}
+        pyd_name_to_error = build_compile_jobs(
+            compile_jobs, temp_dir, target_dir, silent=silent, debug=debug, jobs=jobs, backend=backend,
+            pyd_name_to_duration=pyd_name_to_duration)
 
+        stats = self.stats
+        if stats is not None:
+            for compile_job in compile_jobs:
+                pyd_name = compile_job.pyd_name
+                stats.record_compile(compile_job, pyd_name_to_duration.get(pyd_name), pyd_name_to_error.get(pyd_name))
+
+        for compile_job in compile_jobs:
+            if compile_job.pyd_name not in pyd_name_to_error:
+                self._pyd_name_to_module[compile_job.pyd_name] = self._load_module(
+                    compile_job.module_name, _get_artifact_path(compile_job, target_dir))
+
+        self._prune_cache_after_compile()
+        if pyd_name_to_error:
+            raise cython_jit.CompileCollectedError(pyd_name_to_error)
+
+    def compile_at_exit(self):
+        '''
+        Compiles the collected information (called when the process exits in
+        the `JitStage.collect_info_and_compile_at_exit` stage).
+
+        If a time budget was given or the compilation should be detached (see:
+        `cython_jit.set_compile_at_exit_options`), the compilation is done in
+        a separate process (which is kept running in the background if it
+        doesn't finish during the time budget).
+        '''
+        import subprocess
+        import traceback
+
+        compile_options = self._get_automatic_compile_options()
+        try:
+            if self.compile_at_exit_time_budget is None and not self.compile_at_exit_detach:
+                # A process pool can't be used at this point (the exit hook of
+                # `concurrent.futures.process` may already have run, in which
+                # case new futures can't be scheduled).
+                compile_options['jobs'] = 1
+                self.compile_collected(**compile_options)
+                return
+
+            process = self._start_compile_process(self._create_compile_jobs(
+                debug=compile_options.get('debug', False),
+                backend=compile_options.get('backend'),
+                profile=compile_options.get('profile')), compile_options)
+            if process is not None and not self.compile_at_exit_detach:
                 try:
-                    ret = getattr(module, collector.get_func_wrappr_name())
-                except AttributeError:
-                    return None
-                else:
+                    process.wait(timeout=self.compile_at_exit_time_budget)
+                except subprocess.TimeoutExpired:
+                    pass  # Let it finish in the background.
+        except Exception:
+            traceback.print_exc()
+
+    def on_collected_in_background(self, collector):
+        '''
+        Called after each call collecting information in the
+        `JitStage.collect_info_and_compile_in_background` stage (schedules the
+        compilation when a threshold is reached).
+        '''
+        import time
+        collector.background_calls += 1
+        if collector.background_first_call_time is None:
+            collector.background_first_call_time = time.time()
+
+        if (self.background_compile_calls is not None and
+                collector.background_calls >= self.background_compile_calls) or \
+                (self.background_compile_seconds is not None and
+                 time.time() - collector.background_first_call_time >= self.background_compile_seconds):
+            # Restart the thresholds (if this function isn't compiled now, it's
+            # only considered again after the thresholds are reached again).
+            collector.background_calls = 0
+            collector.background_first_call_time = None
+            self._schedule_background_compile(collector.get_pyd_name())
+
+    def _schedule_background_compile(self, pyd_name):
+        '''
+        Starts a thread to compile the given module with the information
+        collected so far (the code is generated in that thread).
+
+        The functions of the module stop collecting information until the
+        code is generated. Afterwards, only the functions whose information
+        was used are kept as scheduled (the others keep on collecting
+        information and may schedule a new compilation of the module later
+        on -- after this one finishes).
+        '''
+        import threading
+
+        collectors = [
+            collector for collector in list(self.all_collectors.values()) if collector.get_pyd_name() == pyd_name]
+        with self._background_lock:
+            if pyd_name in self._background_pyd_names:
+                return  # Already being compiled.
+            self._background_pyd_names.add(pyd_name)
+            for collector in collectors:
+                if collector.compiled_func is None:
+                    collector.compile_scheduled = True
+
+        thread = threading.Thread(target=self._background_compile, args=(pyd_name, collectors))
+        thread.daemon = True
+        thread.start()
+
+    def _finish_background_compile(self, pyd_name, collectors):
+        '''
+        Marks the compilation of the given module as finished (the given
+        collectors which weren't compiled collect information again).
+        '''
+        with self._background_lock:
+            self._background_pyd_names.discard(pyd_name)
+            for collector in collectors:
+                if collector.compiled_func is None:
+                    collector.compile_scheduled = False
+
+    def _background_compile(self, pyd_name, collectors):
+        import time
+        import traceback
+
+        compile_options = self._get_automatic_compile_options()
+        try:
+            compile_jobs = self._create_compile_jobs(
+                debug=compile_options.get('debug', False),
+                backend=compile_options.get('backend'),
+                profile=compile_options.get('profile'),
+                collectors=collectors)
+
+            # Contents which already failed to compile are not compiled again.
+            compile_jobs = [
+                compile_job for compile_job in compile_jobs
+                if compile_job.module_name not in self._background_failed_module_names]
+        except Exception:
+            traceback.print_exc()
+            self._finish_background_compile(pyd_name, collectors)
+            return
+
+        compiled_func_names = set()
+        for compile_job in compile_jobs:
+            compiled_func_names.update(compile_job.func_keys)
+        with self._background_lock:
+            for collector in collectors:
+                if collector.func.__name__ not in compiled_func_names and collector.compiled_func is None:
+                    collector.compile_scheduled = False
+        collectors = [collector for collector in collectors if collector.func.__name__ in compiled_func_names]
+
+        try:
+            if not compile_jobs:
+                return
+
+            initial_time = time.perf_counter()
+            process = self._start_compile_process(compile_jobs, compile_options)
+            returncode = process.wait() if process is not None else 0
+            stats = self.stats
+            if stats is not None:
+                # The jobs are compiled in a single process (so, the time is the same for all).
+                duration = time.perf_counter() - initial_time if process is not None else None
+                for compile_job in compile_jobs:
+                    stats.record_compile(
+                        compile_job, duration, None if returncode == 0 else 'Exit code: %s' % (returncode,))
+            if returncode != 0:
+                # Just keep on using the python version (collecting information
+                # again, so, a new compilation may be scheduled if it changes).
+                self._background_failed_module_names.update(compile_job.module_name for compile_job in compile_jobs)
+                return
+
+            target_dir = self.get_dir('cache')
+            for compile_job in compile_jobs:
+                module = self._load_module(compile_job.module_name, _get_artifact_path(compile_job, target_dir))
+                self._pyd_name_to_module[compile_job.pyd_name] = module
+
+                for collector in collectors:
                     if module.cython_jit_key_matches(collector.func.__name__, collector.key):
-                        self._pyd_name_to_module[pyd_name] = module
-                        return ret
+                        # Attribute assignment is atomic: the next call uses the compiled version.
+                        collector.compiled_func = getattr(module, collector.get_func_wrappr_name())
+            self._prune_cache_after_compile()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self._finish_background_compile(pyd_name, collectors)
+
+    def _get_automatic_compile_options(self):
+        compile_options = dict(silent=True)
+        compile_options.update(self.compile_options)
+        return compile_options
+
+    def _start_compile_process(self, compile_jobs, compile_options):
+        '''
+        :return subprocess.Popen|NoneType:
+            The process compiling the given jobs or None if all the artifacts
+            were already available.
+        '''
+        from cython_jit import _compile_jobs
+        target_dir = self.get_dir('cache')
+        temp_dir = self.get_dir('temp')
+        if all(_is_artifact_built(compile_job, target_dir) for compile_job in compile_jobs):
+            # Nothing to compile (just mark the existing artifacts as the latest ones).
+            build_compile_jobs(compile_jobs, temp_dir, target_dir)
+            return None
 
-    def compile_collected(self, silent=False, debug=False):
+        compile_options = dict(compile_options)
+        compile_options.pop('profile', None)  # Already in the compile jobs.
+        return _compile_jobs.start_compile_process(compile_jobs, temp_dir, target_dir, compile_options)
+
+    def _create_compile_jobs(self, debug=False, backend=None, profile=None, collectors=None, build_mode=None):
+        '''
+        :param str|CompileProfile profile:
+            The profile used for modules where no function specified a profile.
+
+        :param list(CythonJitInfoCollector) collectors:
+            The collectors to be considered (if None, all the collectors are
+            considered).
+
+        :param str build_mode:
+            'module', 'sliced' or 'function' (see: `cython_jit.set_build_mode`).
+            If None, the current build mode is used.
+
+        :return list(_CompileJob):
+            The contents to be compiled for each module with collected information.
+        '''
         from collections import defaultdict
-        from pathlib import Path
-        from cython_jit.compile_with_cython import compile_with_cython
-        import cython_jit
-        import importlib
-        from ._info_collector import fix_cython_ifdefs
+
+        if collectors is None:
+            collectors = self.all_collectors.values()
+        if build_mode is None:
+            build_mode = self.build_mode
+        if build_mode not in BUILD_MODES:
+            raise AssertionError('Unexpected build mode: %s (expected one of: %s).' % (
+                build_mode, ', '.join(BUILD_MODES)))
 
         pyd_name_to_collectors = defaultdict(list)
-        for collector in self.all_collectors.values():
-            if collector.collected_info:
-                pyd_name = collector.get_pyd_name()
-                pyd_name_to_collectors[pyd_name].append(collector)
+        for collector in collectors:
+            pyd_name = collector.get_pyd_name()
+            pyd_name_to_collectors[pyd_name].append(collector)
 
+        compile_jobs = []
         for pyd_name, collectors in pyd_name_to_collectors.items():
-            first_collector = next(iter(collectors))
-            filepath = Path(first_collector.func.__code__.co_filename)
+            if not any(collector.collected_info() for collector in collectors):
+                continue
+
+            if build_mode == 'function':
+                for collector in collectors:
+                    if collector.collected_info():
+                        compile_jobs.append(self._create_sliced_compile_job(
+                            collector.get_function_pyd_name(), [collector], collectors, debug, backend, profile))
+            elif build_mode == 'sliced':
+                compile_jobs.append(self._create_sliced_compile_job(
+                    pyd_name, [collector for collector in collectors if collector.collected_info()], collectors,
+                    debug, backend, profile))
+            else:
+                compile_jobs.append(self._create_module_compile_job(pyd_name, collectors, debug, backend, profile))
 
-            if not filepath.exists():
-                raise RuntimeError('Expected: %s to exist.' % (filepath,))
+        return compile_jobs
 
-            with filepath.open() as stream:
-                original_lines = fix_cython_ifdefs([x.rstrip() for x in stream.readlines()])
+    def _read_module_lines(self, collector):
+        '''
+        :return tuple(str, list(str)):
+            The source of the module of the given collector and its lines
+            (with the `# IFDEF CYTHON` blocks applied).
+        '''
+        from pathlib import Path
+        from ._info_collector import fix_cython_ifdefs
 
-            # We must apply bottom to top so that lines are correct.
-            collectors = sorted(
-                collectors, key=lambda collector:-collector.func_first_line)
+        filepath = Path(collector.func.__code__.co_filename)
+        if not filepath.exists():
+            raise RuntimeError('Expected: %s to exist.' % (filepath,))
 
-            import_lines = set()
+        with filepath.open() as stream:
+            source = stream.read()
+        return source, fix_cython_ifdefs([x.rstrip() for x in source.splitlines()])
 
-            keys_collected = {}
-            for collector in collectors:
-                info_to_apply = collector.generate()
-                keys_collected[collector.func.__name__] = collector.key
+    def _create_module_compile_job(self, pyd_name, collectors, debug, backend, profile):
+        '''
+        :return _CompileJob:
+            The job to compile the whole module of the given collectors.
+        '''
+        _source, original_lines = self._read_module_lines(next(iter(collectors)))
+
+        # We must apply bottom to top so that lines are correct.
+        collectors = sorted(
+            collectors, key=lambda collector:-collector.func_first_line)
+
+        import_lines = set()
+
+        keys_collected = {}
+        for collector in collectors:
+            if not collector.collected_info():
+                # Keep it as a regular python function (just remove the
+                # @jit decorator).
+                def_line = collector.func_first_line
+                decorator_line = def_line
+                while decorator_line > 0 and original_lines[decorator_line - 1].startswith('@'):
+                    decorator_line -= 1
+                del original_lines[decorator_line:def_line]
+                continue
+
+            info_to_apply = collector.generate()
+            keys_collected[collector.func.__name__] = collector.key
+
+            # Remove decorators too
+            func_first_line = collector.func_first_line
+            while original_lines[func_first_line].startswith('def') or \
+                    original_lines[func_first_line].startswith('@'):
+                func_first_line -= 1
+
+            original_lines[func_first_line:collector.func_last_line] = info_to_apply.func_lines
+            import_lines.update(info_to_apply.c_import_lines)
+
+        return _create_compile_job(
+            pyd_name, import_lines, keys_collected, original_lines,
+            [collector for collector in reversed(collectors) if collector.collected_info()],
+            debug, backend, profile)
+
+    def _create_sliced_compile_job(self, pyd_name, collectors_to_compile, collectors, debug, backend, profile):
+        '''
+        :param list(CythonJitInfoCollector) collectors_to_compile:
+            The collectors of the functions to be compiled.
 
-                # Remove decorators too
-                func_first_line = collector.func_first_line
-                while original_lines[func_first_line].startswith('def') or \
-                        original_lines[func_first_line].startswith('@'):
-                    func_first_line -= 1
+        :param list(CythonJitInfoCollector) collectors:
+            All the collectors of the python module.
 
-                original_lines[func_first_line:collector.func_last_line] = info_to_apply.func_lines
-                import_lines.update(info_to_apply.c_import_lines)
+        :return _CompileJob:
+            The job to compile only the given functions along with the
+            imports, constants and helpers they need from their module (see:
+            `_slicing.get_module_slice`).
+        '''
+        from cython_jit._slicing import get_module_slice
+
+        source, original_lines = self._read_module_lines(collectors_to_compile[0])
+        name_to_collector = dict((collector.func.__name__, collector) for collector in collectors)
+
+        import_lines = set()
+        keys_collected = {}
+        func_name_to_lines = {}
+        generated_collectors = []
+
+        def generate(collector):
+            info_to_apply = collector.generate()
+            func_name_to_lines[collector.func.__name__] = list(info_to_apply.func_lines)
+            import_lines.update(info_to_apply.c_import_lines)
+            generated_collectors.append(collector)
+
+        for collector in collectors_to_compile:
+            generate(collector)
+            keys_collected[collector.func.__name__] = collector.key
+
+        module_lines = []
+        for statement in get_module_slice(source, sorted(func_name_to_lines), name_to_collector):
+            collector = name_to_collector.get(statement.func_name)
+            if collector is not None and statement.func_name not in func_name_to_lines and collector.collected_info():
+                # Other jitted functions needed are also compiled (so that the
+                # calls to them are C calls) but they're loaded from their
+                # own module.
+                generate(collector)
+
+            if statement.func_name in func_name_to_lines:
+                lines = func_name_to_lines[statement.func_name]
+            elif collector is not None:
+                # Jitted functions without type information are kept as
+                # regular python functions.
+                lines = original_lines[statement.body_start:statement.end]
+            else:
+                lines = original_lines[statement.start:statement.end]
+            module_lines.extend(lines + ['', ''])
+
+        return _create_compile_job(
+            pyd_name, import_lines, keys_collected, module_lines, generated_collectors, debug, backend, profile)
+
+
+BUILD_MODES = ('module', 'sliced', 'function')
+
+
+def _create_compile_job(pyd_name, import_lines, keys_collected, module_lines, collectors, debug, backend, profile):
+    '''
+    :param list(CythonJitInfoCollector) collectors:
+        The collectors of the functions compiled in the module.
 
-            cython_jit_key_matches_method = '''
+    :return _CompileJob:
+        The job to compile the given module lines (prefixed with the imports
+        and the table with the keys of the functions compiled).
+    '''
+    from cython_jit.compile_with_cython import get_compile_key
+    from cython_jit.compile_with_cython import get_profile
+    from cython_jit.compile_with_cython import merge_profiles
+
+    cython_jit_key_matches_method = '''
 _keys_collected = %(keys_collected)r
 def cython_jit_key_matches(func_name, key):
     return _keys_collected.get(func_name) == key
 ''' % dict(keys_collected=keys_collected)
 
-            original_lines = sorted(import_lines) + \
-                [x.rstrip() for x in cython_jit_key_matches_method.splitlines()] + \
-                original_lines
+    module_lines = ['# cython: language_level=3'] + sorted(import_lines) + \
+        [x.rstrip() for x in cython_jit_key_matches_method.splitlines()] + \
+        module_lines
+
+    # Functions may specify a profile which overrides the default one
+    # for their module.
+    profiles = [collector.profile for collector in collectors if collector.profile is not None]
+    module_profile = merge_profiles(profiles) if profiles else get_profile(profile)
+    if any(collector.parallel for collector in collectors):
+        # prange loops need OpenMP.
+        module_profile = module_profile._replace(openmp=True)
+
+    module_contents = '\n'.join(module_lines)
+    compile_key = get_compile_key(module_contents, debug=debug, backend=backend, profile=module_profile)
+    return _CompileJob(
+        pyd_name=pyd_name,
+        module_name='%s_%s' % (pyd_name, compile_key[:16]),
+        module_contents=module_contents,
+        profile=module_profile,
+        func_keys=keys_collected)
+
+
+def _get_artifact_path(compile_job, target_dir):
+    from cython_jit._manifest import get_abi
+    return target_dir / (compile_job.module_name + get_abi())
 
-            original_lines = ['# cython: language_level=3'] + original_lines
 
-            pyd_name = first_collector.get_pyd_name()
+def _get_pgo_marker_path(compile_job, target_dir):
+    return target_dir / (compile_job.module_name + '.pgo')
 
-            target_dir = cython_jit.get_cache_dir()
-            temp_dir = cython_jit.get_temp_dir()
 
-            pyd_info = self._get_pyd_info_from_dir(pyd_name, target_dir)
+def _is_artifact_built(compile_job, target_dir):
+    '''
+    :return bool:
+        Whether the artifact for the given job is available (built with the
+        same pgo phase).
+    '''
+    from cython_jit.compile_with_cython import get_pgo_marker
+    if not _get_artifact_path(compile_job, target_dir).exists():
+        return False
+
+    try:
+        with _get_pgo_marker_path(compile_job, target_dir).open() as stream:
+            pgo_marker = stream.read()
+    except OSError:
+        pgo_marker = ''
+    return pgo_marker == get_pgo_marker(compile_job.profile)
+
+
+def get_artifact_files(compile_job, target_dir):
+    '''
+    :return list(pathlib.Path):
+        The files needed to use the module built for the given job from the
+        target dir (i.e.: to be copied to the cache dir in another machine).
+    '''
+    files = [
+        _get_artifact_path(compile_job, target_dir),
+        _get_pgo_marker_path(compile_job, target_dir),
+    ]
+    return [path for path in files if path.exists()]
+
+
+def _get_manifest_entry(compile_job):
+    from cython_jit._manifest import ManifestEntry
+    from cython_jit._manifest import get_abi
+    from cython_jit.compile_with_cython import get_cpu_key
+    from cython_jit.compile_with_cython import get_profile
+    profile = get_profile(compile_job.profile)
+    return ManifestEntry(
+        module_name=compile_job.module_name,
+        filename=_get_artifact_path(compile_job, Path()).name,
+        abi=get_abi(),
+        func_keys=compile_job.func_keys or {},
+        profile=list(profile),
+        cpu=get_cpu_key(profile),
+    )
+
+
+def _set_artifact_built(compile_job, staging_dir, target_dir):
+    '''
+    Publishes the artifact built in the staging dir (and its pgo marker) in
+    the target dir (os.replace is atomic, so, readers see either the previous
+    file or the new one).
+    '''
+    import os
+    from cython_jit.compile_with_cython import get_pgo_marker
+    os.replace(str(_get_artifact_path(compile_job, staging_dir)), str(_get_artifact_path(compile_job, target_dir)))
 
-            compile_with_cython(
-                pyd_info.next_pyd_name, '\n'.join(original_lines), temp_dir, target_dir, silent=silent, debug=debug)
+    # The marker is published last: until then the artifact isn't considered built.
+    pgo_marker = get_pgo_marker(compile_job.profile)
+    pgo_marker_path = _get_pgo_marker_path(compile_job, target_dir)
+    if pgo_marker:
+        staging_pgo_marker_path = _get_pgo_marker_path(compile_job, staging_dir)
+        with staging_pgo_marker_path.open('w') as stream:
+            stream.write(pgo_marker)
+        os.replace(str(staging_pgo_marker_path), str(pgo_marker_path))
+    elif pgo_marker_path.exists():
+        pgo_marker_path.unlink()
 
-            with add_to_sys_path(target_dir):
-                self._pyd_name_to_module[pyd_name] = importlib.import_module(pyd_info.next_pyd_name)
 
-    def _get_pyd_info_from_dir(self, pyd_name, target_dir):
-        # pyd_name is something as: tests_cython_jit__to_cython2_cyjit
-        # file name is something as: tests_cython_jit__to_cython2_cyjit.cp36-win_amd64.pyd
-        found_paths = set()
-        existing_pyd_names_to_filepath = {}
-        latest_pyd_name = None
-        for filepath in target_dir.iterdir():
-            if filepath.name.startswith(pyd_name):
-                found_paths.add(filepath)
-                existing_pyd_names_to_filepath[filepath.name.split('.')[0]] = filepath
+# func_keys: dict(func name -> key) of the functions compiled in the module.
+_CompileJob = namedtuple('_CompileJob', 'pyd_name, module_name, module_contents, profile, func_keys')
+_CompileJob.__new__.__defaults__ = (None,)
 
-        next_pyd_name = pyd_name
-        if existing_pyd_names_to_filepath:
-            version_to_pyd_name = {}
 
-            # Find the latest version compiled
-            for existing_pyd_name in existing_pyd_names_to_filepath:
-                if existing_pyd_name == pyd_name:
-                    version_to_pyd_name[0] = existing_pyd_name
-                else:
-                    try:
-                        version_to_pyd_name[int(existing_pyd_name[len(pyd_name) + 1:])] = existing_pyd_name
-                    except ValueError:
-                        continue
+def build_compile_jobs(compile_jobs, temp_dir, target_dir, silent=False, debug=False, jobs=None, backend=None,
+                       pyd_name_to_duration=None):
+    '''
+    Builds the artifacts for the given jobs (unless already available) and
+    marks them as the latest artifacts for their pyd names in the manifest of
+    the target dir.
 
-            last_version = max(version_to_pyd_name.keys())
-            next_pyd_name = '%s_%04d' % (pyd_name, last_version + 1)
-            latest_pyd_name = version_to_pyd_name[last_version]
+    Many processes may build in the same target dir: a module is only built
+    by one process at a time (the others wait and reuse it) and it's compiled
+    in a staging dir and then moved to the target dir (so, a partially
+    written module is never seen).
 
-            for _version, existing_pyd_name in sorted(version_to_pyd_name.items())[:-1]:
-                self._erase_helper.remove(existing_pyd_names_to_filepath[existing_pyd_name])
+    The intermediate files used to build a module are removed from the temp
+    dir after it's built (unless `debug` is True).
 
-        return _PydInfo(
-            next_pyd_name=next_pyd_name,
-            existing_pyd_names=list(existing_pyd_names_to_filepath.keys()),
-            latest_pyd_name=latest_pyd_name)
+    :param dict(str, float) pyd_name_to_duration:
+        If given, it's filled with the seconds taken to compile each module
+        built (modules already available aren't added).
 
+    :return dict(str, Exception):
+        The pyd name of the modules which failed to compile mapping to the
+        error raised when compiling it.
+    '''
+    import shutil
+    import tempfile
+    from cython_jit._cache import remove_build_intermediates
+    from cython_jit._file_lock import get_module_lock
+    from cython_jit._manifest import update_manifest
+
+    target_dir.mkdir(parents=True, exist_ok=True)
+
+    # Artifacts are content-addressed: if the same contents were already
+    # built with the same toolchain, just reuse it.
+    compile_jobs_to_build = [
+        compile_job for compile_job in compile_jobs if not _is_artifact_built(compile_job, target_dir)]
+
+    # Sorted so that processes building the same modules don't deadlock.
+    module_locks = [
+        get_module_lock(target_dir, module_name)
+        for module_name in sorted(set(compile_job.module_name for compile_job in compile_jobs_to_build))]
+    try:
+        for module_lock in module_locks:
+            module_lock.acquire()
+
+        # Check again (some other process may have built it while we waited).
+        compile_jobs_to_build = [
+            compile_job for compile_job in compile_jobs_to_build if not _is_artifact_built(compile_job, target_dir)]
+        pyd_name_to_error = {}
+        if compile_jobs_to_build:
+            staging_dir = Path(tempfile.mkdtemp(prefix='.staging_', dir=str(target_dir)))
+            try:
+                pyd_name_to_error = _run_compile_jobs(
+                    compile_jobs_to_build, temp_dir, staging_dir, silent, debug, jobs, backend, pyd_name_to_duration)
+                for compile_job in compile_jobs_to_build:
+                    if compile_job.pyd_name not in pyd_name_to_error:
+                        _set_artifact_built(compile_job, staging_dir, target_dir)
+                        if not debug:
+                            remove_build_intermediates(temp_dir / compile_job.module_name)
+            finally:
+                shutil.rmtree(str(staging_dir), ignore_errors=True)
+
+        pyd_name_to_entry = {}
+        for compile_job in compile_jobs:
+            if compile_job.pyd_name not in pyd_name_to_error:
+                pyd_name_to_entry[compile_job.pyd_name] = _get_manifest_entry(compile_job)
+
+        if pyd_name_to_entry:
+            update_manifest(target_dir, pyd_name_to_entry)
+    finally:
+        for module_lock in reversed(module_locks):
+            module_lock.release()
+    return pyd_name_to_error
+
+
+def _compile_timed(*args, **kwargs):
+    '''
+    :return float:
+        The seconds taken to compile (see: `compile_with_cython`).
+    '''
+    import time
+    from cython_jit.compile_with_cython import compile_with_cython
+    initial_time = time.perf_counter()
+    compile_with_cython(*args, **kwargs)
+    return time.perf_counter() - initial_time
+
+
+def _run_compile_jobs(compile_jobs, temp_dir, target_dir, silent, debug, jobs, backend, pyd_name_to_duration=None):
+    '''
+    Compiles each job (concurrently if more than one process is available).
+
+    Each module is built in its own temp directory so that the build
+    artifacts of one job don't clash with the ones from another job.
+
+    :return dict(str, Exception):
+        The pyd name of the modules which failed to compile mapping to the
+        error raised when compiling it.
+    '''
+    import os
+
+    if pyd_name_to_duration is None:
+        pyd_name_to_duration = {}
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, len(compile_jobs))
+
+    def get_compile_args(compile_job):
+        return (
+            compile_job.module_name,
+            compile_job.module_contents,
+            temp_dir / compile_job.module_name,
+            target_dir,
+        )
+
+    pyd_name_to_error = {}
+    if jobs <= 1:
+        for compile_job in compile_jobs:
+            try:
+                pyd_name_to_duration[compile_job.pyd_name] = _compile_timed(
+                    *get_compile_args(compile_job), silent=silent, debug=debug, backend=backend,
+                    profile=compile_job.profile)
+            except Exception as e:
+                pyd_name_to_error[compile_job.pyd_name] = e
+
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            future_to_compile_job = {}
+            for compile_job in compile_jobs:
+                future = executor.submit(
+                    _compile_timed, *get_compile_args(compile_job), silent=silent, debug=debug, backend=backend,
+                    profile=compile_job.profile)
+                future_to_compile_job[future] = compile_job
+
+            for future, compile_job in future_to_compile_job.items():
+                try:
+                    pyd_name_to_duration[compile_job.pyd_name] = future.result()
+                except Exception as e:
+                    pyd_name_to_error[compile_job.pyd_name] = e
 
-_PydInfo = namedtuple('_PydInfo', 'next_pyd_name, existing_pyd_names, latest_pyd_name')
+    return pyd_name_to_error
 
 
 def _get_jit_state_info():
@@ -0,0 +1,210 @@
+'''
+The manifest of a cache dir: an index with the latest module compiled for
+each pyd name (its file, the ABI and cpu it was compiled for and the keys of
+the functions compiled in it).
+
+It's used so that the compiled modules can be found (and loaded directly from
+their files) without scanning the cache dir or changing `sys.path`.
+'''
+from collections import namedtuple
+import sys
+import sysconfig
+
+MANIFEST_NAME = 'cython_jit_manifest.json'
+MANIFEST_LOCK_NAME = 'cython_jit_manifest.lock'
+MANIFEST_VERSION = 2
+
+# filename: the name of the compiled module file (relative to the cache dir).
+# abi: the extension suffix of the python which compiled it.
+# func_keys: dict(func name -> key) of the functions compiled in the module.
+# profile: the fields of the `CompileProfile` used to build the module.
+# cpu: the cpu the module was built for ('' if it runs in any cpu -- see:
+#     `compile_with_cython.get_cpu_key`).
+ManifestEntry = namedtuple('ManifestEntry', 'module_name, filename, abi, func_keys, profile, cpu')
+ManifestEntry.__new__.__defaults__ = (None, '')
+
+
+# Computed on import: sysconfig isn't thread-safe when first initialized.
+_EXT_SUFFIX = sysconfig.get_config_var('EXT_SUFFIX')
+
+
+def get_abi():
+    '''
+    :return str:
+        The extension suffix of the compiled modules of this python.
+    '''
+    return _EXT_SUFFIX
+
+
+def get_manifest_path(cache_dir):
+    return cache_dir / MANIFEST_NAME
+
+
+def get_manifest_lock(cache_dir):
+    '''
+    :return FileLock:
+        The lock held while the manifest is changed.
+    '''
+    from cython_jit._file_lock import FileLock
+    return FileLock(cache_dir / MANIFEST_LOCK_NAME)
+
+
+def read_manifest(cache_dir):
+    '''
+    :return dict(str, ManifestEntry):
+        The entries of the manifest in the given cache dir for each pyd name
+        (empty if there's no manifest or if it can't be read).
+    '''
+    import json
+    try:
+        with get_manifest_path(cache_dir).open() as stream:
+            contents = json.load(stream)
+    except (OSError, ValueError):
+        return {}
+
+    if contents.get('version') != MANIFEST_VERSION:
+        return {}
+    return dict((pyd_name, ManifestEntry(**entry)) for pyd_name, entry in contents['modules'].items())
+
+
+def write_manifest(cache_dir, pyd_name_to_entry):
+    '''
+    Writes the manifest (the file is replaced atomically, so, readers never
+    see a partially written manifest).
+    '''
+    import json
+    import os
+    import tempfile
+
+    fd, temp_path = tempfile.mkstemp(suffix='.tmp', prefix=MANIFEST_NAME, dir=str(cache_dir))
+    try:
+        with os.fdopen(fd, 'w') as stream:
+            json.dump(dict(
+                version=MANIFEST_VERSION,
+                modules=dict((pyd_name, entry._asdict()) for pyd_name, entry in pyd_name_to_entry.items()),
+            ), stream, indent=1, sort_keys=True)
+        os.replace(temp_path, str(get_manifest_path(cache_dir)))
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def update_manifest(cache_dir, pyd_name_to_entry):
+    '''
+    Adds (or replaces) the given entries in the manifest of the cache dir.
+    '''
+    with get_manifest_lock(cache_dir):
+        entries = read_manifest(cache_dir)
+        entries.update(pyd_name_to_entry)
+        write_manifest(cache_dir, entries)
+
+
+def _get_artifact_module_name(path):
+    '''
+    :return str|NoneType:
+        The name of the module of a compiled module (or pgo marker) in the
+        cache dir (or None if it's not one of those).
+    '''
+    module_name, _, suffix = path.name.partition('.')
+    if '_cyjit' not in module_name or not (suffix == 'pgo' or suffix.endswith(('so', 'pyd'))):
+        return None
+    return module_name
+
+
+def remove_unused_artifacts(cache_dir):
+    '''
+    Removes the compiled modules which are no longer referenced by the
+    manifest of the cache dir (older versions of a module).
+
+    Modules which are loaded by live processes (see: `ProcessLease`) or which
+    are being built are kept.
+
+    :return list(pathlib.Path):
+        The files removed.
+    '''
+    from cython_jit._file_lock import get_leased_module_names
+    from cython_jit._file_lock import get_module_lock
+
+    removed = []
+    if not cache_dir.is_dir():
+        return removed
+
+    with get_manifest_lock(cache_dir):
+        in_use = set(entry.module_name for entry in read_manifest(cache_dir).values())
+        in_use.update(get_leased_module_names(cache_dir))
+
+        for path in sorted(cache_dir.iterdir()):
+            module_name = _get_artifact_module_name(path)
+            if module_name is None or module_name in in_use:
+                continue
+
+            module_lock = get_module_lock(cache_dir, module_name)
+            if not module_lock.acquire(blocking=False):
+                continue  # Being built (or loaded) right now.
+            try:
+                if module_name in get_leased_module_names(cache_dir):
+                    continue  # Loaded after the leases were read.
+                path.unlink()
+            except OSError:
+                pass  # i.e.: still loaded by some process on windows.
+            else:
+                removed.append(path)
+            finally:
+                module_lock.release()
+    return removed
+
+
+class ManifestCache(object):
+    '''
+    Keeps the manifests read in memory (a manifest is only read again if its
+    file changed).
+    '''
+
+    def __init__(self):
+        self._cache_dir_to_manifest = {}
+
+    def get_entries(self, cache_dir):
+        '''
+        :return dict(str, ManifestEntry):
+        '''
+        import os
+        try:
+            stat = os.stat(str(get_manifest_path(cache_dir)))
+        except OSError:
+            return {}
+
+        stat_key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        cached = self._cache_dir_to_manifest.get(cache_dir)
+        if cached is not None and cached[0] == stat_key:
+            return cached[1]
+
+        entries = read_manifest(cache_dir)
+        self._cache_dir_to_manifest[cache_dir] = (stat_key, entries)
+        return entries
+
+
+def load_module(module_name, path):
+    '''
+    Loads a compiled module directly from its file (without changing
+    `sys.path`).
+
+    :raise ImportError:
+        If the module can't be loaded.
+    '''
+    import importlib.util
+
+    module = sys.modules.get(module_name)
+    if module is not None:
+        return module
+
+    spec = importlib.util.spec_from_file_location(module_name, str(path))
+    if spec is None:
+        raise ImportError('Unable to load: %s from: %s' % (module_name, path))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[module_name]
+        raise
+    return module
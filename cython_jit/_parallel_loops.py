@@ -0,0 +1,73 @@
+'''
+Finds the loops of a function which may be run in parallel with
+`cython.parallel.prange`.
+'''
+import ast
+import re
+
+_RANGE_LOOP_RE = re.compile(r'^(\s*)for\s+(\w+)\s+in\s+range\((.*)\)\s*:\s*$')
+
+# Statements which may not be inside a prange loop.
+_UNSUPPORTED_NODES = (
+    ast.Return, ast.Break, ast.Yield, ast.YieldFrom, ast.Try, ast.With, ast.Raise,
+    ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.ClassDef,
+    ast.Global, ast.Nonlocal, ast.Delete)
+
+
+def _is_eligible(node, memoryview_arg_names):
+    iter_node = node.iter
+    if not isinstance(node.target, ast.Name) or node.orelse:
+        return False
+    if not isinstance(iter_node, ast.Call) or not isinstance(iter_node.func, ast.Name) or \
+            iter_node.func.id != 'range' or iter_node.keywords or not 1 <= len(iter_node.args) <= 3:
+        return False
+
+    loop_var = node.target.id
+    uses_memoryview = False
+    for stmt in node.body:
+        for child in ast.walk(stmt):
+            if isinstance(child, _UNSUPPORTED_NODES):
+                return False
+            if isinstance(child, ast.Name) and child.id == loop_var and isinstance(child.ctx, ast.Store):
+                return False  # The loop variable may not be changed.
+            if isinstance(child, ast.Subscript) and isinstance(child.value, ast.Name) and \
+                    child.value.id in memoryview_arg_names:
+                uses_memoryview = True
+    return uses_memoryview
+
+
+def get_parallel_loops(func_source, memoryview_arg_names):
+    '''
+    :param str func_source:
+        The source of the function (starting at the `def` line and as seen by
+        cython -- see: `_type_inference.get_inference_source`).
+
+    :param set(str) memoryview_arg_names:
+        The names of the arguments which are typed as memoryviews.
+
+    :return dict(int, str):
+        The (0-based) index of the lines of the function which have an
+        outermost `for <var> in range(...)` loop over memoryviews which may be
+        converted to a `prange` and the loop variable of each one.
+    '''
+    func_node = ast.parse(func_source).body[0]
+    ret = {}
+    for stmt in func_node.body:
+        if isinstance(stmt, ast.For) and _is_eligible(stmt, memoryview_arg_names):
+            ret[stmt.lineno - 1] = stmt.target.id
+    return ret
+
+
+def to_prange_line(line, num_threads=None):
+    '''
+    :return str|NoneType:
+        The given `for <var> in range(...):` line converted to use `prange`
+        (or None if the line has a format which isn't handled).
+    '''
+    match = _RANGE_LOOP_RE.match(line.rstrip())
+    if match is None:
+        return None
+    indent, loop_var, range_args = match.groups()
+    if num_threads is not None:
+        range_args += ', num_threads=%s' % (int(num_threads),)
+    return '%sfor %s in prange(%s):' % (indent, loop_var, range_args)
@@ -0,0 +1,189 @@
+'''
+Extracts from the source of a module only the top-level statements which some
+functions need: the functions themselves and (transitively) the imports,
+constants, helper functions and classes they reference.
+
+Statements which don't define names referenced by those functions (i.e.:
+`main()` calls or `if __name__ == '__main__':` blocks) are not part of the
+slice.
+'''
+from collections import namedtuple
+import ast
+import re
+
+# start: the first line of the statement (including decorators), 0-based.
+# body_start: the first line without the decorators (i.e.: the `def` line).
+# end: the line after the statement.
+# func_name: the name if it's a (top-level) function or None.
+SliceStatement = namedtuple('SliceStatement', 'start, body_start, end, func_name')
+
+
+def _get_defined_names(node):
+    '''
+    :return set(str):
+        The module-level names defined by the given top-level statement ('*'
+        for star imports).
+    '''
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return set([node.name])
+
+    names = set()
+    for child in ast.walk(node):
+        if isinstance(child, (ast.Import, ast.ImportFrom)):
+            for alias in child.names:
+                names.add(alias.asname or alias.name.split('.')[0])
+        elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(child.name)
+        elif isinstance(child, ast.Name) and isinstance(child.ctx, (ast.Store, ast.Del)):
+            names.add(child.id)
+    return names
+
+
+def _get_used_names(node, skip_decorators=False):
+    '''
+    :return set(str):
+        The names read in the given statement (over-approximated: local names
+        of functions are also considered).
+    '''
+    if skip_decorators and isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        nodes = [child for field, child in ast.iter_fields(node) if field != 'decorator_list']
+    else:
+        nodes = [node]
+
+    names = set()
+    while nodes:
+        child = nodes.pop()
+        if isinstance(child, list):
+            nodes.extend(child)
+        elif isinstance(child, ast.AST):
+            if isinstance(child, ast.Name) and isinstance(child.ctx, ast.Load):
+                names.add(child.id)
+            nodes.extend(child for _field, child in ast.iter_fields(child))
+    return names
+
+
+def _get_ifdef_blocks(lines, statement_lines):
+    '''
+    :return list(tuple(int, int)):
+        The (start, end) of the module-level `# IFDEF CYTHON` blocks (which
+        are always kept as they're meant for the compiled version).
+    '''
+    blocks = []
+    start = None
+    for i, line in enumerate(lines):
+        if i in statement_lines:
+            continue
+        if start is None:
+            if line.strip() == '# IFDEF CYTHON' and not line[:1].isspace():
+                start = i
+        elif line.strip() == '# ENDIF':
+            blocks.append((start, i + 1))
+            start = None
+    return blocks
+
+
+def _get_statement_end(node, next_node, lines):
+    '''
+    :return int:
+        The line after the given top-level statement.
+    '''
+    end_lineno = getattr(node, 'end_lineno', None)
+    if end_lineno is not None:
+        return end_lineno
+
+    # Python < 3.8: the statement ends before the next one (without the
+    # blank lines and module-level comments in between).
+    if next_node is None:
+        end = len(lines)
+    else:
+        end = min([next_node.lineno] + [d.lineno for d in getattr(next_node, 'decorator_list', ())]) - 1
+    while end > node.lineno and (not lines[end - 1].strip() or lines[end - 1].startswith('#')):
+        end -= 1
+    return end
+
+
+_DEF_LINE_RE = re.compile(r'\s*(async\s+def|def|class)\b')
+
+
+def _get_def_line(node, lines):
+    '''
+    :return int:
+        The line (0-based) with the `def` or `class` of a decorated statement.
+    '''
+    if hasattr(node, 'end_lineno'):
+        return node.lineno - 1
+
+    # Python < 3.8: node.lineno is the line of the first decorator.
+    for i in range(max(d.lineno for d in node.decorator_list), len(lines)):
+        if _DEF_LINE_RE.match(lines[i]):
+            return i
+    return node.lineno - 1
+
+
+def get_module_slice(source, func_names, jitted_names=()):
+    '''
+    :param str source:
+        The source of the module.
+
+    :param iterable(str) func_names:
+        The names of the top-level functions which must be in the slice.
+
+    :param iterable(str) jitted_names:
+        The names of the functions decorated with `@jit` (their decorators are
+        not considered as they're removed from the generated module).
+
+    :return list(SliceStatement):
+        The statements needed by the given functions (in the order they appear
+        in the source).
+    '''
+    tree = ast.parse(source)
+    lines = source.splitlines()
+    jitted_names = set(jitted_names)
+
+    statements = []
+    for i, node in enumerate(tree.body):
+        if isinstance(node, ast.ImportFrom) and node.module == '__future__':
+            continue  # The generated module has its own header.
+
+        func_name = None
+        start = body_start = node.lineno - 1
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            func_name = node.name
+        if getattr(node, 'decorator_list', None):
+            start = min(decorator.lineno for decorator in node.decorator_list) - 1
+            body_start = _get_def_line(node, lines)
+        next_node = tree.body[i + 1] if i + 1 < len(tree.body) else None
+        statements.append((
+            SliceStatement(start, body_start, _get_statement_end(node, next_node, lines), func_name),
+            _get_defined_names(node),
+            _get_used_names(node, skip_decorators=func_name in jitted_names),
+        ))
+
+    name_to_statements = {}
+    for i, (_statement, defined_names, _used_names) in enumerate(statements):
+        for name in defined_names:
+            name_to_statements.setdefault(name, []).append(i)
+
+    # Star imports may define any name, so, they're always kept.
+    needed = set(name_to_statements.get('*', ()))
+    pending = list(func_names)
+    seen = set()
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        for i in name_to_statements.get(name, ()):
+            if i not in needed:
+                needed.add(i)
+                pending.extend(statements[i][2])
+
+    ret = [statements[i][0] for i in sorted(needed)]
+
+    statement_lines = set()
+    for statement, _defined_names, _used_names in statements:
+        statement_lines.update(range(statement.start, statement.end))
+    for start, end in _get_ifdef_blocks(lines, statement_lines):
+        ret.append(SliceStatement(start, start, end, None))
+
+    return sorted(ret, key=lambda statement: statement.start)
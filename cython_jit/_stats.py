@@ -0,0 +1,285 @@
+'''
+Opt-in runtime statistics of the jitted functions (see:
+`cython_jit.set_stats_enabled`).
+
+For each function the calls are counted (and timed) according to the code
+which actually ran:
+
+- collect: the python function while its types were collected;
+- python: the python function without collecting (i.e.: while it's compiled
+  in the background);
+- compiled: the compiled function.
+
+The time to compile each module in `compile_collected` (or in the background)
+is also recorded.
+
+i.e.:
+    cython_jit.set_stats_enabled()
+    import mymodule  # The functions jitted afterwards are instrumented.
+    ...
+    cython_jit.export_stats('stats.prom', output_format='prometheus')
+'''
+from collections import namedtuple
+
+MODES = ('collect', 'python', 'compiled')
+
+# Reasons for a call not to run the compiled version.
+FALLBACK_NOT_CACHED = 'not_cached'  # The compiled module wasn't found (ModuleNotCachedError).
+FALLBACK_COMPILE_PENDING = 'compile_pending'  # Being compiled in the background.
+
+# The percentiles are computed with the duration of this number of most
+# recent calls.
+MAX_SAMPLES = 1024
+
+# name: the name of the function.
+# module: the name of the python module of the function.
+# calls: the number of calls.
+# total_time: the seconds spent in the calls.
+# p50, p90, p99: the percentiles of the duration of the calls (in seconds).
+# mode_calls: dict(str, int) with the calls for each one of `MODES`.
+# mode_time: dict(str, float) with the seconds spent in each one of `MODES`.
+# stage_calls: dict(str, int) with the calls in each `JitStage` (by name).
+# collect_time: the seconds spent collecting the types (not running the function).
+# fallbacks: dict(str, int) with the number of times each fallback happened.
+FunctionStats = namedtuple(
+    'FunctionStats',
+    'name, module, calls, total_time, p50, p90, p99, mode_calls, mode_time, stage_calls, collect_time, fallbacks')
+
+# pyd_name: the name of the module compiled.
+# module_name: the name of the extension module (with the compile key).
+# duration: the seconds taken to compile it (None if it was already compiled).
+# error: a str with the error if it failed to compile (or None).
+ModuleCompileStats = namedtuple('ModuleCompileStats', 'pyd_name, module_name, duration, error')
+
+# functions: dict(str, FunctionStats) with the module and function name as the key (i.e.: `mymodule.func`).
+# modules: dict(str, ModuleCompileStats) with the pyd name as the key (for the last time it was compiled).
+Stats = namedtuple('Stats', 'functions, modules')
+
+
+def _get_percentile(sorted_samples, percentile):
+    if not sorted_samples:
+        return None
+    i = int(round((len(sorted_samples) - 1) * percentile / 100.))
+    return sorted_samples[i]
+
+
+class FunctionRecorder(object):
+    '''
+    Records the calls of a function (thread-safe).
+    '''
+
+    def __init__(self, name, module):
+        from collections import deque
+        import threading
+        self._name = name
+        self._module = module
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._total_time = 0.0
+        self._samples = deque(maxlen=MAX_SAMPLES)
+        self._mode_calls = {}
+        self._mode_time = {}
+        self._stage_calls = {}
+        self._collect_time = 0.0
+        self._fallbacks = {}
+
+    def record_call(self, stage, mode, duration):
+        with self._lock:
+            self._calls += 1
+            self._total_time += duration
+            self._samples.append(duration)
+            self._mode_calls[mode] = self._mode_calls.get(mode, 0) + 1
+            self._mode_time[mode] = self._mode_time.get(mode, 0.0) + duration
+            self._stage_calls[stage] = self._stage_calls.get(stage, 0) + 1
+
+    def record_collect(self, duration):
+        with self._lock:
+            self._collect_time += duration
+
+    def record_fallback(self, reason):
+        with self._lock:
+            self._fallbacks[reason] = self._fallbacks.get(reason, 0) + 1
+
+    def get_stats(self):
+        '''
+        :return FunctionStats:
+        '''
+        with self._lock:
+            samples = sorted(self._samples)
+            return FunctionStats(
+                name=self._name,
+                module=self._module,
+                calls=self._calls,
+                total_time=self._total_time,
+                p50=_get_percentile(samples, 50),
+                p90=_get_percentile(samples, 90),
+                p99=_get_percentile(samples, 99),
+                mode_calls=dict(self._mode_calls),
+                mode_time=dict(self._mode_time),
+                stage_calls=dict((stage.name, calls) for stage, calls in self._stage_calls.items()),
+                collect_time=self._collect_time,
+                fallbacks=dict(self._fallbacks),
+            )
+
+
+class RuntimeStats(object):
+    '''
+    The statistics of all the jitted functions (and compiled modules).
+    '''
+
+    def __init__(self):
+        import threading
+        self._lock = threading.Lock()
+        self._key_to_recorder = {}
+        self._pyd_name_to_compile_stats = {}
+
+    def get_recorder(self, func):
+        '''
+        :return FunctionRecorder:
+            The recorder for the given (python) function.
+        '''
+        key = '%s.%s' % (func.__module__, func.__name__)
+        with self._lock:
+            recorder = self._key_to_recorder.get(key)
+            if recorder is None:
+                recorder = self._key_to_recorder[key] = FunctionRecorder(func.__name__, func.__module__)
+            return recorder
+
+    def record_compile(self, compile_job, duration, error=None):
+        with self._lock:
+            self._pyd_name_to_compile_stats[compile_job.pyd_name] = ModuleCompileStats(
+                compile_job.pyd_name, compile_job.module_name, duration, None if error is None else str(error))
+
+    def get_stats(self):
+        '''
+        :return Stats:
+        '''
+        with self._lock:
+            key_to_recorder = dict(self._key_to_recorder)
+            modules = dict(self._pyd_name_to_compile_stats)
+        return Stats(
+            dict((key, recorder.get_stats()) for key, recorder in key_to_recorder.items()), modules)
+
+
+def instrument(recorder, func, get_stage_and_mode):
+    '''
+    :param callable() -> tuple(JitStage, str) get_stage_and_mode:
+        Provides the stage and the mode (one of `MODES`) of a call (called
+        before `func`).
+
+    :return callable:
+        A function which calls `func` recording the time of each call.
+    '''
+    from functools import wraps
+    from time import perf_counter
+
+    @wraps(func)
+    def instrumented_method(*args, **kwargs):
+        stage, mode = get_stage_and_mode()
+        initial_time = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            recorder.record_call(stage, mode, perf_counter() - initial_time)
+
+    return instrumented_method
+
+
+def stats_to_json(stats):
+    '''
+    :return dict:
+        The given stats as a dict which may be saved as json.
+    '''
+    return dict(
+        functions=dict((key, function_stats._asdict()) for key, function_stats in stats.functions.items()),
+        modules=dict((pyd_name, module_stats._asdict()) for pyd_name, module_stats in stats.modules.items()),
+    )
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def stats_to_prometheus(stats):
+    '''
+    :return str:
+        The given stats in the Prometheus text exposition format.
+    '''
+    metrics = []  # list(tuple(name, type, help, list(tuple(suffix, labels, value))))
+
+    def add_metric(name, metric_type, help_text):
+        samples = []
+        metrics.append((name, metric_type, help_text, samples))
+        return samples
+
+    calls = add_metric('cython_jit_calls_total', 'counter', 'Calls of jitted functions (by the code which ran).')
+    call_seconds = add_metric(
+        'cython_jit_call_seconds_total', 'counter', 'Seconds spent in jitted functions (by the code which ran).')
+    duration = add_metric(
+        'cython_jit_call_duration_seconds', 'summary', 'Duration of the most recent calls of jitted functions.')
+    stage_calls = add_metric('cython_jit_stage_calls_total', 'counter', 'Calls of jitted functions by jit stage.')
+    collect_seconds = add_metric(
+        'cython_jit_collect_seconds_total', 'counter', 'Seconds spent collecting the types of jitted functions.')
+    fallbacks = add_metric(
+        'cython_jit_fallbacks_total', 'counter', 'Times the compiled version of a jitted function was not used.')
+    compile_seconds = add_metric(
+        'cython_jit_compile_seconds', 'gauge', 'Seconds taken in the last compilation of a module.')
+    compile_failed = add_metric(
+        'cython_jit_compile_failed', 'gauge', 'Whether the last compilation of a module failed.')
+
+    for _key, function_stats in sorted(stats.functions.items()):
+        labels = (('module', function_stats.module), ('function', function_stats.name))
+        for mode, mode_calls in sorted(function_stats.mode_calls.items()):
+            calls.append(('', labels + (('mode', mode),), mode_calls))
+            call_seconds.append(('', labels + (('mode', mode),), function_stats.mode_time[mode]))
+        for percentile in ('p50', 'p90', 'p99'):
+            value = getattr(function_stats, percentile)
+            if value is not None:
+                duration.append(('', labels + (('quantile', '0.%s' % (percentile[1:],)),), value))
+        duration.append(('_sum', labels, function_stats.total_time))
+        duration.append(('_count', labels, function_stats.calls))
+        for stage, count in sorted(function_stats.stage_calls.items()):
+            stage_calls.append(('', labels + (('stage', stage),), count))
+        collect_seconds.append(('', labels, function_stats.collect_time))
+        for reason, count in sorted(function_stats.fallbacks.items()):
+            fallbacks.append(('', labels + (('reason', reason),), count))
+
+    for pyd_name, module_stats in sorted(stats.modules.items()):
+        labels = (('module', pyd_name),)
+        if module_stats.duration is not None:
+            compile_seconds.append(('', labels, module_stats.duration))
+        compile_failed.append(('', labels, 0 if module_stats.error is None else 1))
+
+    lines = []
+    for name, metric_type, help_text, samples in metrics:
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        for suffix, labels, value in samples:
+            lines.append('%s%s{%s} %r' % (name, suffix, ','.join(
+                '%s="%s"' % (label, _escape_label_value(label_value)) for label, label_value in labels), value))
+    return '\n'.join(lines) + '\n'
+
+
+def export_stats(stats, path, output_format='json'):
+    '''
+    Saves the given stats to a file.
+
+    :param str output_format:
+        'json' or 'prometheus' (the text exposition format, i.e.: for the
+        node exporter textfile collector).
+    '''
+    import io
+    import json
+    import os
+    if output_format == 'json':
+        contents = json.dumps(stats_to_json(stats), indent=2, sort_keys=True)
+    elif output_format == 'prometheus':
+        contents = stats_to_prometheus(stats)
+    else:
+        raise AssertionError('Unexpected output format: %s (expected json or prometheus).' % (output_format,))
+
+    # Written to a temp file and renamed so that readers never see a partial file.
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with io.open(tmp_path, 'w', encoding='utf-8') as stream:
+        stream.write(contents)
+    os.replace(tmp_path, str(path))
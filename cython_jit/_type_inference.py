@@ -0,0 +1,363 @@
+'''
+Infers the cython types of the local variables of a function (based on the
+types of its arguments) so that `cdef` declarations can be generated for
+loop counters, accumulators and temporaries.
+'''
+import ast
+import re
+
+# Integer types ordered by rank (when joining 2 different integer types the
+# one with the higher rank is used).
+_INT_TYPES = (
+    'bint',
+    'int8_t',
+    'uint8_t',
+    'int16_t',
+    'uint16_t',
+    'int32_t',
+    'uint32_t',
+    'int64_t',
+    'Py_ssize_t',
+)
+
+_FLOAT_TYPES = ('float', 'double')
+
+# Marks a variable whose type can't be inferred.
+_UNKNOWN = object()
+
+
+def _join_types(type1, type2):
+    '''
+    :return str|NoneType:
+        The type which can hold values of both types (None if there's no such
+        type).
+    '''
+    if type1 is None or type2 is None:
+        return None
+    if type1 == type2:
+        return type1
+
+    if type1 in _INT_TYPES and type2 in _INT_TYPES:
+        return max(type1, type2, key=_INT_TYPES.index)
+
+    if type1 in _INT_TYPES + _FLOAT_TYPES and type2 in _INT_TYPES + _FLOAT_TYPES:
+        return 'double'
+
+    return None
+
+
+def _get_memoryview_info(cython_type):
+    '''
+    :return tuple(str, int)|NoneType:
+        The item type and the number of dimensions of a memoryview type
+        (i.e.: 'double[:, ::1]' -> ('double', 2)) or None if it's not a
+        memoryview.
+    '''
+    if not cython_type.endswith(']') or '[' not in cython_type:
+        return None
+    item_type, dims = cython_type[:-1].split('[', 1)
+    return item_type.strip(), len(dims.split(','))
+
+
+class _ExprTypeInference(object):
+
+    def __init__(self, name_to_type):
+        self._name_to_type = name_to_type
+
+    def get_type(self, node):
+        method = getattr(self, '_get_type_%s' % (node.__class__.__name__,), None)
+        if method is None:
+            return None
+        return method(node)
+
+    def _get_type_Constant(self, node):
+        if isinstance(node.value, bool):
+            return 'bint'
+        if isinstance(node.value, int):
+            return 'Py_ssize_t'
+        if isinstance(node.value, float):
+            return 'double'
+        return None
+
+    def _get_type_Num(self, node):  # Python < 3.8
+        return self._get_type_Constant(ast.Constant(value=node.n))
+
+    def _get_type_NameConstant(self, node):  # Python < 3.8
+        return self._get_type_Constant(ast.Constant(value=node.value))
+
+    def _get_type_Name(self, node):
+        ret = self._name_to_type.get(node.id)
+        if ret is _UNKNOWN:
+            return None
+        return ret
+
+    def _get_type_Subscript(self, node):
+        # arr.shape[0]
+        if isinstance(node.value, ast.Attribute) and node.value.attr == 'shape' and \
+                isinstance(node.value.value, ast.Name):
+            name_type = self._get_type_Name(node.value.value)
+            if name_type is not None and _get_memoryview_info(name_type) is not None:
+                return 'Py_ssize_t'
+            return None
+
+        # arr[i, j]
+        if not isinstance(node.value, ast.Name):
+            return None
+        name_type = self._get_type_Name(node.value)
+        if name_type is None:
+            return None
+        memoryview_info = _get_memoryview_info(name_type)
+        if memoryview_info is None:
+            return None
+
+        item_type, ndim = memoryview_info
+        index = node.slice
+        if isinstance(index, ast.Index):  # Python < 3.9
+            index = index.value
+        indexes = index.elts if isinstance(index, ast.Tuple) else [index]
+        if len(indexes) != ndim or any(isinstance(x, ast.Slice) for x in indexes):
+            return None  # Not a single item.
+        if item_type not in _INT_TYPES + _FLOAT_TYPES:
+            return None
+        return item_type
+
+    def _get_type_BinOp(self, node):
+        left = self.get_type(node.left)
+        right = self.get_type(node.right)
+        joined = _join_types(left, right)
+        if joined is None:
+            return None
+
+        if isinstance(node.op, ast.Div):
+            return 'double'
+        if isinstance(node.op, (ast.Add, ast.Sub, ast.Mult, ast.FloorDiv, ast.Mod)):
+            return 'Py_ssize_t' if joined == 'bint' else joined
+        if isinstance(node.op, (ast.BitAnd, ast.BitOr, ast.BitXor, ast.LShift, ast.RShift)):
+            return joined if joined in _INT_TYPES else None
+        return None
+
+    def _get_type_UnaryOp(self, node):
+        if isinstance(node.op, ast.Not):
+            return 'bint'
+        if isinstance(node.op, (ast.USub, ast.UAdd)):
+            return self.get_type(node.operand)
+        return None
+
+    def _get_type_Compare(self, node):
+        return 'bint'
+
+    def _get_type_IfExp(self, node):
+        return _join_types(self.get_type(node.body), self.get_type(node.orelse))
+
+    def _get_type_Call(self, node):
+        if not isinstance(node.func, ast.Name) or node.keywords:
+            return None
+        func_name = node.func.id
+        if func_name == 'len' and len(node.args) == 1:
+            return 'Py_ssize_t'
+        if func_name == 'float' and len(node.args) == 1:
+            return 'double'
+        if func_name == 'abs' and len(node.args) == 1:
+            return self.get_type(node.args[0])
+        if func_name in ('min', 'max') and len(node.args) >= 2:
+            ret = self.get_type(node.args[0])
+            for arg in node.args[1:]:
+                ret = _join_types(ret, self.get_type(arg))
+            return ret
+        return None
+
+
+class _AssignmentsCollector(ast.NodeVisitor):
+    '''
+    Collects the assignments to local names in the function body (without
+    entering nested scopes).
+    '''
+
+    def __init__(self):
+        self.name_to_exprs = {}
+        self.untypeable_names = set()
+
+    def _add(self, name, expr):
+        self.name_to_exprs.setdefault(name, []).append(expr)
+
+    def _mark_untypeable(self, target, stored_only=True):
+        for node in ast.walk(target):
+            if isinstance(node, ast.Name) and (not stored_only or isinstance(node.ctx, ast.Store)):
+                self.untypeable_names.add(node.id)
+
+    def visit_Assign(self, node):
+        for target in node.targets:
+            if isinstance(target, ast.Name):
+                self._add(target.id, node.value)
+            else:
+                self._mark_untypeable(target)
+        self.generic_visit(node)
+
+    def visit_AugAssign(self, node):
+        if isinstance(node.target, ast.Name):
+            self._add(node.target.id, ast.BinOp(left=ast.Name(id=node.target.id, ctx=ast.Load()),
+                                                op=node.op, right=node.value))
+        else:
+            self._mark_untypeable(node.target)
+        self.generic_visit(node)
+
+    def visit_AnnAssign(self, node):
+        self._mark_untypeable(node.target)
+        self.generic_visit(node)
+
+    def visit_For(self, node):
+        iter_node = node.iter
+        if isinstance(node.target, ast.Name) and isinstance(iter_node, ast.Call) and \
+                isinstance(iter_node.func, ast.Name) and iter_node.func.id == 'range' and \
+                not iter_node.keywords and 1 <= len(iter_node.args) <= 3:
+            self._add(node.target.id, ast.Constant(value=0))
+        else:
+            self._mark_untypeable(node.target)
+        self.generic_visit(node)
+
+    def visit_With(self, node):
+        for item in node.items:
+            if item.optional_vars is not None:
+                self._mark_untypeable(item.optional_vars)
+        self.generic_visit(node)
+
+    def visit_ExceptHandler(self, node):
+        if node.name:
+            self.untypeable_names.add(node.name)
+        self.generic_visit(node)
+
+    def visit_Delete(self, node):
+        for target in node.targets:
+            if isinstance(target, ast.Name):
+                self.untypeable_names.add(target.id)
+
+    def visit_Global(self, node):
+        self.untypeable_names.update(node.names)
+
+    visit_Nonlocal = visit_Global
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self.untypeable_names.add((alias.asname or alias.name).split('.')[0])
+
+    visit_ImportFrom = visit_Import
+
+    def _visit_nested_scope(self, node):
+        # Names used in nested scopes (closures) are kept as python objects.
+        self._mark_untypeable(node, stored_only=False)
+
+    visit_FunctionDef = visit_AsyncFunctionDef = visit_Lambda = visit_ClassDef = _visit_nested_scope
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = _visit_nested_scope
+
+
+def get_inference_source(func_lines):
+    '''
+    :param list(str) func_lines:
+        The original lines of the function (i.e.: before `fix_cython_ifdefs`).
+
+    :return str:
+        The (dedented) source of the function as seen by cython: the lines in
+        the `# ELSE` part of `# IFDEF CYTHON` blocks are replaced by `pass`.
+    '''
+    import textwrap
+    state = 'regular'
+    lines = []
+    for line in func_lines:
+        strip = line.strip()
+        if state == 'regular' and strip == '# IFDEF CYTHON':
+            state = 'cython'
+        elif state == 'cython' and strip == '# ELSE':
+            state = 'nocython'
+        elif state in ('cython', 'nocython') and strip == '# ENDIF':
+            state = 'regular'
+        elif state == 'nocython' and strip:
+            line = line[:len(line) - len(line.lstrip())] + 'pass\n'
+        lines.append(line.rstrip() + '\n')
+    return textwrap.dedent(''.join(lines))
+
+
+def get_declared_names(cython_func_lines):
+    '''
+    :param list(str) cython_func_lines:
+        The lines of the function as seen by cython.
+
+    :return set(str):
+        The names already declared in `cdef` statements.
+    '''
+    declared = set()
+    for line in cython_func_lines[1:]:
+        strip = line.strip()
+        if strip.startswith('cdef '):
+            for chunk in strip[len('cdef '):].split(','):
+                names = re.findall(r'\w+', chunk.split('=')[0])
+                if names:
+                    declared.add(names[-1])
+    return declared
+
+
+def infer_local_types(func_source, arg_name_to_type, declared_names=()):
+    '''
+    :param str func_source:
+        The source of the function (starting at the `def` line).
+
+    :param dict(str, str) arg_name_to_type:
+        The cython types of the arguments.
+
+    :param set(str) declared_names:
+        Names which already have a declaration (and shouldn't be inferred).
+
+    :return dict(str, str):
+        The local variable names and their inferred cython types (only
+        variables for which the type could be inferred in all the
+        assignments are returned).
+    '''
+    func_node = ast.parse(func_source).body[0]
+    collector = _AssignmentsCollector()
+    for stmt in func_node.body:
+        collector.visit(stmt)
+
+    name_to_type = dict(arg_name_to_type)
+    local_names = [
+        name for name in collector.name_to_exprs
+        if name not in arg_name_to_type and name not in declared_names and name not in collector.untypeable_names]
+
+    # Iterate until a fixed point is reached (types may only be widened).
+    for _i in range(10):
+        changed = False
+        expr_type_inference = _ExprTypeInference(name_to_type)
+        for name in local_names:
+            if name_to_type.get(name) is _UNKNOWN:
+                continue
+
+            new_type = name_to_type.get(name)
+            for expr in collector.name_to_exprs[name]:
+                expr_type = expr_type_inference.get_type(expr)
+                if expr_type is None:
+                    if name not in name_to_type:
+                        # Its type may still depend on other locals.
+                        continue
+                    new_type = _UNKNOWN
+                    break
+                new_type = expr_type if new_type is None else _join_types(new_type, expr_type)
+                if new_type is None:
+                    new_type = _UNKNOWN
+                    break
+
+            if new_type is not None and new_type != name_to_type.get(name):
+                name_to_type[name] = new_type
+                changed = True
+
+        if not changed:
+            break
+
+    ret = {}
+    expr_type_inference = _ExprTypeInference(name_to_type)
+    for name in local_names:
+        local_type = name_to_type.get(name)
+        if local_type is None or local_type is _UNKNOWN:
+            continue
+        # All the assignments must be typed with the final types.
+        if all(_join_types(local_type, expr_type_inference.get_type(expr)) == local_type
+               for expr in collector.name_to_exprs[name]):
+            ret[name] = local_type
+    return ret
@@ -0,0 +1,451 @@
+'''
+Type profiles: the information collected for the jitted functions saved to
+disk so that the functions may be compiled later on (possibly in another
+machine) without importing the application.
+
+i.e.:
+    # In each process collecting information:
+    cython_jit.save_type_profile('profiles/%s.json' % (os.getpid(),))
+
+    # In the build host:
+    python -m cython_jit compile --profile profiles --cache-dir <cache_dir>
+'''
+from collections import namedtuple
+import sys
+
+TYPE_PROFILE_VERSION = 1
+
+
+def create_type_profile(collectors):
+    '''
+    :param list(CythonJitInfoCollector) collectors:
+    :return dict:
+        The type profile with the functions which had information collected.
+    '''
+    return dict(
+        version=TYPE_PROFILE_VERSION,
+        python='%s.%s' % sys.version_info[:2],
+        functions=[collector.to_type_profile() for collector in collectors if collector.collected_info()],
+    )
+
+
+def save_type_profile(path, type_profile):
+    '''
+    Saves the given type profile as json (the file is replaced atomically).
+
+    :param pathlib.Path path:
+    :param dict type_profile:
+    '''
+    import json
+    import os
+    import tempfile
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(suffix='.tmp', prefix=path.name, dir=str(path.parent))
+    try:
+        with os.fdopen(fd, 'w') as stream:
+            json.dump(type_profile, stream, indent=1, sort_keys=True)
+        os.replace(temp_path, str(path))
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def load_type_profile(path):
+    '''
+    :param pathlib.Path path:
+    :return dict:
+    '''
+    import json
+    with path.open() as stream:
+        type_profile = json.load(stream)
+    if type_profile.get('version') != TYPE_PROFILE_VERSION:
+        raise AssertionError('Unexpected type profile version in %s (expected: %s, found: %s).' % (
+            path, TYPE_PROFILE_VERSION, type_profile.get('version')))
+    return type_profile
+
+
+def load_type_profiles(paths):
+    '''
+    :param list(pathlib.Path) paths:
+        Type profile files or directories (in which case all the `.json`
+        files in the directory are loaded).
+
+    :return dict:
+        The merged type profile.
+    '''
+    type_profiles = []
+    for path in paths:
+        if path.is_dir():
+            type_profiles.extend(load_type_profile(p) for p in sorted(path.glob('*.json')))
+        else:
+            type_profiles.append(load_type_profile(path))
+    return merge_type_profiles(type_profiles)
+
+
+def merge_type_profiles(type_profiles):
+    '''
+    Merges type profiles (i.e.: collected in different processes).
+
+    The signatures of the same function (with the same key) are merged (the
+    number of calls is summed) and the signatures with more calls are used
+    first (up to the maximum number of signatures of the function).
+
+    :param list(dict) type_profiles:
+    :return dict:
+    '''
+    import copy
+    from cython_jit._info_collector import CythonJitInfoCollector
+
+    pythons = set(type_profile['python'] for type_profile in type_profiles)
+    if len(pythons) > 1:
+        raise AssertionError('Unable to merge type profiles from different python versions: %s' % (
+            ', '.join(sorted(pythons)),))
+
+    func_id_to_func_profile = {}
+    for type_profile in type_profiles:
+        for func_profile in type_profile['functions']:
+            func_id = (func_profile['module'], func_profile['name'], func_profile['key'])
+            merged = func_id_to_func_profile.get(func_id)
+            if merged is None:
+                func_id_to_func_profile[func_id] = copy.deepcopy(func_profile)
+                continue
+
+            merged['c_imports'] = sorted(set(merged['c_imports']).union(func_profile['c_imports']))
+            arg_types_to_signature = dict(
+                (repr(signature['arg_types']), signature) for signature in merged['signatures'])
+            for signature in func_profile['signatures']:
+                merged_signature = arg_types_to_signature.get(repr(signature['arg_types']))
+                if merged_signature is None:
+                    merged['signatures'].append(copy.deepcopy(signature))
+                    continue
+                merged_signature['count'] += signature['count']
+                for arg_name, checks in signature['checks'].items():
+                    merged_signature['checks'][arg_name] = sorted(
+                        set(merged_signature['checks'].get(arg_name, ())).union(checks))
+
+    functions = []
+    for _func_id, func_profile in sorted(func_id_to_func_profile.items()):
+        jit_options = func_profile['jit_options']
+        max_signatures = jit_options['max_signatures']
+        if max_signatures is None:
+            max_signatures = CythonJitInfoCollector.DEFAULT_MAX_SIGNATURES
+        if jit_options['vectorize']:
+            max_signatures = 1
+        func_profile['signatures'] = sorted(
+            func_profile['signatures'], key=lambda signature: -signature['count'])[:max(1, max_signatures)]
+        functions.append(func_profile)
+
+    return dict(
+        version=TYPE_PROFILE_VERSION,
+        python=next(iter(pythons)) if pythons else '%s.%s' % sys.version_info[:2],
+        functions=functions,
+    )
+
+
+# non_literal_options: the names of the options passed to `jit()` which aren't
+# literals (so, their value isn't known without importing the module).
+_JitDecoratedFunction = namedtuple('_JitDecoratedFunction', 'name, first_line, jit_options, node, non_literal_options')
+
+
+def find_jit_decorated_functions(source):
+    '''
+    :param str source:
+        The source of a module.
+
+    :return list(_JitDecoratedFunction):
+        The functions decorated with `@jit(...)`, with the first line (of the
+        first decorator, as in `code.co_firstlineno`), the options passed to
+        `jit()` (only the ones given as literals), the ast node and the names
+        of the options which aren't literals.
+    '''
+    import ast
+
+    ret = []
+    for node in ast.walk(ast.parse(source)):
+        if not isinstance(node, ast.FunctionDef):
+            continue
+        for decorator in node.decorator_list:
+            call = decorator if isinstance(decorator, ast.Call) else None
+            func = decorator.func if call is not None else decorator
+            name = func.id if isinstance(func, ast.Name) else func.attr if isinstance(func, ast.Attribute) else None
+            if name != 'jit':
+                continue
+
+            jit_options = {}
+            non_literal_options = []
+            if call is not None:
+                for keyword in call.keywords:
+                    try:
+                        jit_options[keyword.arg] = ast.literal_eval(keyword.value)
+                    except ValueError:
+                        non_literal_options.append(keyword.arg)
+            first_line = min(d.lineno for d in node.decorator_list)
+            ret.append(_JitDecoratedFunction(node.name, first_line, jit_options, node, tuple(non_literal_options)))
+            break
+    return ret
+
+
+def get_signature_from_ast(node, source):
+    '''
+    :param ast.FunctionDef node:
+    :param str source:
+        The source of the module with the function.
+
+    :return inspect.Signature:
+        The signature of the function (the defaults which aren't literals and
+        the annotations which aren't strings are represented by their source,
+        see: `_Repr`).
+    '''
+    import ast
+    import inspect
+    from cython_jit._info_collector import _Repr
+    from cython_jit._info_collector import get_def_arg_sources
+
+    # Note: node.lineno is the line of the first decorator in Python < 3.8
+    # (the decorators are skipped when getting the sources).
+    def_arg_sources = get_def_arg_sources(''.join(source.splitlines(True)[node.lineno - 1:]))
+
+    def get_annotation(annotation, annotation_source):
+        if annotation is None:
+            return inspect.Parameter.empty
+        try:
+            value = ast.literal_eval(annotation)
+        except ValueError:
+            pass
+        else:
+            if isinstance(value, str):
+                return value
+        return _Repr(annotation_source)
+
+    def get_arg_annotation(arg):
+        return get_annotation(arg.annotation, def_arg_sources.arg_name_to_annotation.get(arg.arg))
+
+    def get_default(arg, default):
+        if default is None:
+            return inspect.Parameter.empty
+        try:
+            # The value (and not its source) is used so that the signature
+            # (used in the key) is the same one from the imported function.
+            return ast.literal_eval(default)
+        except ValueError:
+            return _Repr(def_arg_sources.arg_name_to_default[arg.arg])
+
+    args = node.args
+    positional = [(arg, inspect.Parameter.POSITIONAL_ONLY) for arg in getattr(args, 'posonlyargs', [])] + \
+        [(arg, inspect.Parameter.POSITIONAL_OR_KEYWORD) for arg in args.args]
+    defaults = [None] * (len(positional) - len(args.defaults)) + list(args.defaults)
+
+    parameters = []
+    for (arg, kind), default in zip(positional, defaults):
+        parameters.append(inspect.Parameter(
+            arg.arg, kind, default=get_default(arg, default), annotation=get_arg_annotation(arg)))
+    if args.vararg is not None:
+        parameters.append(inspect.Parameter(
+            args.vararg.arg, inspect.Parameter.VAR_POSITIONAL, annotation=get_arg_annotation(args.vararg)))
+    for arg, default in zip(args.kwonlyargs, args.kw_defaults):
+        parameters.append(inspect.Parameter(
+            arg.arg, inspect.Parameter.KEYWORD_ONLY, default=get_default(arg, default),
+            annotation=get_arg_annotation(arg)))
+    if args.kwarg is not None:
+        parameters.append(inspect.Parameter(
+            args.kwarg.arg, inspect.Parameter.VAR_KEYWORD, annotation=get_arg_annotation(args.kwarg)))
+    return inspect.Signature(
+        parameters, return_annotation=get_annotation(node.returns, def_arg_sources.return_annotation))
+
+
+def find_function_code(module_code, func_name):
+    '''
+    :return code|NoneType:
+        The code of the function with the given name (searched in the code
+        of the module and in the code of its classes/functions).
+    '''
+    import types
+    for const in module_code.co_consts:
+        if isinstance(const, types.CodeType):
+            if const.co_name == func_name:
+                return const
+            found = find_function_code(const, func_name)
+            if found is not None:
+                return found
+    return None
+
+
+def find_module_file(module_name, filename, source_paths):
+    '''
+    :param str module_name:
+    :param str filename:
+        The file of the module where the information was collected.
+    :param list(pathlib.Path) source_paths:
+        Directories where the module should be searched if the filename
+        doesn't exist (i.e.: when compiling in another machine).
+
+    :return pathlib.Path|NoneType:
+    '''
+    from pathlib import Path
+    path = Path(filename)
+    if path.exists():
+        return path
+
+    module_path = Path(*module_name.split('.'))
+    for source_path in source_paths:
+        for candidate in (source_path / module_path.with_suffix('.py'), source_path / module_path / '__init__.py'):
+            if candidate.exists():
+                return candidate
+    return None
+
+
+def create_module_collectors(module_name, path, func_profiles=(), use_annotations=False):
+    '''
+    Creates the collectors for the jitted functions of a module (from its
+    current source, without importing it).
+
+    :param list(dict) func_profiles:
+        The type profiles of functions of the module.
+
+    :param bool use_annotations:
+        If True, functions which are not in `func_profiles` but have string
+        annotations (cython types) for all the arguments and the return are
+        also compiled.
+
+    :return tuple(list(CythonJitInfoCollector), list(dict)):
+        The collectors and the functions in the profile which are stale (the
+        function changed since the profile was collected). Note that collectors
+        (without collected information) are also created for the other
+        jitted functions so that they're kept as regular python functions in
+        the compiled modules.
+    '''
+    import types
+    from cython_jit import JitStage
+    from cython_jit._info_collector import CythonJitInfoCollector
+
+    source = path.read_text()
+    module_code = compile(source, str(path), 'exec')
+
+    collectors = []
+    stale = []
+    profiled_names = set()
+    for func_profile in func_profiles:
+        if func_profile['name'] in profiled_names:
+            stale.append(func_profile)  # Another version of the function was already used.
+            continue
+
+        code = find_function_code(module_code, func_profile['name'])
+        collector = None
+        if code is not None:
+            collector = CythonJitInfoCollector.from_type_profile(func_profile, code)
+        if collector is None or collector.key != func_profile['key']:
+            stale.append(func_profile)
+            continue
+        profiled_names.add(func_profile['name'])
+        collectors.append(collector)
+
+    for jit_decorated in find_jit_decorated_functions(source):
+        if jit_decorated.name in profiled_names:
+            continue
+        code = find_function_code(module_code, jit_decorated.name)
+        if code is None:
+            # i.e.: defined in code which the compiler removes (such as `if 0:`).
+            continue
+        func = types.FunctionType(code, {'__name__': module_name}, jit_decorated.name)
+        func.__signature__ = get_signature_from_ast(jit_decorated.node, source)
+        collector = None
+        if use_annotations:
+            collector = CythonJitInfoCollector.from_annotations(func, jit_decorated.jit_options)
+            if collector is not None:
+                _check_key_from_source(module_name, jit_decorated, func)
+        if collector is None:
+            collector = CythonJitInfoCollector(func, nogil=False, jit_stage=JitStage.collect_info, register=False)
+        collectors.append(collector)
+
+    return collectors, stale
+
+
+def _check_key_from_source(module_name, jit_decorated, func):
+    '''
+    :raise AssertionError:
+        If the function has `jit()` options or defaults which aren't literals
+        (the key of the function when it's imported depends on their values,
+        so, the compiled version would never be used).
+    '''
+    from cython_jit._info_collector import _Repr
+
+    non_literal_defaults = [
+        name for name, param in func.__signature__.parameters.items() if isinstance(param.default, _Repr)]
+    if jit_decorated.non_literal_options or non_literal_defaults:
+        raise AssertionError(
+            'Unable to compile %s.%s from its annotations: the options passed to jit() and the defaults must be '
+            'literals (found options: %s, defaults: %s).' % (
+                module_name, jit_decorated.name, ', '.join(jit_decorated.non_literal_options) or '-',
+                ', '.join(non_literal_defaults) or '-'))
+
+
+def check_python_version(type_profile):
+    '''
+    :raise AssertionError:
+        If the type profile was collected in another python version (the
+        keys of the functions depend on the python version, so, all of them
+        would be considered stale).
+    '''
+    python = '%s.%s' % sys.version_info[:2]
+    if type_profile['python'] != python:
+        raise AssertionError(
+            'The type profile was collected in python %s (it must be compiled with the same python version, '
+            'found: %s).' % (type_profile['python'], python))
+
+
+def create_collectors(type_profile, source_paths=()):
+    '''
+    Creates the collectors for the functions in the type profile (see:
+    `create_module_collectors`).
+
+    :return tuple(list(CythonJitInfoCollector), list(dict)):
+        The collectors and the functions in the profile which are stale (the
+        function changed or its module wasn't found).
+
+    :raise AssertionError:
+        If the type profile was collected in another python version.
+    '''
+    from collections import defaultdict
+
+    check_python_version(type_profile)
+    module_to_func_profiles = defaultdict(list)
+    for func_profile in type_profile['functions']:
+        module_to_func_profiles[func_profile['module']].append(func_profile)
+
+    collectors = []
+    stale = []
+    for module_name, func_profiles in sorted(module_to_func_profiles.items()):
+        path = find_module_file(module_name, func_profiles[0]['filename'], source_paths)
+        if path is None:
+            stale.extend(func_profiles)
+            continue
+
+        module_collectors, module_stale = create_module_collectors(module_name, path, func_profiles)
+        collectors.extend(module_collectors)
+        stale.extend(module_stale)
+
+    return collectors, stale
+
+
+def compile_type_profile(type_profile, source_paths=(), silent=False, debug=False, jobs=None, backend=None,
+                         profile=None):
+    '''
+    Compiles the modules of the functions in the given type profile (to the
+    cache dir -- see: `cython_jit.set_cache_dir`).
+
+    :return tuple(dict(str, str), list(dict)):
+        The errors for each module which failed to compile and the functions
+        which were not compiled because they're stale (see: `create_collectors`).
+    '''
+    import cython_jit
+    from cython_jit._jit_state_info import _get_jit_state_info
+    from cython_jit._jit_state_info import build_compile_jobs
+
+    collectors, stale = create_collectors(type_profile, source_paths)
+    compile_jobs = _get_jit_state_info()._create_compile_jobs(
+        debug=debug, backend=backend, profile=profile, collectors=collectors)
+    pyd_name_to_error = build_compile_jobs(
+        compile_jobs, cython_jit.get_temp_dir(), cython_jit.get_cache_dir(), silent=silent, debug=debug, jobs=jobs,
+        backend=backend)
+    return pyd_name_to_error, stale
@@ -0,0 +1,54 @@
+'''
+Helpers for the functions decorated with `jit(vectorize=True)`: the scalar
+function is applied element-wise to (broadcast) arrays.
+'''
+import sys
+
+
+def call_element_wise(collector, func, args, kwargs, collect=True):
+    '''
+    Calls the (python) scalar function for each element of the given
+    arguments (used when the compiled version is still not available).
+
+    :param CythonJitInfoCollector collector:
+    :param bool collect:
+        Whether the types of the call (of the first element) should be
+        collected.
+
+    :return:
+        The result of the scalar function if only scalars were passed or an
+        array with the result for each element (the `out` array if given).
+    '''
+    out = kwargs.pop('out', None)
+    arg_values = list(collector.bind_arguments(args, kwargs).values())
+
+    numpy = sys.modules.get('numpy')
+    if numpy is None or (out is None and all(numpy.ndim(value) == 0 for value in arg_values)):
+        if collect:
+            collector.collect_args(arg_values, {})
+        ret = func(*arg_values)
+        if collect:
+            collector.collect_return(ret)
+        return ret
+
+    arrays = numpy.broadcast_arrays(*[numpy.asarray(value) for value in arg_values])
+    shape = arrays[0].shape if arrays else ()
+    first = True
+    for index in numpy.ndindex(shape):
+        element_args = [array[index] for array in arrays]
+        if first and collect:
+            collector.collect_args(element_args, {})
+        ret = func(*element_args)
+        if first:
+            if collect:
+                collector.collect_return(ret)
+            if out is None:
+                out = numpy.empty(shape, dtype=numpy.asarray(ret).dtype)
+            elif out.shape != shape:
+                raise ValueError('Expected out to have shape: %s (found: %s).' % (shape, out.shape))
+            first = False
+        out[index] = ret
+
+    if out is None:
+        out = numpy.empty(shape)  # No elements.
+    return out
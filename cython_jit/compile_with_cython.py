@@ -1,4 +1,5 @@
 import os
+from collections import namedtuple
 from contextlib import contextmanager
 
 
@@ -13,13 +14,281 @@ def working_directory(path):
         os.chdir(prev_cwd)
 
 
-def compile_with_cython(module_name, module_contents, temp_dir, target_dir, silent=False, debug=False):
+class CythonizeError(RuntimeError):
+    pass
+
+
+def get_default_backend():
+    '''
+    :return str:
+        'inprocess' if the C compiler can be gotten from sysconfig (which
+        isn't the case on Windows) and 'subprocess' otherwise.
+    '''
+    import sys
+    import sysconfig
+    if sys.platform != 'win32' and sysconfig.get_config_var('CC') and sysconfig.get_config_var('LDSHARED'):
+        return 'inprocess'
+    return 'subprocess'
+
+
+# Optimization options passed to the C compiler when building a module.
+#
+# opt_level: str with the optimization level (i.e.: '2', '3', 's').
+# march/mtune: str with the target cpu (i.e.: 'native').
+# fast_math: bool (note: may change the results of floating point operations).
+# lto: bool (link time optimization).
+# openmp: bool.
+# pgo: None, 'generate' or 'use' (profile-guided optimization with gcc: build
+#     with 'generate', run a representative workload and rebuild with 'use').
+# pgo_dir: str with the directory where the profile data is written/read
+#     (if None, a 'pgo' directory inside the temp dir of the module is used).
+CompileProfile = namedtuple('CompileProfile', 'opt_level, march, mtune, fast_math, lto, openmp, pgo, pgo_dir')
+CompileProfile.__new__.__defaults__ = (None, None, None, False, False, False, None, None)
+
+PROFILES = {
+    'default': CompileProfile(),
+    'fast': CompileProfile(opt_level='3'),
+    'native': CompileProfile(opt_level='3', march='native', mtune='native'),
+    'aggressive': CompileProfile(opt_level='3', march='native', mtune='native', fast_math=True, lto=True),
+}
+
+
+def get_profile(profile):
+    '''
+    :param str|CompileProfile|NoneType profile:
+        The name of a profile in `PROFILES` or a `CompileProfile`.
+
+    :return CompileProfile
+    '''
+    if profile is None:
+        return PROFILES['default']
+    if isinstance(profile, CompileProfile):
+        return profile
+    try:
+        return PROFILES[profile]
+    except KeyError:
+        raise AssertionError('Unexpected profile: %s (expected one of: %s).' % (
+            profile, ', '.join(sorted(PROFILES))))
+
+
+def merge_profiles(profiles):
+    '''
+    :return CompileProfile:
+        A profile where each field is the first value set in the given
+        profiles (used when functions in the same module specify different
+        profiles).
+    '''
+    profiles = [get_profile(profile) for profile in profiles]
+    default = CompileProfile()
+    merged = {}
+    for field in CompileProfile._fields:
+        merged[field] = next(
+            (getattr(profile, field) for profile in profiles if getattr(profile, field) != getattr(default, field)),
+            getattr(default, field))
+    return CompileProfile(**merged)
+
+
+def get_compile_flags(profile=None, debug=False, pgo_dir=None):
+    '''
+    :return tuple(list(str), list(str)):
+        The extra compile args and the extra link args for the given profile.
+    '''
+    import sys
+
+    profile = get_profile(profile)
+    compile_args = []
+    link_args = []
+    if sys.platform == 'win32':
+        # msvc
+        if profile.opt_level:
+            compile_args.append('/O2')
+        if profile.fast_math:
+            compile_args.append('/fp:fast')
+        if profile.openmp:
+            compile_args.append('/openmp')
+        if profile.lto:
+            compile_args.append('/GL')
+            link_args.append('/LTCG')
+        if debug:
+            compile_args.extend(['-Zi', '/Od'])
+            link_args.append('-debug')
+        return compile_args, link_args
+
+    if profile.opt_level:
+        compile_args.append('-O%s' % (profile.opt_level,))
+    if profile.march:
+        compile_args.append('-march=%s' % (profile.march,))
+    if profile.mtune:
+        compile_args.append('-mtune=%s' % (profile.mtune,))
+    if profile.fast_math:
+        compile_args.append('-ffast-math')
+    if profile.lto:
+        compile_args.append('-flto')
+        link_args.append('-flto')
+    if profile.openmp:
+        compile_args.append('-fopenmp')
+        link_args.append('-fopenmp')
+
+    pgo_dir = profile.pgo_dir or pgo_dir
+    if profile.pgo == 'generate':
+        compile_args.append('-fprofile-generate=%s' % (pgo_dir,))
+        link_args.append('-fprofile-generate=%s' % (pgo_dir,))
+    elif profile.pgo == 'use':
+        compile_args.extend(['-fprofile-use=%s' % (pgo_dir,), '-fprofile-correction', '-Wno-missing-profile'])
+        link_args.append('-fprofile-use=%s' % (pgo_dir,))
+    elif profile.pgo is not None:
+        raise AssertionError('Unexpected pgo: %s (expected None, "generate" or "use").' % (profile.pgo,))
+
+    if debug:
+        compile_args.extend(['-O0', '-g'])
+    return compile_args, link_args
+
+
+def _get_cpu_fingerprint():
+    '''
+    :return list(str):
+        Information identifying the current cpu (used in the key of artifacts
+        built with -march=native/-mtune=native).
+    '''
+    import platform
+    fingerprint = [platform.machine(), platform.processor()]
+    try:
+        with open('/proc/cpuinfo') as stream:
+            for line in stream:
+                if line.startswith(('model name', 'flags')) and line.strip() not in fingerprint:
+                    fingerprint.append(line.strip())
+                    if len(fingerprint) == 4:
+                        break
+    except OSError:
+        pass
+    return fingerprint
+
+
+def get_cpu_key(profile=None):
+    '''
+    :param str|CompileProfile profile:
+        If given, '' is returned if the profile doesn't build for the current
+        cpu (-march=native/-mtune=native), so, the modules built with it may
+        be used in any cpu.
+
+    :return str:
+        A hash identifying the current cpu.
+    '''
+    import hashlib
+    import json
+
+    if profile is not None:
+        profile = get_profile(profile)
+        if 'native' not in (profile.march, profile.mtune):
+            return ''
+
+    try:
+        return get_cpu_key._cpu_key
+    except AttributeError:
+        get_cpu_key._cpu_key = hashlib.sha256(json.dumps(_get_cpu_fingerprint()).encode('utf-8')).hexdigest()[:16]
+    return get_cpu_key._cpu_key
+
+
+_CompilerInfo = namedtuple('_CompilerInfo', 'cc, cflags, ldshared, include_dirs, ext_suffix')
+
+
+def get_compiler_info():
+    '''
+    :return _CompilerInfo:
+        The compiler, flags and extension suffix (gotten from sysconfig) used
+        to build extension modules.
+    '''
+    import shlex
+    import sysconfig
+
+    config_vars = sysconfig.get_config_vars()
+    cc = shlex.split(os.environ.get('CC', config_vars.get('CC') or ''))
+    cflags = shlex.split(config_vars.get('CFLAGS') or '') + shlex.split(config_vars.get('CCSHARED') or '')
+    ldshared = shlex.split(os.environ.get('LDSHARED', config_vars.get('LDSHARED') or ''))
+
+    include_dirs = []
+    for path_name in ('include', 'platinclude'):
+        include_dir = sysconfig.get_paths()[path_name]
+        if include_dir not in include_dirs:
+            include_dirs.append(include_dir)
+
+    return _CompilerInfo(cc, cflags, ldshared, include_dirs, config_vars['EXT_SUFFIX'])
+
+
+def get_compile_key(module_contents, debug=False, backend=None, profile=None):
+    '''
+    :return str:
+        A hash identifying the artifact built from the given contents (it
+        takes into account the contents, the Cython version, the compiler and
+        its flags and the Python ABI), so, if an artifact with this key was
+        already built it may be reused.
+
+    :note: the pgo phase of the profile isn't part of the key as both phases
+        must build a module with the same name for gcc to match the profile
+        data (see: `get_pgo_marker`).
+    '''
+    import hashlib
     import json
-    import os.path
-    import subprocess
     import sys
+    import Cython
+
+    if backend is None:
+        backend = get_default_backend()
+
+    profile = get_profile(profile)._replace(pgo=None, pgo_dir=None)
+    compile_args, link_args = get_compile_flags(profile, debug)
+    compiler_info = get_compiler_info()
+    toolchain = dict(
+        backend=backend,
+        debug=debug,
+        cython_version=Cython.__version__,
+        cc=compiler_info.cc,
+        cflags=compiler_info.cflags + compile_args,
+        ldshared=compiler_info.ldshared + link_args,
+        ext_suffix=compiler_info.ext_suffix,
+        python_version=sys.version,
+        cache_tag=sys.implementation.cache_tag,
+    )
+    if 'native' in (profile.march, profile.mtune):
+        # Artifacts built for different cpus must not be mixed.
+        toolchain['cpu'] = _get_cpu_fingerprint()
+
+    m = hashlib.sha256()
+    m.update(module_contents.encode('utf-8'))
+    m.update(json.dumps(toolchain, sort_keys=True).encode('utf-8'))
+    return m.hexdigest()
+
+
+def get_pgo_marker(profile):
+    '''
+    :return str:
+        The pgo phase of the given profile ('' if pgo isn't used).
+    '''
+    return get_profile(profile).pgo or ''
+
+
+def compile_with_cython(
+        module_name, module_contents, temp_dir, target_dir, silent=False, debug=False, backend=None, profile=None):
+    '''
+    Compiles the given contents as an extension module named `module_name`
+    which is put in `target_dir`.
+
+    :param str backend:
+        'inprocess': cythonizes in this process and calls the C compiler
+            directly (with the flags from sysconfig).
+        'subprocess': generates a setup.py and runs `build_ext` in a new
+            process.
+        None: uses `get_default_backend()`.
+
+    :param str|CompileProfile profile:
+        The optimization profile used (see: `PROFILES` and `CompileProfile`).
+    '''
     from pathlib import Path
 
+    if backend is None:
+        backend = get_default_backend()
+    compile_args, link_args = get_compile_flags(profile, debug, pgo_dir=Path(temp_dir) / 'pgo')
+
     temp_dir = Path(temp_dir)
 
     temp_dir.mkdir(exist_ok=True)
@@ -29,13 +298,64 @@ def compile_with_cython(module_name, module_contents, temp_dir, target_dir, sile
     with pyx_file.open('w') as stream:
         stream.write(module_contents)
 
-    debug_options = ''
-    if debug:
-        debug_options = '''
+    if backend == 'inprocess':
+        _compile_in_process(module_name, pyx_file, temp_dir, Path(target_dir), silent, compile_args, link_args)
+    elif backend == 'subprocess':
+        _compile_with_setup_py(pyx_file, temp_dir, target_dir, silent, compile_args, link_args)
+    else:
+        raise AssertionError('Unexpected backend: %s' % (backend,))
+
+
+def _compile_in_process(module_name, pyx_file, temp_dir, target_dir, silent, compile_args, link_args):
+    import contextlib
+    import io
+    from Cython.Compiler import Main
+
+    c_file = temp_dir / (module_name + '.c')
+    options = Main.CompilationOptions(
+        Main.default_options, output_file=str(c_file), language_level=3, quiet=silent)
+
+    stderr = io.StringIO()
+    with contextlib.ExitStack() as stack:
+        if silent:
+            stack.enter_context(contextlib.redirect_stderr(stderr))
+        result = Main.compile_single(str(pyx_file), options, full_module_name=module_name)
+    if result.num_errors:
+        raise CythonizeError('Error cythonizing: %s\n%s' % (pyx_file, stderr.getvalue()))
+
+    compiler_info = get_compiler_info()
+    o_file = temp_dir / (module_name + '.o')
+    target_file = target_dir / (module_name + compiler_info.ext_suffix)
+
+    _call(compiler_info.cc + compiler_info.cflags + compile_args +
+          ['-I%s' % (x,) for x in compiler_info.include_dirs] + ['-c', str(c_file), '-o', str(o_file)], silent)
+    _call(compiler_info.ldshared + [str(o_file), '-o', str(target_file)] + link_args, silent)
+
+
+def _call(args, silent, **kwargs):
+    import subprocess
+    if silent:
+        process = subprocess.Popen(
+            args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+        output = process.communicate()[0]
+        if process.returncode:
+            from subprocess import CalledProcessError
+            raise CalledProcessError(process.returncode, args, output=output)
+    else:
+        print('Calling args: %s' % (args,))
+        subprocess.check_call(args, **kwargs)
+
+
+def _compile_with_setup_py(pyx_file, temp_dir, target_dir, silent, compile_args, link_args):
+    import json
+    import os.path
+    import sys
+
+    compile_options = '''
 for extension in ext_modules:
-    extension.extra_compile_args.extend(["-Zi", "/Od"])
-    extension.extra_link_args.extend(["-debug"])
-'''
+    extension.extra_compile_args.extend(%s)
+    extension.extra_link_args.extend(%s)
+''' % (json.dumps(compile_args), json.dumps(link_args))
 
     setup_template = '''
 from Cython.Build import cythonize
@@ -43,14 +363,14 @@ from distutils.core import setup
 
 ext_modules = %(ext_modules)s
 ext_modules = cythonize(ext_modules)
-%(debug_options)s
+%(compile_options)s
 
 setup(
     name='Cythonize',
     ext_modules=ext_modules,
 )
 ''' % dict(
-    debug_options=debug_options,
+    compile_options=compile_options,
     ext_modules=json.dumps([str(pyx_file)]),
     )
 
@@ -72,16 +392,5 @@ setup(
         '--build-lib', str(target_dir),
         '--build-temp', str(build_temp_artifacts)
     ]
-    if not silent:
-        print('Calling args: %s' % (args,))
     with working_directory(os.path.dirname(setup_cython)):
-        kwargs = {}
-        if silent:
-            process = subprocess.Popen(
-                args, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            process.communicate()
-            if process.returncode:
-                from subprocess import CalledProcessError
-                raise CalledProcessError(process.returncode, args)
-        else:
-            subprocess.check_call(args, env=env, **kwargs)
+        _call(args, silent, env=env)
@@ -0,0 +1,16 @@
+from cython_jit import jit
+
+
+@jit(nogil=True)
+def add_annotated(a: 'double', b: 'int64_t'=1) -> 'double':
+    return a + b
+
+
+@jit()
+def mul_annotated(a: 'double', b: 'double') -> 'double':
+    return a * b
+
+
+@jit(directives={'cdivision': True})
+def div_annotated(a: 'int64_t', b: 'int64_t'=0x10) -> 'int64_t':
+    return a // b
@@ -0,0 +1,26 @@
+from cython_jit import jit
+
+
+@jit()
+def twice(x):
+    return x * 2
+
+
+@jit()
+def twice_plus_one(n):
+    return twice(n) + 1
+
+
+@jit()
+def twice_plus_half(x):
+    return twice(x) + 0.5
+
+
+@jit(inline=False)
+def triple(x):
+    return x * 3
+
+
+@jit()
+def triple_sum(a, b):
+    return triple(a) + triple(b)
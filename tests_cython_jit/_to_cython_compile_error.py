@@ -0,0 +1,10 @@
+from cython_jit import jit
+
+
+@jit(nogil=False)
+def my_func_compile_error(bar):
+    # IFDEF CYTHON
+    # cdef UnknownCythonType x
+    # ENDIF
+    x = 1
+    return bar + x
@@ -0,0 +1,7 @@
+from cython_jit import jit
+
+
+@jit(nogil=True, directives=dict(cdivision=True), aggressive=True)
+def scale_array(arr, divisor):
+    for i in range(arr.shape[0]):
+        arr[i] = arr[i] / divisor
@@ -0,0 +1,10 @@
+from cython_jit import jit
+
+
+@jit(nogil=True, infer_locals=True)
+def sum_2d(arr):
+    total = 0
+    for i in range(arr.shape[0]):
+        for j in range(arr.shape[1]):
+            total += arr[i, j]
+    return total
@@ -0,0 +1,9 @@
+from cython_jit import jit
+
+
+@jit(nogil=False)
+def sum_array(arr):
+    total = 0.0
+    for i in range(arr.shape[0]):
+        total += arr[i]
+    return total
@@ -0,0 +1,8 @@
+from cython_jit import jit
+
+
+@jit(nogil=True, infer_locals=True, parallel=True, num_threads=2)
+def scale_pixels(pixels_array, factor):
+    for i in range(pixels_array.shape[0]):
+        for j in range(pixels_array.shape[1]):
+            pixels_array[i, j] = pixels_array[i, j] * factor
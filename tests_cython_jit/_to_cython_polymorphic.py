@@ -0,0 +1,11 @@
+from cython_jit import jit
+
+
+@jit(nogil=False)
+def my_func_polymorphic(bar):
+    return bar + 1
+
+
+@jit(nogil=True)
+def my_func_polymorphic_nogil(bar):
+    return bar + 1
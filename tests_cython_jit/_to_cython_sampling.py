@@ -0,0 +1,6 @@
+from cython_jit import jit
+
+
+@jit(nogil=False, stable_after=3)
+def my_func_sampling(bar, baz=1):
+    return bar + baz
@@ -0,0 +1,11 @@
+from cython_jit import jit
+
+
+@jit(nogil=True, vectorize=True)
+def scale_and_shift(x, factor):
+    return x * factor + 1
+
+
+@jit(vectorize=True)
+def add_ints(a, b):
+    return a + b
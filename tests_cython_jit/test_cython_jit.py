@@ -48,9 +48,12 @@ def test_cython_jit(tmpdir):
             (my_func,
                 [
                     'def my_func_cy_wrapper(int bar) -> int64_t:',
-                    '    return my_func(bar)',
+                    '    cdef int64_t _cyjit_ret',
+                    '    with nogil:',
+                    '        _cyjit_ret = my_func(bar)',
+                    '    return _cyjit_ret',
 
-                    'cdef int64_t my_func(int bar) nogil:',
+                    'cdef int64_t my_func(int bar) noexcept nogil:',
                     '    return bar + 1'
                 ]
             ),
@@ -175,6 +178,43 @@ def test_cache_working(tmpdir):
         _to_cython2_reloaded.my_func3(1)
 
 
+def test_read_only_cache_dir(tmpdir, monkeypatch):
+    from cython_jit import JitStage, set_jit_stage, get_cache_dir
+    from importlib import reload
+
+    from cython_jit import _file_lock
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    all_collectors = _get_jit_state_info().all_collectors
+    with set_jit_stage(JitStage.collect_info):
+        from tests_cython_jit import _to_cython2
+        all_collectors.clear()
+        _to_cython2 = reload(_to_cython2)
+        _to_cython2.my_func3(1)
+        _to_cython2.my_func4(1)
+        _to_cython2.my_func5(1)
+        _get_jit_state_info().compile_collected(silent=True, jobs=1)
+    all_collectors.clear()
+
+    # i.e.: an installed wheel in site-packages (permissions aren't checked
+    # for root, so, the failure to write is simulated).
+    cache_dir = get_cache_dir()
+
+    def acquire(self, blocking=True):
+        if cache_dir in self.path.parents:
+            raise PermissionError('Read-only file system: %s' % (self.path,))
+        return original_acquire(self, blocking)
+
+    original_acquire = _file_lock.FileLock.acquire
+    monkeypatch.setattr(_file_lock.FileLock, 'acquire', acquire)
+
+    with _set_new_state_info(tmpdir):
+        with set_jit_stage(JitStage.use_compiled):
+            _to_cython2_reloaded = reload(_to_cython2)
+            assert _to_cython2_reloaded.my_func3(1) == 2
+            assert _to_cython2_reloaded.my_func3.__name__ == 'my_func3_cy_wrapper'
+
+
 def test_compile_numpy_arrays(tmpdir):
     from cython_jit import JitStage, set_jit_stage
     from importlib import reload
@@ -195,7 +235,8 @@ def test_compile_numpy_arrays(tmpdir):
         _to_cython_numpy_arrays_reloaded.check_parameters(pixels_array, 0, 0, 0, result, 0.8)
 
 
-def test_compile_with_cython(tmpdir):
+@pytest.mark.parametrize('backend', ['inprocess', 'subprocess'])
+def test_compile_with_cython(tmpdir, backend):
     from cython_jit.compile_with_cython import compile_with_cython
     from cython_jit._jit_state_info import add_to_sys_path
 
@@ -206,6 +247,7 @@ def test_compile_with_cython(tmpdir):
         str(tmpdir),
         target_dir,
         silent=True,
+        backend=backend,
     )
     with pytest.raises(ImportError):
         import mymod1_cython_tests  # @UnresolvedImport @UnusedImport
@@ -213,3 +255,1560 @@ def test_compile_with_cython(tmpdir):
     with add_to_sys_path(target_dir):
         import mymod1_cython_tests  # @UnresolvedImport @Reimport
     assert mymod1_cython_tests.func() == 1
+
+
+def test_compile_collected_in_parallel(tmpdir):
+    from cython_jit import JitStage, set_jit_stage
+    from importlib import reload
+
+    from cython_jit import CompileCollectedError
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    with set_jit_stage(JitStage.collect_info):
+        from tests_cython_jit import _to_cython2
+        from tests_cython_jit import _to_cython_compile_error
+        _get_jit_state_info().all_collectors.clear()
+        _to_cython2 = reload(_to_cython2)
+        _to_cython_compile_error = reload(_to_cython_compile_error)
+        _to_cython2.my_func3(1)
+        _to_cython2.my_func4(1)
+        _to_cython2.my_func5(1)
+        _to_cython_compile_error.my_func_compile_error(1)
+
+        with pytest.raises(CompileCollectedError) as exc_info:
+            _get_jit_state_info().compile_collected(silent=True, jobs=2)
+
+    # Only the module which had an error should be reported.
+    assert list(exc_info.value.pyd_name_to_error) == [
+        _get_jit_state_info().all_collectors['my_func_compile_error'].get_pyd_name()]
+    _get_jit_state_info().all_collectors.clear()
+
+    # The sibling module must still be available.
+    with set_jit_stage(JitStage.use_compiled):
+        _to_cython2_reloaded = reload(_to_cython2)
+        assert _to_cython2_reloaded.my_func3(1) == 2
+
+
+def test_compile_with_cython_inprocess_error(tmpdir):
+    from cython_jit.compile_with_cython import compile_with_cython
+    from cython_jit.compile_with_cython import CythonizeError
+
+    with pytest.raises(CythonizeError) as exc_info:
+        compile_with_cython(
+            'mymod1_cython_tests',
+            'cdef UnknownCythonType x\n',
+            str(tmpdir),
+            str(tmpdir.join('target_dir')),
+            silent=True,
+            backend='inprocess',
+        )
+    assert 'UnknownCythonType' in str(exc_info.value)
+
+
+def test_compile_cache_reuses_artifacts(tmpdir, monkeypatch):
+    from cython_jit import JitStage, set_jit_stage
+    from importlib import reload
+
+    from cython_jit import compile_with_cython
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    all_collectors = _get_jit_state_info().all_collectors
+    with set_jit_stage(JitStage.collect_info):
+        from tests_cython_jit import _to_cython2
+        all_collectors.clear()
+        _to_cython2 = reload(_to_cython2)
+        _to_cython2.my_func3(1)
+        _to_cython2.my_func4(1)
+        _to_cython2.my_func5(1)
+        _get_jit_state_info().compile_collected(silent=True, jobs=1)
+
+    def compile_not_expected(*args, **kwargs):
+        raise AssertionError('The artifact should have been reused.')
+
+    # The generated contents are the same, so, the compiler must not be called.
+    monkeypatch.setattr(compile_with_cython, 'compile_with_cython', compile_not_expected)
+    with _set_new_state_info(tmpdir):
+        with set_jit_stage(JitStage.collect_info):
+            all_collectors = _get_jit_state_info().all_collectors
+            _to_cython2 = reload(_to_cython2)
+            _to_cython2.my_func3(1)
+            _to_cython2.my_func4(1)
+            _to_cython2.my_func5(1)
+            _get_jit_state_info().compile_collected(silent=True, jobs=1)
+        all_collectors.clear()
+
+        with set_jit_stage(JitStage.use_compiled):
+            _to_cython2_reloaded = reload(_to_cython2)
+            assert _to_cython2_reloaded.my_func3(1) == 2
+
+
+def test_manifest_index(tmpdir, monkeypatch):
+    import sys
+    from pathlib import Path
+    from cython_jit import JitStage, set_jit_stage
+    from importlib import reload
+
+    from cython_jit import _manifest
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    with _set_new_state_info(tmpdir):
+        all_collectors = _get_jit_state_info().all_collectors
+        with set_jit_stage(JitStage.collect_info):
+            from tests_cython_jit import _to_cython2
+            all_collectors.clear()
+            _to_cython2 = reload(_to_cython2)
+            _to_cython2.my_func3(1)
+            _to_cython2.my_func4(1)
+            _to_cython2.my_func5(1)
+            _get_jit_state_info().compile_collected(silent=True, jobs=1)
+        all_collectors.clear()
+
+        manifest = _manifest.read_manifest(_get_jit_state_info().get_dir('cache'))
+        entry = manifest[_to_cython2.my_func3.__module__.replace('.', '_') + '_cyjit' + ''.join(
+            str(x) for x in sys.version_info[:2])]
+        assert entry.abi == _manifest.get_abi()
+        assert sorted(entry.func_keys) == ['my_func3', 'my_func4', 'my_func5']
+
+        # The build intermediates are removed after the build.
+        temp_dir = _get_jit_state_info().get_dir('temp')
+        assert not list(temp_dir.glob(entry.module_name + '/*'))
+
+    read_manifest_calls = []
+
+    def read_manifest(cache_dir):
+        read_manifest_calls.append(cache_dir)
+        return original_read_manifest(cache_dir)
+
+    def iterdir_not_expected(*args, **kwargs):
+        raise AssertionError('The cache dir should not be scanned.')
+
+    original_read_manifest = _manifest.read_manifest
+    monkeypatch.setattr(_manifest, 'read_manifest', read_manifest)
+    monkeypatch.setattr(Path, 'iterdir', iterdir_not_expected)
+
+    # A new state info: the module is found through the manifest (read only once).
+    sys_path = list(sys.path)
+    with _set_new_state_info(tmpdir):
+        with set_jit_stage(JitStage.use_compiled):
+            _to_cython2_reloaded = reload(_to_cython2)
+            assert _to_cython2_reloaded.my_func3(1) == 2
+            assert _to_cython2_reloaded.my_func4.__name__ == 'my_func4_cy_wrapper'
+        _get_jit_state_info().all_collectors.clear()
+    assert len(read_manifest_calls) == 1
+    assert sys.path == sys_path
+
+
+def test_shared_cache_dir_builds_once(tmpdir, monkeypatch):
+    import threading
+    import time
+    from pathlib import Path
+    from cython_jit import _jit_state_info
+    from cython_jit._manifest import read_manifest
+    from cython_jit.compile_with_cython import CompileProfile
+
+    run_calls = []
+
+    def run_compile_jobs(compile_jobs, temp_dir, target_dir, *args):
+        run_calls.append([compile_job.module_name for compile_job in compile_jobs])
+        time.sleep(.3)
+        for compile_job in compile_jobs:
+            # Only visible in the cache dir when published.
+            assert not _jit_state_info._get_artifact_path(compile_job, cache_dir).exists()
+            _jit_state_info._get_artifact_path(compile_job, target_dir).write_bytes(b'')
+        return {}
+
+    monkeypatch.setattr(_jit_state_info, '_run_compile_jobs', run_compile_jobs)
+    cache_dir = Path(str(tmpdir.join('shared_cache')))
+    compile_job = _jit_state_info._CompileJob(
+        pyd_name='mod_cyjit311', module_name='mod_cyjit311_0123', module_contents='', profile=CompileProfile(),
+        func_keys={'func': 'key'})
+
+    results = []
+
+    def build():
+        results.append(_jit_state_info.build_compile_jobs([compile_job], cache_dir, cache_dir))
+
+    # Many processes (threads here, as each lock opens the file again) build the same module.
+    threads = [threading.Thread(target=build) for _i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [{}, {}, {}]
+    assert run_calls == [['mod_cyjit311_0123']]
+    assert read_manifest(cache_dir)['mod_cyjit311'].func_keys == {'func': 'key'}
+    assert not list(cache_dir.glob('.staging_*'))
+
+
+def test_remove_unused_artifacts(tmpdir):
+    import sysconfig
+    from pathlib import Path
+    from cython_jit._file_lock import LEASES_DIR_NAME
+    from cython_jit._file_lock import ProcessLease
+    from cython_jit._file_lock import get_module_lock
+    from cython_jit._manifest import ManifestEntry
+    from cython_jit._manifest import get_abi
+    from cython_jit._manifest import remove_unused_artifacts
+    from cython_jit._manifest import update_manifest
+
+    cache_dir = Path(str(tmpdir.join('shared_cache')))
+    cache_dir.mkdir()
+    ext_suffix = sysconfig.get_config_var('EXT_SUFFIX')
+    for name in ('latest', 'old', 'leased', 'building', 'leased_by_dead_process'):
+        (cache_dir / ('mod_cyjit311_%s%s' % (name, ext_suffix))).write_bytes(b'')
+    (cache_dir / 'mod_cyjit311_old.pgo').write_text('use')
+    (cache_dir / 'other.txt').write_text('')
+    update_manifest(cache_dir, {'mod_cyjit311': ManifestEntry('mod_cyjit311_latest', '', get_abi(), {})})
+
+    lease = ProcessLease(cache_dir)
+    lease.add('mod_cyjit311_leased')
+
+    leases_dir = cache_dir / LEASES_DIR_NAME
+    (leases_dir / '1_dead.modules').write_text('mod_cyjit311_leased_by_dead_process\n')
+    (leases_dir / '1_dead.lock').write_text('')
+
+    with get_module_lock(cache_dir, 'mod_cyjit311_building'):
+        removed = remove_unused_artifacts(cache_dir)
+
+    assert sorted(path.name for path in removed) == [
+        'mod_cyjit311_leased_by_dead_process' + ext_suffix,
+        'mod_cyjit311_old' + ext_suffix,
+        'mod_cyjit311_old.pgo',
+    ]
+    assert sorted(path.name for path in cache_dir.iterdir() if path.is_file()) == sorted([
+        'cython_jit_manifest.json',
+        'cython_jit_manifest.lock',
+        'mod_cyjit311_building' + ext_suffix,
+        'mod_cyjit311_latest' + ext_suffix,
+        'mod_cyjit311_leased' + ext_suffix,
+        'other.txt',
+    ])
+    assert len(list(leases_dir.iterdir())) == 2  # Only the lease of this process is kept.
+
+
+def test_cache_prune(tmpdir, capsys):
+    import os
+    import sysconfig
+    import time
+    from pathlib import Path
+    from cython_jit.__main__ import main
+    from cython_jit._file_lock import ProcessLease
+    from cython_jit._manifest import ManifestEntry
+    from cython_jit._manifest import get_abi
+    from cython_jit._manifest import read_manifest
+    from cython_jit._manifest import update_manifest
+
+    cache_dir = Path(str(tmpdir.join('shared_cache')))
+    temp_dir = Path(str(tmpdir.join('shared_temp')))
+    cache_dir.mkdir()
+    ext_suffix = sysconfig.get_config_var('EXT_SUFFIX')
+
+    # Modules used 3, 2 and 1 days ago (100 bytes each).
+    now = time.time()
+    entries = {}
+    for days, name in ((3, 'a'), (2, 'b'), (1, 'c')):
+        module_name = 'mod_%s_cyjit311_0123' % (name,)
+        path = cache_dir / (module_name + ext_suffix)
+        path.write_bytes(b'x' * 100)
+        os.utime(str(path), (now - days * 24 * 60 * 60,) * 2)
+        entries['mod_%s_cyjit311' % (name,)] = ManifestEntry(module_name, path.name, get_abi(), {})
+        (temp_dir / module_name / 'pgo').mkdir(parents=True)
+    update_manifest(cache_dir, entries)
+
+    # A previous version of a module (not in the manifest) used 4 days ago.
+    superseded = cache_dir / ('mod_a_cyjit311_4567' + ext_suffix)
+    superseded.write_bytes(b'x' * 100)
+    os.utime(str(superseded), (now - 4 * 24 * 60 * 60,) * 2)
+    (cache_dir / 'mod_a_cyjit311_4567.pgo').write_text('use')
+
+    args = ['cache', '--cache-dir', str(cache_dir), '--temp-dir', str(temp_dir)]
+    assert main(args + ['stats']) == 0
+    assert 'Modules: 4 (3 latest)' in capsys.readouterr().out
+
+    # Previous versions are kept while within the limits (so that they can be reused).
+    assert main(args + ['prune', '--max-size', '1000']) == 0
+    assert superseded.exists()
+
+    # The least recently used is removed first.
+    assert main(args + ['prune', '--max-size', '250']) == 0
+    assert not superseded.exists()
+    assert not (cache_dir / 'mod_a_cyjit311_4567.pgo').exists()
+    assert sorted(read_manifest(cache_dir)) == ['mod_b_cyjit311', 'mod_c_cyjit311']
+    assert sorted(path.name for path in temp_dir.iterdir()) == ['mod_b_cyjit311_0123', 'mod_c_cyjit311_0123']
+
+    assert main(args + ['prune', '--max-age', '1.5d']) == 0
+    assert sorted(read_manifest(cache_dir)) == ['mod_c_cyjit311']
+
+    # Modules in use are kept.
+    lease = ProcessLease(cache_dir)
+    lease.add('mod_c_cyjit311_0123')
+    assert main(args + ['clear']) == 0
+    assert sorted(read_manifest(cache_dir)) == ['mod_c_cyjit311']
+    capsys.readouterr()
+    assert main(args + ['stats']) == 0
+    assert 'Size: 100 bytes' in capsys.readouterr().out
+
+
+def test_cache_prune_while_loading(tmpdir, monkeypatch):
+    import sysconfig
+    from pathlib import Path
+    from cython_jit import _file_lock
+    from cython_jit import _manifest
+    from cython_jit._cache import prune_cache
+    from cython_jit._file_lock import ProcessLease
+    from cython_jit._file_lock import get_module_lock
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    cache_dir = Path(str(tmpdir.join('shared_cache')))
+    cache_dir.mkdir()
+    ext_suffix = sysconfig.get_config_var('EXT_SUFFIX')
+    paths = []
+    entries = {}
+    for name in ('a', 'b', 'c'):
+        module_name = 'mod_%s_cyjit311_0123' % (name,)
+        path = cache_dir / (module_name + ext_suffix)
+        path.write_bytes(b'x' * 100)
+        paths.append(path)
+        if name != 'c':  # mod_c is a previous version (not in the manifest).
+            entries['mod_%s_cyjit311' % (name,)] = _manifest.ManifestEntry(
+                module_name, path.name, _manifest.get_abi(), {})
+    _manifest.update_manifest(cache_dir, entries)
+
+    # A module loaded after the leases were read (but before it's removed) is kept.
+    get_leased_module_names = _file_lock.get_leased_module_names
+    leases = []
+
+    def get_leased_module_names_before_load(cache_dir):
+        ret = get_leased_module_names(cache_dir)
+        if not leases:
+            for module_name in ('mod_b_cyjit311_0123', 'mod_c_cyjit311_0123'):
+                leases.append(ProcessLease(cache_dir))
+                leases[-1].add(module_name)
+        return ret
+
+    monkeypatch.setattr(_file_lock, 'get_leased_module_names', get_leased_module_names_before_load)
+    prune_cache(cache_dir, max_size=0)
+    del leases[:]  # i.e.: the process exited.
+    _manifest.remove_unused_artifacts(cache_dir)
+    assert [path.exists() for path in paths] == [False, True, True]
+    del leases[:]
+    monkeypatch.undo()
+
+    # The module lock is held while loading (so, it can't be pruned in the meanwhile).
+    def load_module(module_name, path):
+        assert not get_module_lock(cache_dir, module_name).acquire(blocking=False)
+        prune_cache(cache_dir, max_size=0)
+        assert path.exists()
+        return 'loaded'
+
+    monkeypatch.setattr(_manifest, 'load_module', load_module)
+    assert _get_jit_state_info()._load_module('mod_b_cyjit311_0123', paths[1]) == 'loaded'
+    assert [path.exists() for path in paths] == [False, True, False]
+
+
+def test_lazy_load(tmpdir):
+    from cython_jit import JitStage, set_jit_stage, set_lazy_load
+    from cython_jit import ModuleNotCachedError
+    from importlib import reload
+
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    with _set_new_state_info(tmpdir):
+        set_lazy_load(True)
+        # Nothing compiled: the error only happens when the function is called.
+        with set_jit_stage(JitStage.use_compiled):
+            from tests_cython_jit import _to_cython2
+            _to_cython2 = reload(_to_cython2)
+            assert _to_cython2.my_func3.__name__ == 'my_func3'
+            with pytest.raises(ModuleNotCachedError):
+                _to_cython2.my_func3(1)
+
+        all_collectors = _get_jit_state_info().all_collectors
+        with set_jit_stage(JitStage.collect_info):
+            all_collectors.clear()
+            _to_cython2 = reload(_to_cython2)
+            _to_cython2.my_func3(1)
+            _to_cython2.my_func4(1)
+            _to_cython2.my_func5(1)
+            _get_jit_state_info().compile_collected(silent=True, jobs=1)
+        all_collectors.clear()
+
+    with _set_new_state_info(tmpdir):
+        set_lazy_load(True)
+        jit_state_info = _get_jit_state_info()
+        get_cached_calls = []
+        original_get_cached = jit_state_info.get_cached
+
+        def get_cached(collector):
+            get_cached_calls.append(collector.func.__name__)
+            return original_get_cached(collector)
+
+        # Nothing is resolved when the module is imported.
+        jit_state_info.get_cached = get_cached
+        with set_jit_stage(JitStage.use_compiled):
+            _to_cython2 = reload(_to_cython2)
+        assert get_cached_calls == []
+        assert not jit_state_info.all_collectors
+
+        lazy_my_func3 = _to_cython2.my_func3
+        assert _to_cython2.my_func3(1) == 2
+        assert get_cached_calls == ['my_func3']
+
+        # After the first call the module attribute is the compiled function
+        # (references to the lazy wrapper still work).
+        assert _to_cython2.my_func3.__name__ == 'my_func3_cy_wrapper'
+        assert _to_cython2.my_func3(2) == 3
+        assert lazy_my_func3(2) == 3
+        assert get_cached_calls == ['my_func3']
+
+
+@pytest.mark.parametrize('detach', [False, True])
+def test_compile_at_exit(tmpdir, detach):
+    import atexit
+    import sys
+    import time
+    from cython_jit import JitStage, set_jit_stage, set_compile_at_exit_options
+    from importlib import reload
+    from cython_jit._manifest import read_manifest
+
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    jit_state_info = _get_jit_state_info()
+    all_collectors = jit_state_info.all_collectors
+    with set_jit_stage(JitStage.collect_info_and_compile_at_exit):
+        from tests_cython_jit import _to_cython2
+        all_collectors.clear()
+        _to_cython2 = reload(_to_cython2)
+        _to_cython2.my_func3(1)
+        _to_cython2.my_func4(1)
+        _to_cython2.my_func5(1)
+
+    assert jit_state_info.compile_at_exit_registered
+    atexit.unregister(jit_state_info.compile_at_exit)
+
+    set_compile_at_exit_options(time_budget=None if detach else 120, detach=detach)
+    jit_state_info.compile_at_exit()
+    all_collectors.clear()
+
+    pyd_name = _to_cython2.my_func3.__module__.replace('.', '_') + '_cyjit' + ''.join(
+        str(x) for x in sys.version_info[:2])
+    cache_dir = jit_state_info.get_dir('cache')
+    if detach:
+        timeout_at = time.time() + 120
+        while pyd_name not in read_manifest(cache_dir):
+            assert time.time() < timeout_at, 'Compile process did not finish in time.'
+            time.sleep(.2)
+    assert pyd_name in read_manifest(cache_dir)
+
+    with set_jit_stage(JitStage.use_compiled):
+        _to_cython2_reloaded = reload(_to_cython2)
+        assert _to_cython2_reloaded.my_func3(1) == 2
+
+
+_AT_EXIT_SCRIPT = """
+import concurrent.futures.process  # Its exit hook runs before the atexit handlers.
+import sys
+from pathlib import Path
+
+import cython_jit
+from cython_jit import JitStage
+
+cython_jit.set_cache_dir(Path(sys.argv[1]))
+cython_jit.set_temp_dir(Path(sys.argv[2]))
+cython_jit.set_jit_stage(JitStage.collect_info_and_compile_at_exit)
+cython_jit.set_compile_options(jobs=2)
+
+import cyjit_at_exit_mod
+import cyjit_at_exit_mod2
+assert cyjit_at_exit_mod.add_one(1) == 2
+assert cyjit_at_exit_mod2.add_two(1) == 3
+"""
+
+
+def test_compile_at_exit_subprocess(tmpdir):
+    import os
+    import subprocess
+    import sys
+    from pathlib import Path
+    from cython_jit._manifest import read_manifest
+
+    # More than one module so that more than one job is available to compile.
+    tmpdir.join('cyjit_at_exit_mod.py').write(
+        'from cython_jit import jit\n\n\n@jit()\ndef add_one(x):\n    return x + 1\n')
+    tmpdir.join('cyjit_at_exit_mod2.py').write(
+        'from cython_jit import jit\n\n\n@jit()\ndef add_two(x):\n    return x + 2\n')
+    tmpdir.join('run_at_exit.py').write(_AT_EXIT_SCRIPT)
+
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(
+        [str(tmpdir), str(Path(__file__).absolute().parent.parent)] + [x for x in [env.get('PYTHONPATH')] if x])
+    cache_dir = tmpdir.join('at_exit_cache')
+    process = subprocess.run(
+        [sys.executable, str(tmpdir.join('run_at_exit.py')), str(cache_dir), str(tmpdir.join('at_exit_temp'))],
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, timeout=300)
+    assert process.returncode == 0, process.stderr
+    assert 'Traceback' not in process.stderr, process.stderr
+    manifest = read_manifest(Path(str(cache_dir)))
+    for module_name in ('cyjit_at_exit_mod', 'cyjit_at_exit_mod2'):
+        assert '%s_cyjit%s%s' % ((module_name,) + sys.version_info[:2]) in manifest
+
+
+def test_compile_in_background(tmpdir):
+    import time
+    from cython_jit import JitStage, set_jit_stage, set_background_compile_thresholds
+    from importlib import reload
+
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    all_collectors = _get_jit_state_info().all_collectors
+    set_background_compile_thresholds(calls=2)
+    with set_jit_stage(JitStage.collect_info_and_compile_in_background):
+        from tests_cython_jit import _to_cython2
+        all_collectors.clear()
+        _to_cython2 = reload(_to_cython2)
+
+        collector = all_collectors['my_func3']
+        assert _to_cython2.my_func3(1) == 2
+        assert not collector.compile_scheduled
+        assert _to_cython2.my_func3(1) == 2
+        assert collector.compile_scheduled
+
+        # While it's being compiled the python version is used.
+        timeout_at = time.time() + 120
+        while collector.compiled_func is None:
+            assert time.time() < timeout_at, 'Background compile did not finish in time.'
+            assert _to_cython2.my_func3(1) == 2
+            time.sleep(.1)
+
+        assert _to_cython2.my_func3(2) == 3
+        assert collector.compiled_func.__name__ == 'my_func3_cy_wrapper'
+
+        # my_func4 was not called, so, it's still a python function (which
+        # collects information and is compiled when a threshold is reached).
+        collector4 = all_collectors['my_func4']
+        assert collector4.compiled_func is None
+        assert not collector4.compile_scheduled
+        assert _to_cython2.my_func4(1) == 2
+        assert not collector4.compile_scheduled
+        assert _to_cython2.my_func4(1) == 2
+        assert collector4.compile_scheduled
+
+        timeout_at = time.time() + 120
+        while collector4.compiled_func is None:
+            assert time.time() < timeout_at, 'Background compile did not finish in time.'
+            time.sleep(.1)
+        assert _to_cython2.my_func4(2) == 3
+        assert collector.compiled_func is not None
+
+
+def test_compile_in_background_failure(tmpdir, monkeypatch):
+    import time
+    from cython_jit import JitStage, set_jit_stage, set_background_compile_thresholds
+    from importlib import reload
+
+    from cython_jit import _compile_jobs
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    class _FailedProcess(object):
+
+        def wait(self):
+            return 1
+
+    started = []
+
+    def start_compile_process(compile_jobs, *args, **kwargs):
+        started.append(sorted(compile_job.pyd_name for compile_job in compile_jobs))
+        return _FailedProcess()
+
+    monkeypatch.setattr(_compile_jobs, 'start_compile_process', start_compile_process)
+
+    all_collectors = _get_jit_state_info().all_collectors
+    set_background_compile_thresholds(calls=2)
+    with set_jit_stage(JitStage.collect_info_and_compile_in_background):
+        from tests_cython_jit import _to_cython2
+        all_collectors.clear()
+        _to_cython2 = reload(_to_cython2)
+
+        collector = all_collectors['my_func3']
+        assert _to_cython2.my_func3(1) == 2
+        assert _to_cython2.my_func3(1) == 2
+        timeout_at = time.time() + 120
+        while collector.compile_scheduled:
+            assert time.time() < timeout_at, 'Background compile did not finish in time.'
+            time.sleep(.1)
+        assert len(started) == 1
+        assert collector.compiled_func is None
+
+        # The same contents are not compiled again (checked when the code is
+        # generated in the background).
+        assert _to_cython2.my_func3(1) == 2
+        assert _to_cython2.my_func3(1) == 2
+        timeout_at = time.time() + 120
+        while collector.compile_scheduled:
+            assert time.time() < timeout_at, 'Background compile did not finish in time.'
+            time.sleep(.1)
+        assert len(started) == 1
+
+        # With new information (another function collected) it's compiled again.
+        assert _to_cython2.my_func4(1) == 2
+        assert _to_cython2.my_func4(1) == 2
+        timeout_at = time.time() + 120
+        while len(started) < 2:
+            assert time.time() < timeout_at, 'Background compile did not start in time.'
+            time.sleep(.1)
+
+
+def test_compile_in_background_concurrent(tmpdir, monkeypatch):
+    import threading
+    import time
+    from cython_jit import JitStage, set_jit_stage, set_background_compile_thresholds
+    from importlib import reload
+
+    from cython_jit import _compile_jobs
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    compile_finished = threading.Event()
+
+    class _BlockedProcess(object):
+
+        def wait(self):
+            compile_finished.wait(60)
+            return 1
+
+    started = []
+
+    def start_compile_process(compile_jobs, *args, **kwargs):
+        started.append(sorted(compile_job.pyd_name for compile_job in compile_jobs))
+        return _BlockedProcess()
+
+    jit_state_info = _get_jit_state_info()
+    create_compile_jobs = jit_state_info._create_compile_jobs
+    create_threads = []
+
+    def create_compile_jobs_in_thread(*args, **kwargs):
+        create_threads.append(threading.current_thread())
+        return create_compile_jobs(*args, **kwargs)
+
+    monkeypatch.setattr(_compile_jobs, 'start_compile_process', start_compile_process)
+    monkeypatch.setattr(jit_state_info, '_create_compile_jobs', create_compile_jobs_in_thread)
+
+    all_collectors = jit_state_info.all_collectors
+    set_background_compile_thresholds(calls=2)
+    with set_jit_stage(JitStage.collect_info_and_compile_in_background):
+        from tests_cython_jit import _to_cython2
+        all_collectors.clear()
+        _to_cython2 = reload(_to_cython2)
+
+        # Many threads reach the thresholds at the same time.
+        barrier = threading.Barrier(8)
+        errors = []
+
+        def call():
+            try:
+                barrier.wait()
+                for _i in range(20):
+                    assert _to_cython2.my_func3(1) == 2
+                    assert _to_cython2.my_func4(1) == 2
+            except BaseException as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+
+        # The code is generated in the background and the module is only compiled once at a time.
+        timeout_at = time.time() + 120
+        while not started:
+            assert time.time() < timeout_at, 'Background compile did not start in time.'
+            time.sleep(.1)
+        assert len(started) == 1
+        assert create_threads and not set(create_threads).intersection(threads)
+
+        compile_finished.set()
+        timeout_at = time.time() + 120
+        while all_collectors['my_func3'].compile_scheduled or all_collectors['my_func4'].compile_scheduled:
+            assert time.time() < timeout_at, 'Background compile did not finish in time.'
+            time.sleep(.1)
+        assert len(started) == 1
+
+
+def test_collect_sampling(tmpdir):
+    from cython_jit import JitStage, set_jit_stage
+    from importlib import reload
+
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    all_collectors = _get_jit_state_info().all_collectors
+    with set_jit_stage(JitStage.collect_info):
+        from tests_cython_jit import _to_cython_sampling
+        all_collectors.clear()
+        _to_cython_sampling = reload(_to_cython_sampling)
+        collector = all_collectors['my_func_sampling']
+
+        assert _to_cython_sampling.my_func_sampling(1, 2) == 3
+        assert _to_cython_sampling.my_func_sampling(bar=1, baz=2) == 3
+        assert not collector.collection_done
+        assert _to_cython_sampling.my_func_sampling(1, baz=2) == 3
+        assert collector.collection_done
+        assert collector.get_def_line() == 'cdef int64_t my_func_sampling(int64_t bar, int64_t baz):'
+
+        # Types are no longer collected after they're stable.
+        assert _to_cython_sampling.my_func_sampling(1.5, 2.5) == 4.0
+        assert collector.get_def_line() == 'cdef int64_t my_func_sampling(int64_t bar, int64_t baz):'
+
+
+def test_compile_polymorphic(tmpdir):
+    from cython_jit import JitStage, set_jit_stage
+    from importlib import reload
+
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    all_collectors = _get_jit_state_info().all_collectors
+    with set_jit_stage(JitStage.collect_info):
+        from tests_cython_jit import _to_cython_polymorphic
+        all_collectors.clear()
+        _to_cython_polymorphic = reload(_to_cython_polymorphic)
+        assert _to_cython_polymorphic.my_func_polymorphic(1) == 2
+        assert _to_cython_polymorphic.my_func_polymorphic(1.5) == 2.5
+
+        collector = all_collectors['my_func_polymorphic']
+        generated_info = collector.generate()
+        assert [x.rstrip() for x in generated_info.func_lines if x.strip()] == [
+            'def my_func_polymorphic_cy_wrapper(bar):',
+            '    if ((type(bar) is int)):',
+            '        return my_func_polymorphic(bar)',
+            '    if ((type(bar) is float)):',
+            '        return my_func_polymorphic__cyjit_1(bar)',
+            '    return my_func_polymorphic(bar)',
+            'cdef int64_t my_func_polymorphic(int64_t bar):',
+            '    return bar + 1',
+            'cdef double my_func_polymorphic__cyjit_1(double bar):',
+            '    return bar + 1',
+        ]
+
+        assert _to_cython_polymorphic.my_func_polymorphic_nogil(1) == 2
+        assert _to_cython_polymorphic.my_func_polymorphic_nogil(1.5) == 2.5
+        collector = all_collectors['my_func_polymorphic_nogil']
+        generated_info = collector.generate()
+        assert [x.rstrip() for x in generated_info.func_lines if x.strip()][:11] == [
+            'def my_func_polymorphic_nogil_cy_wrapper(bar):',
+            '    cdef int64_t _cyjit_0_bar',
+            '    cdef int64_t _cyjit_ret_0',
+            '    cdef double _cyjit_1_bar',
+            '    cdef double _cyjit_ret_1',
+            '    if ((type(bar) is int)):',
+            '        _cyjit_0_bar = bar',
+            '        with nogil:',
+            '            _cyjit_ret_0 = my_func_polymorphic_nogil(_cyjit_0_bar)',
+            '        return _cyjit_ret_0',
+            '    if ((type(bar) is float)):',
+        ]
+        _get_jit_state_info().compile_collected(silent=True)
+    all_collectors.clear()
+
+    with set_jit_stage(JitStage.use_compiled):
+        _to_cython_polymorphic = reload(_to_cython_polymorphic)
+        assert _to_cython_polymorphic.my_func_polymorphic(1) == 2
+        assert _to_cython_polymorphic.my_func_polymorphic(1.5) == 2.5
+        assert _to_cython_polymorphic.my_func_polymorphic_nogil(1) == 2
+        assert _to_cython_polymorphic.my_func_polymorphic_nogil(1.5) == 2.5
+
+
+def test_compile_jitted_calls(tmpdir):
+    from cython_jit import JitStage, set_jit_stage
+    from importlib import reload
+
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    all_collectors = _get_jit_state_info().all_collectors
+    with set_jit_stage(JitStage.collect_info):
+        from tests_cython_jit import _to_cython_calls
+        all_collectors.clear()
+        _to_cython_calls = reload(_to_cython_calls)
+        assert _to_cython_calls.twice_plus_one(1) == 3
+        assert _to_cython_calls.twice_plus_half(1.5) == 3.5
+        assert _to_cython_calls.triple_sum(1, 2) == 9
+
+        # The callee is inlined and each caller calls the specialization
+        # matching the types it passed.
+        generated_info = all_collectors['twice'].generate()
+        assert [x.rstrip() for x in generated_info.func_lines if x.startswith('cdef')] == [
+            'cdef inline int64_t twice(int64_t x):',
+            'cdef inline double twice__cyjit_1(double x):',
+        ]
+        generated_info = all_collectors['twice_plus_half'].generate()
+        assert [x.rstrip() for x in generated_info.func_lines if x.strip()][-2:] == [
+            'cdef double twice_plus_half(double x):',
+            '    return twice__cyjit_1(x) + 0.5',
+        ]
+        generated_info = all_collectors['twice_plus_one'].generate()
+        assert [x.rstrip() for x in generated_info.func_lines if x.strip()][-1:] == [
+            '    return twice(n) + 1',
+        ]
+        generated_info = all_collectors['triple'].generate()
+        assert [x.rstrip() for x in generated_info.func_lines if x.startswith('cdef')] == [
+            'cdef int64_t triple(int64_t x):',
+        ]
+        _get_jit_state_info().compile_collected(silent=True)
+    all_collectors.clear()
+
+    with set_jit_stage(JitStage.use_compiled):
+        _to_cython_calls = reload(_to_cython_calls)
+        assert _to_cython_calls.twice_plus_one(1) == 3
+        assert _to_cython_calls.twice_plus_half(1.5) == 3.5
+        assert _to_cython_calls.triple_sum(1, 2) == 9
+
+
+def test_runtime_stats(tmpdir):
+    import json
+    import sys
+    from importlib import import_module
+    from importlib import reload
+    import cython_jit
+    from cython_jit import JitStage, ModuleNotCachedError, jit, set_jit_stage
+
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    with _set_new_state_info(tmpdir):
+        assert cython_jit.get_stats() is None
+        cython_jit.set_stats_enabled()
+        all_collectors = _get_jit_state_info().all_collectors
+        with set_jit_stage(JitStage.collect_info):
+            module = sys.modules.get('tests_cython_jit._to_cython_calls')
+            module = import_module('tests_cython_jit._to_cython_calls') if module is None else reload(module)
+            assert module.twice_plus_one(1) == 3
+            assert module.twice_plus_half(1.5) == 3.5
+            assert module.triple_sum(1, 2) == 9
+
+            # The calls between jitted functions are still detected.
+            generated_info = all_collectors['twice_plus_half'].generate()
+            assert '    return twice__cyjit_1(x) + 0.5' in generated_info.func_lines
+            _get_jit_state_info().compile_collected(silent=True, jobs=1)
+        all_collectors.clear()
+
+        with set_jit_stage(JitStage.use_compiled):
+            module = reload(module)
+            for _i in range(3):
+                assert module.twice_plus_half(1.5) == 3.5
+
+            with pytest.raises(ModuleNotCachedError):
+                @jit()
+                def not_compiled(x):
+                    return x
+
+        stats = cython_jit.get_stats()
+        function_stats = stats.functions['tests_cython_jit._to_cython_calls.twice_plus_half']
+        assert function_stats.calls == 4
+        assert function_stats.mode_calls == {'collect': 1, 'compiled': 3}
+        assert function_stats.stage_calls == {'collect_info': 1, 'use_compiled': 3}
+        assert function_stats.collect_time > 0
+        assert function_stats.p50 is not None and function_stats.p99 >= function_stats.p50
+        assert stats.functions['tests_cython_jit._to_cython_calls.twice'].mode_calls == {'collect': 2}
+        assert stats.functions['%s.not_compiled' % (__name__,)].fallbacks == {'not_cached': 1}
+
+        module_stats, = stats.modules.values()
+        assert module_stats.pyd_name.startswith('tests_cython_jit__to_cython_calls_cyjit')
+        assert module_stats.duration > 0
+        assert module_stats.error is None
+
+        cython_jit.export_stats(str(tmpdir.join('stats.json')))
+        with open(str(tmpdir.join('stats.json'))) as stream:
+            assert json.load(stream)['functions'][
+                'tests_cython_jit._to_cython_calls.twice_plus_half']['mode_calls'] == {'collect': 1, 'compiled': 3}
+
+        cython_jit.export_stats(str(tmpdir.join('stats.prom')), output_format='prometheus')
+        contents = tmpdir.join('stats.prom').read()
+        assert '# TYPE cython_jit_calls_total counter' in contents
+        assert 'cython_jit_calls_total{module="tests_cython_jit._to_cython_calls",function="twice_plus_half",' \
+            'mode="compiled"} 3' in contents
+        assert 'cython_jit_fallbacks_total{module="%s",function="not_compiled",reason="not_cached"} 1' % (
+            __name__,) in contents
+        assert 'cython_jit_call_duration_seconds_count{' in contents
+
+        cython_jit.set_stats_enabled(False)
+        assert cython_jit.get_stats() is None
+
+
+def test_translate_numpy_arrays(tmpdir):
+    import numpy
+    from cython_jit import JitStage, set_jit_stage
+    from importlib import reload
+
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    all_collectors = _get_jit_state_info().all_collectors
+    with set_jit_stage(JitStage.collect_info):
+        from tests_cython_jit import _to_cython_numpy_dtypes
+        all_collectors.clear()
+        _to_cython_numpy_dtypes = reload(_to_cython_numpy_dtypes)
+        collector = all_collectors['sum_array']
+
+        for dtype, expected in [
+                ('bool', 'uint8_t'),
+                ('int8', 'int8_t'),
+                ('int16', 'int16_t'),
+                ('int32', 'int32_t'),
+                ('int64', 'int64_t'),
+                ('uint16', 'uint16_t'),
+                ('uint64', 'uint64_t'),
+                ('float32', 'float'),
+                ('float64', 'double'),
+                ('complex128', 'double complex'),
+            ]:
+            assert collector._translate_type('arr', numpy.zeros(3, dtype=dtype)) == expected + '[::1]'
+
+        arr = numpy.zeros((3, 4), dtype=numpy.float64)
+        assert collector._translate_type('arr', arr) == 'double[:, ::1]'
+        assert collector._translate_type('arr', numpy.asfortranarray(arr)) == 'double[::1, :]'
+        assert collector._translate_type('arr', arr[:, ::2]) == 'double[:, :]'
+        assert collector._translate_type('arr', arr[0, ::2]) == 'double[:]'
+
+        result = _to_cython_numpy_dtypes.sum_array(numpy.ones(5, dtype=numpy.float32))
+        assert result == 5.0
+        # Note: numpy < 2 promotes `0.0 + float32` to float64.
+        ret_type = 'float' if isinstance(result, numpy.float32) else 'double'
+        assert collector.get_def_line() == 'cdef %s sum_array(float[::1] arr):' % (ret_type,)
+        _get_jit_state_info().compile_collected(silent=True)
+    all_collectors.clear()
+
+    with set_jit_stage(JitStage.use_compiled):
+        _to_cython_numpy_dtypes = reload(_to_cython_numpy_dtypes)
+        assert _to_cython_numpy_dtypes.sum_array(numpy.ones(5, dtype=numpy.float32)) == 5.0
+
+
+def test_compile_directives(tmpdir):
+    import numpy
+    from cython_jit import JitStage, set_jit_stage
+    from importlib import reload
+
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    all_collectors = _get_jit_state_info().all_collectors
+    with set_jit_stage(JitStage.collect_info):
+        from tests_cython_jit import _to_cython_directives
+        all_collectors.clear()
+        _to_cython_directives = reload(_to_cython_directives)
+        arr = numpy.ones(4, dtype=numpy.float64)
+        _to_cython_directives.scale_array(arr, 2.0)
+
+        collector = all_collectors['scale_array']
+        generated_info = collector.generate()
+        assert 'cimport cython' in generated_info.c_import_lines
+        assert [x.rstrip() for x in generated_info.func_lines if x.strip()][4:9] == [
+            '@cython.boundscheck(False)',
+            '@cython.cdivision(True)',
+            '@cython.initializedcheck(False)',
+            '@cython.wraparound(False)',
+            'cdef void scale_array(double[::1] arr, double divisor) noexcept nogil:',
+        ]
+        _get_jit_state_info().compile_collected(silent=True)
+    all_collectors.clear()
+
+    with set_jit_stage(JitStage.use_compiled):
+        _to_cython_directives = reload(_to_cython_directives)
+        _to_cython_directives.scale_array(arr, 2.0)
+        assert arr.tolist() == [.25] * 4
+
+
+def test_infer_local_types():
+    from cython_jit._type_inference import infer_local_types
+
+    source = """
+def func(arr, n):
+    total = 0
+    count = 0
+    obj = None
+    for i in range(n):
+        value = arr[i] * 2
+        total += value
+        count += 1
+    mean = total / count
+    for item in arr:
+        pass
+    return [total, mean, obj, item]
+"""
+    assert infer_local_types(source, {'arr': 'float[::1]', 'n': 'int64_t'}) == {
+        'i': 'Py_ssize_t',
+        'value': 'double',
+        'total': 'double',
+        'count': 'Py_ssize_t',
+        'mean': 'double',
+    }
+    assert infer_local_types(source, {'arr': 'float[::1]', 'n': 'int64_t'}, declared_names={'total'}) == {
+        'i': 'Py_ssize_t',
+        'value': 'double',
+        'count': 'Py_ssize_t',
+    }
+
+    # The names used as indexes in subscript assignments may still be typed.
+    source = """
+def func(mat):
+    for i in range(mat.shape[0]):
+        for j in range(mat.shape[1]):
+            mat[i, j] = i * j
+    tmp = 1
+    del tmp
+"""
+    assert infer_local_types(source, {'mat': 'double[:, :]'}) == {'i': 'Py_ssize_t', 'j': 'Py_ssize_t'}
+
+
+def test_compile_infer_locals(tmpdir):
+    import numpy
+    from cython_jit import JitStage, set_jit_stage
+    from importlib import reload
+
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    all_collectors = _get_jit_state_info().all_collectors
+    with set_jit_stage(JitStage.collect_info):
+        from tests_cython_jit import _to_cython_infer_locals
+        all_collectors.clear()
+        _to_cython_infer_locals = reload(_to_cython_infer_locals)
+        arr = numpy.arange(6, dtype=numpy.float64).reshape(2, 3)
+        assert _to_cython_infer_locals.sum_2d(arr) == 15
+
+        collector = all_collectors['sum_2d']
+        generated_info = collector.generate()
+        assert [x.rstrip() for x in generated_info.func_lines if x.strip()][5:9] == [
+            'cdef double sum_2d(double[:, ::1] arr) noexcept nogil:',
+            '    cdef Py_ssize_t i',
+            '    cdef Py_ssize_t j',
+            '    cdef double total',
+        ]
+        # Without the declarations a nogil function with python locals
+        # wouldn't compile.
+        _get_jit_state_info().compile_collected(silent=True)
+    all_collectors.clear()
+
+    with set_jit_stage(JitStage.use_compiled):
+        _to_cython_infer_locals = reload(_to_cython_infer_locals)
+        assert _to_cython_infer_locals.sum_2d(arr) == 15
+
+
+def test_compile_parallel(tmpdir):
+    import numpy
+    from cython_jit import JitStage, set_jit_stage, jit
+    from importlib import reload
+
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    all_collectors = _get_jit_state_info().all_collectors
+    with set_jit_stage(JitStage.collect_info):
+        with pytest.raises(AssertionError):
+            jit(parallel=True)(lambda: None)
+
+        from tests_cython_jit import _to_cython_parallel
+        all_collectors.clear()
+        _to_cython_parallel = reload(_to_cython_parallel)
+        pixels_array = numpy.ones((4, 3), dtype=numpy.float64)
+        _to_cython_parallel.scale_pixels(pixels_array, 2.0)
+
+        collector = all_collectors['scale_pixels']
+        generated_info = collector.generate()
+        assert 'from cython.parallel cimport prange' in generated_info.c_import_lines
+        assert [x.rstrip() for x in generated_info.func_lines if x.strip()][:9] == [
+            'def scale_pixels_cy_wrapper(double[:, ::1] pixels_array, double factor) -> void:',
+            '    with nogil:',
+            '        scale_pixels(pixels_array, factor)',
+            '    return None',
+            'cdef void scale_pixels(double[:, ::1] pixels_array, double factor) noexcept nogil:',
+            '    cdef Py_ssize_t i',
+            '    cdef Py_ssize_t j',
+            '    for i in prange(pixels_array.shape[0], num_threads=2):',
+            '        for j in range(pixels_array.shape[1]):',
+        ]
+        compile_jobs = _get_jit_state_info()._create_compile_jobs()
+        assert [compile_job.profile.openmp for compile_job in compile_jobs] == [True]
+        _get_jit_state_info().compile_collected(silent=True)
+    all_collectors.clear()
+
+    with set_jit_stage(JitStage.use_compiled):
+        _to_cython_parallel = reload(_to_cython_parallel)
+        _to_cython_parallel.scale_pixels(pixels_array, 2.0)
+        assert pixels_array.tolist() == [[4.0] * 3] * 4
+
+
+def test_compile_flags_for_profiles():
+    import sys
+    from cython_jit.compile_with_cython import CompileProfile
+    from cython_jit.compile_with_cython import get_compile_flags
+    from cython_jit.compile_with_cython import get_compile_key
+
+    if sys.platform == 'win32':
+        return
+
+    compile_args, link_args = get_compile_flags('aggressive')
+    assert compile_args == ['-O3', '-march=native', '-mtune=native', '-ffast-math', '-flto']
+    assert link_args == ['-flto']
+
+    compile_args, link_args = get_compile_flags(CompileProfile(openmp=True), debug=True)
+    assert compile_args == ['-fopenmp', '-O0', '-g']
+    assert link_args == ['-fopenmp']
+
+    compile_args, link_args = get_compile_flags(CompileProfile(pgo='use'), pgo_dir='pgo_dir')
+    assert compile_args == ['-fprofile-use=pgo_dir', '-fprofile-correction', '-Wno-missing-profile']
+
+    assert get_compile_key('contents', profile='fast') != get_compile_key('contents', profile='native')
+
+    # Both pgo phases must generate the same module name.
+    assert get_compile_key('contents', profile=CompileProfile(opt_level='3', pgo='generate')) == \
+        get_compile_key('contents', profile=CompileProfile(opt_level='3', pgo='use'))
+
+
+def test_compile_with_pgo(tmpdir):
+    import sys
+    from cython_jit import JitStage, set_jit_stage
+    from importlib import reload
+
+    from cython_jit.compile_with_cython import CompileProfile
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    if sys.platform == 'win32':
+        return
+
+    all_collectors = _get_jit_state_info().all_collectors
+    with set_jit_stage(JitStage.collect_info):
+        from tests_cython_jit import _to_cython2
+        all_collectors.clear()
+        _to_cython2 = reload(_to_cython2)
+        _to_cython2.my_func3(1)
+        _to_cython2.my_func4(1)
+        _to_cython2.my_func5(1)
+
+        pgo_dir = str(tmpdir.join('pgo'))
+        _get_jit_state_info().compile_collected(
+            silent=True, jobs=1, profile=CompileProfile(opt_level='2', pgo='generate', pgo_dir=pgo_dir))
+        module_name = _get_jit_state_info()._pyd_name_to_module[all_collectors['my_func3'].get_pyd_name()].__name__
+        pgo_marker_path = _get_jit_state_info().get_dir('cache') / (module_name + '.pgo')
+        assert pgo_marker_path.read_text() == 'generate'
+
+        # Rebuilding with the profile data uses the same module name.
+        _get_jit_state_info().compile_collected(
+            silent=True, jobs=1, profile=CompileProfile(opt_level='2', pgo='use', pgo_dir=pgo_dir))
+        assert pgo_marker_path.read_text() == 'use'
+
+
+def test_native_module_not_used_in_other_cpu(tmpdir, monkeypatch):
+    import sys
+    from cython_jit import JitStage, set_jit_stage
+    from cython_jit import ModuleNotCachedError
+    from importlib import reload
+
+    from cython_jit import compile_with_cython
+    from cython_jit._jit_state_info import _get_jit_state_info
+    from cython_jit._manifest import read_manifest
+
+    if sys.platform == 'win32':
+        return
+
+    all_collectors = _get_jit_state_info().all_collectors
+    with set_jit_stage(JitStage.collect_info):
+        from tests_cython_jit import _to_cython2
+        all_collectors.clear()
+        _to_cython2 = reload(_to_cython2)
+        _to_cython2.my_func3(1)
+        _to_cython2.my_func4(1)
+        _to_cython2.my_func5(1)
+        _get_jit_state_info().compile_collected(silent=True, jobs=1, profile='native')
+    all_collectors.clear()
+
+    entry, = read_manifest(_get_jit_state_info().get_dir('cache')).values()
+    assert entry.cpu == compile_with_cython.get_cpu_key()
+    assert entry.profile == list(compile_with_cython.PROFILES['native'])
+
+    # i.e.: another host sharing the cache dir.
+    monkeypatch.setattr(compile_with_cython.get_cpu_key, '_cpu_key', 'other_cpu')
+    with _set_new_state_info(tmpdir):
+        with set_jit_stage(JitStage.use_compiled):
+            with pytest.raises(ModuleNotCachedError):
+                reload(_to_cython2)
+    all_collectors.clear()
+
+
+def test_bench_nogil_threads(tmpdir):
+    import numpy
+    from cython_jit import JitStage, set_jit_stage
+    from cython_jit._bench import bench_threads, _call_kernels, _load_kernels_module
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    with set_jit_stage(JitStage.collect_info):
+        _call_kernels(_load_kernels_module())
+        _get_jit_state_info().compile_collected(silent=True)
+
+    with set_jit_stage(JitStage.use_compiled):
+        kernels = _load_kernels_module()
+    arr = numpy.ones(100, dtype=numpy.float64)
+    assert kernels.bench_sum_squares(arr) == 100
+    assert bench_threads(kernels.bench_sum_squares, (arr,), num_threads=2, calls_per_thread=10) > 0
+
+
+def test_bench_command(tmpdir, capsys):
+    import json
+    from cython_jit.__main__ import main
+
+    json_path = str(tmpdir.join('bench.json'))
+    assert main([
+        'bench', '--kernel', 'bench_sum_squares', '--threads', '1,2', '--min-time', '0.001', '--repeat', '1',
+        '--json', json_path, '--cache-dir', str(tmpdir.join('cache')), '--temp-dir', str(tmpdir.join('temp'))]) == 0
+    assert 'Compile time:' in capsys.readouterr().out
+
+    with open(json_path) as stream:
+        report = json.load(stream)
+    assert report['compile_time'] > 0
+    assert report['import_time'] > 0
+    assert sorted((result['stage'], result['threads']) for result in report['results']) == [
+        ('collect_info', 1), ('python', 1), ('python', 2), ('use_compiled', 1), ('use_compiled', 2)]
+    assert all(result['kernel'] == 'bench_sum_squares' and result['throughput'] > 0 for result in report['results'])
+
+
+def test_compile_vectorize(tmpdir):
+    import numpy
+    from cython_jit import JitStage, set_jit_stage
+    from importlib import reload
+
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    all_collectors = _get_jit_state_info().all_collectors
+    with set_jit_stage(JitStage.collect_info):
+        from tests_cython_jit import _to_cython_vectorize
+        all_collectors.clear()
+        _to_cython_vectorize = reload(_to_cython_vectorize)
+        assert _to_cython_vectorize.scale_and_shift(numpy.arange(4.0), 2.0).tolist() == [1.0, 3.0, 5.0, 7.0]
+        assert _to_cython_vectorize.add_ints(1, 2) == 3
+
+        collector = all_collectors['scale_and_shift']
+        generated_info = collector.generate()
+        func_lines = [x.rstrip() for x in generated_info.func_lines if x.strip()]
+        assert func_lines[0] == 'def scale_and_shift_cy_wrapper(x, factor, out=None):'
+        assert func_lines[-8:] == [
+            '@cython.boundscheck(False)',
+            '@cython.wraparound(False)',
+            'cdef void scale_and_shift__cyjit_loop(double[::1] x, double[::1] factor, double[::1] out) noexcept nogil:',
+            '    cdef Py_ssize_t _cyjit_i',
+            '    for _cyjit_i in range(out.shape[0]):',
+            '        out[_cyjit_i] = scale_and_shift(x[_cyjit_i], factor[_cyjit_i])',
+            'cdef double scale_and_shift(double x, double factor) noexcept nogil:',
+            '    return x * factor + 1',
+        ]
+        _get_jit_state_info().compile_collected(silent=True)
+    all_collectors.clear()
+
+    with set_jit_stage(JitStage.use_compiled):
+        _to_cython_vectorize = reload(_to_cython_vectorize)
+        scale_and_shift = _to_cython_vectorize.scale_and_shift
+        assert scale_and_shift(2.0, 3.0) == 7.0
+
+        # Arrays are broadcast.
+        result = scale_and_shift(numpy.ones((2, 3)), [1, 2, 3])
+        assert result.shape == (2, 3)
+        assert result.tolist() == [[2.0, 3.0, 4.0]] * 2
+
+        out = numpy.zeros(3)
+        assert scale_and_shift(numpy.arange(3.0), 2.0, out=out) is out
+        assert out.tolist() == [1.0, 3.0, 5.0]
+
+        with pytest.raises(ValueError):
+            scale_and_shift(numpy.arange(3.0), 2.0, out=numpy.zeros(4))
+
+        # Values are only cast within the same kind (floats aren't truncated to ints).
+        add_ints = _to_cython_vectorize.add_ints
+        assert add_ints([1, 2], numpy.array([1, 2], dtype=numpy.int32)).tolist() == [2, 4]
+        with pytest.raises(TypeError):
+            add_ints([2.5, 3.5], 1)
+
+
+_PER_FUNCTION_MODULE = """
+import math
+
+from cython_jit import jit
+
+SCALE = 2
+
+
+def _helper(x):
+    return x * SCALE
+
+
+@jit()
+def scaled(x):
+    return _helper(x) + 1
+
+
+@jit()
+def floored(x):
+    return math.floor(x) + 10
+
+
+class Unrelated(object):
+    pass
+
+
+if __name__ == '__main__':
+    print(scaled(1))
+"""
+
+
+def test_compile_per_function(tmpdir, monkeypatch):
+    import sys
+    from importlib import import_module
+    from importlib import reload
+    from cython_jit import JitStage, set_jit_stage, set_build_mode
+    from cython_jit import compile_with_cython
+    from cython_jit._manifest import read_manifest
+
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    module_dir = tmpdir.join('per_function_src')
+    module_dir.ensure(dir=True)
+    module_dir.join('cyjit_per_function_mod.py').write(_PER_FUNCTION_MODULE)
+
+    compiled = []
+    original_compile_with_cython = compile_with_cython.compile_with_cython
+
+    def compile_and_record(module_name, module_contents, *args, **kwargs):
+        compiled.append(module_contents)
+        return original_compile_with_cython(module_name, module_contents, *args, **kwargs)
+
+    monkeypatch.setattr(compile_with_cython, 'compile_with_cython', compile_and_record)
+    monkeypatch.syspath_prepend(str(module_dir))
+    with _set_new_state_info(tmpdir):
+        set_build_mode('function')
+        all_collectors = _get_jit_state_info().all_collectors
+
+        def collect_and_compile():
+            all_collectors.clear()
+            with set_jit_stage(JitStage.collect_info):
+                mod = sys.modules.get('cyjit_per_function_mod')
+                mod = import_module('cyjit_per_function_mod') if mod is None else reload(mod)
+                assert mod.scaled(1) == 3
+                assert mod.floored(1.5) == 11
+                _get_jit_state_info().compile_collected(silent=True, jobs=1)
+            all_collectors.clear()
+            return mod
+
+        try:
+            mod = collect_and_compile()
+
+            # Each function is compiled only with what it needs.
+            assert len(compiled) == 2
+            scaled_contents, = [contents for contents in compiled if 'def scaled_cy_wrapper' in contents]
+            assert 'SCALE = 2' in scaled_contents
+            assert 'def _helper(x):' in scaled_contents
+            assert 'floored' not in scaled_contents
+            assert 'Unrelated' not in scaled_contents
+            assert 'import math' not in scaled_contents
+            assert '__main__' not in scaled_contents
+            assert sorted(pyd_name.split('__')[-1] for pyd_name in read_manifest(_get_jit_state_info().get_dir(
+                'cache')) if '__' in pyd_name) == ['floored', 'scaled']
+
+            with set_jit_stage(JitStage.use_compiled):
+                mod = reload(mod)
+                assert mod.scaled(2) == 5
+                assert mod.floored(2.5) == 12
+                assert mod.scaled.__name__ == 'scaled_cy_wrapper'
+            all_collectors.clear()
+
+            # Only the function changed is compiled again.
+            module_dir.join('cyjit_per_function_mod.py').write(
+                _PER_FUNCTION_MODULE.replace('_helper(x) + 1', '_helper(x) + 1 + 0'))
+            del compiled[:]
+            collect_and_compile()
+            assert len(compiled) == 1
+            assert 'def scaled_cy_wrapper' in compiled[0]
+        finally:
+            sys.modules.pop('cyjit_per_function_mod', None)
+
+
+def test_compile_sliced(tmpdir, monkeypatch):
+    import sys
+    from importlib import import_module
+    from importlib import reload
+    from cython_jit import JitStage, set_jit_stage, set_build_mode
+
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    module_dir = tmpdir.join('sliced_src')
+    module_dir.ensure(dir=True)
+    module_dir.join('cyjit_sliced_mod.py').write(_PER_FUNCTION_MODULE)
+    monkeypatch.syspath_prepend(str(module_dir))
+    with _set_new_state_info(tmpdir):
+        set_build_mode('sliced')
+        all_collectors = _get_jit_state_info().all_collectors
+        try:
+            with set_jit_stage(JitStage.collect_info):
+                mod = import_module('cyjit_sliced_mod')
+                assert mod.scaled(1) == 3
+                assert mod.floored(1.5) == 11
+
+                # Only the jitted functions and what they reference are compiled.
+                compile_job, = _get_jit_state_info()._create_compile_jobs()
+                assert compile_job.pyd_name == 'cyjit_sliced_mod_cyjit%s%s' % sys.version_info[:2]
+                for expected in ('import math', 'SCALE = 2', 'def _helper(x):', 'def scaled_cy_wrapper',
+                                 'def floored_cy_wrapper', 'def cython_jit_key_matches'):
+                    assert expected in compile_job.module_contents
+                assert 'Unrelated' not in compile_job.module_contents
+                assert '__main__' not in compile_job.module_contents
+                assert 'from cython_jit import jit' not in compile_job.module_contents
+
+                _get_jit_state_info().compile_collected(silent=True, jobs=1)
+            all_collectors.clear()
+
+            with set_jit_stage(JitStage.use_compiled):
+                mod = reload(mod)
+                assert mod.scaled(2) == 5
+                assert mod.floored(2.5) == 12
+                assert mod.floored.__name__ == 'floored_cy_wrapper'
+            all_collectors.clear()
+        finally:
+            sys.modules.pop('cyjit_sliced_mod', None)
+
+
+def test_compile_from_type_profiles(tmpdir):
+    from importlib import reload
+    from pathlib import Path
+    from cython_jit import JitStage, set_jit_stage, save_type_profile, get_cache_dir
+    from cython_jit import _type_profiles
+    from cython_jit.__main__ import main
+
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    profiles_dir = Path(str(tmpdir.join('profiles')))
+    all_collectors = _get_jit_state_info().all_collectors
+    with set_jit_stage(JitStage.collect_info):
+        from tests_cython_jit import _to_cython_polymorphic
+        all_collectors.clear()
+        _to_cython_polymorphic = reload(_to_cython_polymorphic)
+        assert _to_cython_polymorphic.my_func_polymorphic(1) == 2
+        assert _to_cython_polymorphic.my_func_polymorphic_nogil(1) == 2
+        save_type_profile(profiles_dir / 'process1.json')
+
+        # Information collected in another process.
+        all_collectors.clear()
+        _to_cython_polymorphic = reload(_to_cython_polymorphic)
+        assert _to_cython_polymorphic.my_func_polymorphic(1) == 2
+        for _i in range(3):
+            assert _to_cython_polymorphic.my_func_polymorphic(1.5) == 2.5
+        save_type_profile(profiles_dir / 'process2.json')
+    all_collectors.clear()
+
+    type_profile = _type_profiles.load_type_profiles([profiles_dir])
+    func_profiles = type_profile['functions']
+    assert [func_profile['name'] for func_profile in func_profiles] == [
+        'my_func_polymorphic', 'my_func_polymorphic_nogil']
+    # The signature with more calls is the primary one.
+    assert [(signature['arg_types'], signature['count']) for signature in func_profiles[0]['signatures']] == [
+        ([['bar', 'double']], 3),
+        ([['bar', 'int64_t']], 2),
+    ]
+
+    # A profile from a function which changed isn't used.
+    collectors, stale = _type_profiles.create_collectors(dict(
+        type_profile, functions=[dict(func_profiles[0], key='changed')]))
+    assert [func_profile['name'] for func_profile in stale] == ['my_func_polymorphic']
+    assert sorted((collector.func.__name__, collector.collected_info()) for collector in collectors) == [
+        ('my_func_polymorphic', False), ('my_func_polymorphic_nogil', False)]
+
+    # Profiles from another python version can't be used.
+    with pytest.raises(AssertionError):
+        _type_profiles.compile_type_profile(dict(type_profile, python='2.7'))
+
+    # Compile without importing the module.
+    assert main(['compile', '--profile', str(profiles_dir), '--cache-dir', str(get_cache_dir())]) == 0
+    assert not all_collectors
+
+    with set_jit_stage(JitStage.use_compiled):
+        _to_cython_polymorphic = reload(_to_cython_polymorphic)
+        assert _to_cython_polymorphic.my_func_polymorphic(1) == 2
+        assert _to_cython_polymorphic.my_func_polymorphic(1.5) == 2.5
+        assert _to_cython_polymorphic.my_func_polymorphic_nogil(1) == 2
+
+
+@pytest.mark.parametrize('output_format', ['wheel', 'tar'])
+def test_build_package(tmpdir, output_format):
+    import sys
+    import tarfile
+    import zipfile
+    from importlib import import_module
+    from pathlib import Path
+    from cython_jit import JitStage, set_jit_stage, set_cache_dir, get_cache_dir
+    from cython_jit.__main__ import main
+    from cython_jit._manifest import read_manifest
+
+    from cython_jit._jit_state_info import _get_jit_state_info
+
+    package_dir = Path(__file__).absolute().parent
+    output_dir = Path(str(tmpdir.join('dist')))
+    assert main(['build', str(package_dir), '--output', str(output_dir), '--format', output_format]) == 0
+
+    # Only the fully annotated functions are compiled (no type profile given).
+    installed_dir = Path(str(tmpdir.join('installed')))
+    if output_format == 'wheel':
+        wheel_path, = output_dir.glob('tests_cython_jit_cyjit-0.0.0-*.whl')
+        with zipfile.ZipFile(str(wheel_path)) as zip_file:
+            names = zip_file.namelist()
+            assert 'tests_cython_jit_cyjit-0.0.0.dist-info/RECORD' in names
+            zip_file.extractall(str(installed_dir))
+
+        sys.path.insert(0, str(installed_dir))
+        try:
+            import tests_cython_jit_cyjit
+            cache_dir = tests_cython_jit_cyjit.CACHE_DIR
+        finally:
+            sys.path.remove(str(installed_dir))
+            sys.modules.pop('tests_cython_jit_cyjit', None)
+    else:
+        tar_path, = output_dir.glob('tests_cython_jit_cyjit-0.0.0-*.tar.gz')
+        with tarfile.open(str(tar_path)) as tar:
+            tar.extractall(str(installed_dir))
+        cache_dir = installed_dir
+
+    assert sorted(pyd_name.split('_cyjit')[0] for pyd_name in read_manifest(cache_dir)) == [
+        'tests_cython_jit__to_cython_annotated']
+
+    initial_cache_dir = get_cache_dir()
+    set_cache_dir(cache_dir)
+    try:
+        _get_jit_state_info().all_collectors.clear()
+        with set_jit_stage(JitStage.use_compiled):
+            sys.modules.pop('tests_cython_jit._to_cython_annotated', None)
+            _to_cython_annotated = import_module('tests_cython_jit._to_cython_annotated')
+            assert _to_cython_annotated.add_annotated(1.5) == 2.5
+            assert _to_cython_annotated.add_annotated(1.5, 2) == 3.5
+            assert _to_cython_annotated.add_annotated.__name__ == 'add_annotated_cy_wrapper'
+            assert _to_cython_annotated.mul_annotated(1.5, 2) == 3.0
+            assert _to_cython_annotated.mul_annotated.__name__ == 'mul_annotated_cy_wrapper'
+            assert _to_cython_annotated.div_annotated(-33) == -2  # cdivision: truncated.
+            assert _to_cython_annotated.div_annotated.__name__ == 'div_annotated_cy_wrapper'
+    finally:
+        set_cache_dir(initial_cache_dir)
+
+
+@pytest.mark.parametrize('decorator, def_line, expected', [
+    ('@jit(directives=dict(cdivision=True))', "def func(a: 'double') -> 'double':", 'options: directives, defaults: -'),
+    ('@jit()', "def func(a: 'double', b: 'double'=SCALE) -> 'double':", 'options: -, defaults: b'),
+])
+def test_build_package_non_literal(tmpdir, decorator, def_line, expected):
+    from pathlib import Path
+    from cython_jit.__main__ import main
+
+    package_dir = Path(str(tmpdir.join('non_literal')))
+    package_dir.mkdir()
+    (package_dir / '__init__.py').write_text('')
+    (package_dir / 'mod.py').write_text('\n'.join([
+        'from cython_jit import jit',
+        'SCALE = 2',
+        decorator,
+        def_line,
+        '    return a',
+        '']))
+
+    # The compiled function would never be used (its key depends on values
+    # which are only available when the module is imported).
+    with pytest.raises(AssertionError) as exc_info:
+        main(['build', str(package_dir), '--output', str(tmpdir.join('dist'))])
+    assert 'non_literal.mod.func' in str(exc_info.value)
+    assert expected in str(exc_info.value)